@@ -15,17 +15,35 @@ This project deploys an **autonomous LangGraph AI assistant** in a **real-world
 - Accepts a user-defined goal (e.g. `"Build a workout planner"`)
 - Estimates number of days needed to complete it
 - Breaks it into subtasks automatically
-- Executes tasks and reviews progress daily
+- `PLANNER_BATCH_SIZE`: let the planner return several independent subtasks per day; each runs in its own executor branch (LangGraph `Send`) and the reviewer joins them into one round
+- `PIPELINE_PLANNING=1`: drafts the next day's plan while the executor runs, assuming the task is accepted; the draft is used only if the reviewed progress matches (hit ratio in `agent_planner_speculation_hit_ratio`)
+- Keeps planner prompts bounded: the last `PLANNER_RECENT_SUBTASKS` subtasks stay verbatim, older ones are folded into a rolling summary within `PLANNER_CONTEXT_TOKENS`
+- Executes tasks and reviews progress daily (tasks run in a pool of pre-forked sandbox processes: `EXECUTOR_WORKERS`, `EXECUTOR_TIMEOUT`, `EXECUTOR_MAX_RSS_MB`, `EXECUTOR_MAX_TASKS`)
+- Routes each worker node straight to the next role (three graph steps per day, recursion limit sized from the estimated days; `python app.py --bench graph` compares against the old `role_switch` topology)
+- Enforces per-session budgets before every planning call: the estimated `max_rounds`, `SESSION_TOKEN_BUDGET` tokens and a `SESSION_DEADLINE_SECONDS` deadline; the session ends gracefully with `end_reason` recorded
 - Persists memory across sessions (like a real autonomous agent)
+- Shares one OpenAI request scheduler across all sessions: request/token rate buckets (`LLM_REQUESTS_PER_MINUTE`, `LLM_TOKENS_PER_MINUTE`), an AIMD concurrency limit (`LLM_MAX_CONCURRENCY`, `LLM_LATENCY_TARGET`) and jittered exponential backoff on 429s/timeouts (`LLM_MAX_RETRIES`)
+- Caches repeated OpenAI answers in memory and in `llm_cache.sqlite` (`LLM_CACHE_NODES`, `LLM_CACHE_TTL`, `LLM_CACHE_MEMORY_ITEMS`, `LLM_CACHE_DISK_ITEMS`)
+- Collapses identical OpenAI requests that are in flight at the same time into one call (`LLM_COALESCE`, savings in `agent_llm_coalescing_ratio`)
+- Schedules sessions one day at a time over `SESSION_WORKERS` slots with weighted fair queuing per tenant and priority (`tenant`/`priority` on `POST /sessions`, `TENANT_WEIGHTS`, `PRIORITY_WEIGHTS`); past `SESSION_ADMIT_LIMIT` (or `SESSION_TENANT_LIMIT` for one tenant) new goals get a 429 and `/ready` reports `saturated`; with `LEASE_DB` the limits count every replica's open sessions and replicas claim leases in the same weighted order
+- Rejects planned subtasks that repeat done work, using a per-session MinHash index over word shingles (`DEDUP_THRESHOLD`), and re-plans without them (`DEDUP_MAX_REPLANS`); rounds and estimated tokens saved show up per session and in `agent_dedup_*` metrics (`FAKE_LLM_REPEAT_RATE` makes the offline backend repeat itself)
 
 ---
 
 ## ⚙️ Infrastructure Features
 - `Dockerfile`: Builds a container for the agent
 - `docker-compose.yml`: Optional local monitoring stack (Prometheus + Grafana)
-- `deployment.yaml` + `service.yaml`: Kubernetes deployment and exposure configs
-- `agent_memory.json`: Mounted volume to persist daily progress
-- `/health` and `/ready`: FastAPI endpoints for liveness/readiness probes
+- `deployment.yaml` + `service.yaml` + `pvc.yaml`: Kubernetes deployment and exposure configs; the replicas share SQLite databases on one `ReadWriteOnce` volume (avoid network filesystems, whose locks SQLite can't rely on), so they are pinned to a single node and run with `SQLITE_JOURNAL_MODE=DELETE` (WAL does not work across hosts)
+- `agent_memory.json` + `agent_memory.journal`: Mounted volume to persist daily progress (periodic snapshot plus an append-only, fsync-batched journal of per-step deltas; other sessions live under `sessions/`)
+- `STATE_STORE=sqlite`: keep every session in one WAL-mode `agent_state.sqlite` with group-committed writes (`python app.py --bench store` compares both stores at 1k and 10k sessions)
+- `LEASE_DB`: replicas claim sessions through heartbeat-renewed leases (`LEASE_TTL`, `LEASE_HEARTBEAT`, `LEASE_CAPACITY`) in a shared SQLite table, so each session runs on one pod and an expired lease is resumed elsewhere from the shared state store
+- `/health` and `/ready`: FastAPI endpoints for liveness/readiness probes; the server starts first and `/ready` stays 503 until the OpenAI client, graph, state store, history index and executor workers are warm and the executor has capacity (`python app.py --bench coldstart` measures both)
+- `/sessions`: submit many goals at once, each runs as its own async session
+- `/sessions/{id}/log?since_round=&after=&limit=` and `/sessions/{id}/subtasks`: paginated session history served from `agent_history.sqlite`, indexed by session and round (state itself only keeps the last `LOG_WINDOW` log entries)
+- `/sessions/{id}/events`: Server-Sent Events for one session (status changes, node start/end, planned tasks, executor results, reviews, planner tokens, end reason); filter with `?types=planned,result`, each subscriber keeps the newest `EVENT_BUFFER` events and `seq` gaps show what a slow client missed; with `LEASE_DB`, a session running on another replica answers 409 with its `owner`, while `GET /sessions` and `GET /sessions/{id}` read it from the lease table and the shared state store
+- Progress messages go through `logging` (`LOG_LEVEL=INFO` for the per-step chatter, `WARNING` by default)
+- `/sessions/{id}/plan-stream`: planner tokens only as they arrive (`PLANNER_STREAM=1` streams from OpenAI and stops reading at the first full subtask line or `GOAL COMPLETE`)
+- `/metrics`: Prometheus metrics (node latency, OpenAI latency/errors/tokens, rounds per session, memory write time)
 
 ---
 
@@ -44,6 +62,7 @@ This project deploys an **autonomous LangGraph AI assistant** in a **real-world
 | `Dockerfile` | Container build for the AI agent |
 | `deployment.yaml` | Kubernetes deployment definition |
 | `service.yaml` | Kubernetes service (exposes `/health` and `/ready`) |
+| `pvc.yaml` | Volume claim for the SQLite state, history and lease databases |
 | `docker-compose.yml` | Launches Grafana + Prometheus stack |
 | `prometheus.yml` | Prometheus scrape config |
 | `requirements.txt` | Python dependencies |
@@ -56,6 +75,20 @@ This project deploys an **autonomous LangGraph AI assistant** in a **real-world
 docker build -t langgraph-agent .
 docker run -p 8000:8000 -e USER_GOAL="Learn LangGraph" langgraph-agent
 
+# submit more goals to the running agent
+curl -X POST localhost:8000/sessions -H "Content-Type: application/json" -d '{"goals": ["Learn LangGraph", "Build a workout planner"]}'
+curl localhost:8000/sessions
+
+# estimate a whole file of goals (JSONL or CSV with a `goal` column) without starting the server
+python app.py --batch goals.jsonl --concurrency 64 --plan
+
+# benchmark offline against the deterministic fake LLM (sessions/sec, per-node p50/p99, memory, persistence cost)
+LLM_BACKEND=fake FAKE_LLM_LATENCY=lognormal:0.8:0.5 FAKE_LLM_ERROR_RATE=0.02 python app.py --bench suite
+
+# record a real run, then replay it without network access
+LLM_RECORD_PATH=llm_recording.jsonl python app.py --batch goals.jsonl --plan
+LLM_BACKEND=replay LLM_REPLAY_PATH=llm_recording.jsonl python app.py --batch goals.jsonl --plan
+
 """
 
 with open("README.md", "w") as f:
@@ -102,7 +135,7 @@ with open("docker-notes.md", "w") as f:
 from google.colab import files
 files.download("docker-notes.md")
 
-!pip install -q langgraph openai
+!pip install -q langgraph openai prometheus-client
 
 import json
 from langgraph.graph import StateGraph
@@ -113,186 +146,2595 @@ import os
 os.environ["OPENAI_API_KEY"] = getpass("🔑 Enter your OpenAI API Key: ")
 
 import os
+import csv
+import ast
 import json
-from openai import OpenAI
-import langgraph
-from langgraph.graph import StateGraph
-
-# ✅ User input is now pulled from environment variable
+import re
+import time
+import uuid
+import types
+import math
+import random
+import heapq
+import itertools
+import contextlib
+import socket
+import asyncio
+import builtins
+import hashlib
+import logging
+import operator
+import multiprocessing
+import sqlite3
+import functools
+import threading
+from collections import OrderedDict
+from typing import Annotated, Any, TypedDict
+from contextvars import ContextVar
+import langgraph  # the OpenAI SDK and the graph modules are imported lazily, see warm_up()
+from prometheus_client import Counter, Gauge, Histogram
+
+# 📝 Progress messages go through logging, so a busy server only writes what LOG_LEVEL asks for
+LOG_LEVEL = os.getenv("LOG_LEVEL", "WARNING").upper()
+logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger("agent")
+
+# 🪵 Log ring buffer: state keeps the last LOG_WINDOW entries, the full history lives in the history index
+LOG_WINDOW = int(os.getenv("LOG_WINDOW", "50"))
+
+def append_log(left, right):
+    return (left + right)[-LOG_WINDOW:]
+
+def log_update(state, *entries):
+    overflow = len(state.get("log", [])) + len(entries) - LOG_WINDOW
+    update = {"log": list(entries)}
+    if overflow > 0:
+        update["log_spilled"] = state.get("log_spilled", 0) + overflow
+    return update
+
+def last_value(left, right):
+    return right
+
+def collect_results(left, right):
+    # Parallel executors append their results; the reviewer resets the list by writing None
+    return [] if right is None else (left or []) + right
+
+def log_total(state):
+    return state.get("log_spilled", 0) + len(state.get("log", []))
+
+# 🧩 Typed agent state: nodes return only the keys they change, append-only lists use reducers
+class AgentState(TypedDict, total=False):
+    session_id: str
+    user_goal: str
+    role: Annotated[str, last_value]
+    round: int
+    max_rounds: int
+    difficulty_estimated: bool
+    task: str
+    tasks: list
+    result: Any
+    results: Annotated[list, collect_results]
+    planner_failures: int
+    progress_summary: str
+    summarized_count: int
+    log_spilled: int
+    log: Annotated[list, append_log]
+    subtask_progress: Annotated[list, operator.add]
+    tokens_used: Annotated[int, operator.add]
+    started_at: float
+    end_reason: str
+    duplicates_rejected: int
+    rounds_saved: int
+    tokens_saved: int
+
+REDUCERS = {
+    "log": append_log,
+    "subtask_progress": operator.add,
+    "results": collect_results,
+    "tokens_used": operator.add
+}
+REDUCER_DEFAULTS = {"tokens_used": 0}
+
+def merge_update(state, update):
+    # Apply a node's return value the way the graph's reducers would
+    merged = {**state, **update}
+    for key, reducer in REDUCERS.items():
+        if key in update:
+            merged[key] = reducer(state.get(key, REDUCER_DEFAULTS.get(key, [])), update[key])
+    return merged
+
+# ✅ User input comes from the session, falling back to the environment variable
 def user_goal_node(state):
-    goal = os.getenv("USER_GOAL", "Default Goal")
-    print(f"User Goal Provided: {goal}")
-    return {**state, "user_goal": goal, "role": "planner"}
+    goal = " ".join((state.get("user_goal") or os.getenv("USER_GOAL", "Default Goal")).split())
+    logger.info("User goal provided: %s", goal)
+    return {"user_goal": goal, "role": "planner"}
+
+# 🔌 LLM backend: OpenAI (optionally recording every response), a deterministic offline fake, or a replay
+LLM_BACKEND = os.getenv("LLM_BACKEND", "openai")
+LLM_RECORD_PATH = os.getenv("LLM_RECORD_PATH")
+LLM_REPLAY_PATH = os.getenv("LLM_REPLAY_PATH", "llm_recording.jsonl")
+LLM_REPLAY_LATENCY_SCALE = float(os.getenv("LLM_REPLAY_LATENCY_SCALE", "1.0"))
+FAKE_LLM_LATENCY = os.getenv("FAKE_LLM_LATENCY", "lognormal:0.8:0.5")  # fixed:s | uniform:lo:hi | lognormal:median:sigma
+FAKE_LLM_ERROR_RATE = float(os.getenv("FAKE_LLM_ERROR_RATE", "0"))
+FAKE_LLM_ERRORS = os.getenv("FAKE_LLM_ERRORS", "RateLimitError,InternalServerError,APITimeoutError").split(",")
+FAKE_LLM_SEED = int(os.getenv("FAKE_LLM_SEED", "0"))
+FAKE_LLM_REPEAT_RATE = float(os.getenv("FAKE_LLM_REPEAT_RATE", "0"))  # share of plans that repeat the last subtask
+
+def completion_response(content, usage):
+    message = types.SimpleNamespace(content=content)
+    return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)], usage=usage)
+
+class OfflineStream:
+    def __init__(self, content, usage, latency):
+        self.words = content.split(" ")
+        self.usage = usage
+        self.latency = latency
+        self.sent = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        # First token after ~30% of the latency, the rest spread evenly; usage arrives in a final chunk
+        if self.sent > len(self.words):
+            raise StopAsyncIteration
+        share = 0.3 if self.sent == 0 else 0.7 / max(len(self.words), 1)
+        await asyncio.sleep(self.latency * share)
+        self.sent += 1
+        if self.sent > len(self.words):
+            return types.SimpleNamespace(choices=[], usage=self.usage)
+        text = self.words[self.sent - 1] + (" " if self.sent < len(self.words) else "")
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(delta=types.SimpleNamespace(content=text))], usage=None)
+
+    async def close(self):
+        self.sent = len(self.words) + 1
+
+class OfflineLLM:
+    # Speaks just enough of the AsyncOpenAI surface for request_completion and stream_completion
+    def __init__(self):
+        self.chat = types.SimpleNamespace(completions=self)
+
+    async def create(self, model, messages, stream=False, stream_options=None, **params):
+        content, usage, latency = await self.reply(model, messages, params)
+        if usage is None:
+            usage = types.SimpleNamespace(
+                prompt_tokens=sum(estimate_tokens(m["content"]) for m in messages),
+                completion_tokens=estimate_tokens(content)
+            )
+        if stream:
+            return OfflineStream(content, usage, latency)
+        await asyncio.sleep(latency)
+        return completion_response(content, usage)
+
+class FakeLLM(OfflineLLM):
+    # Answers from the prompt alone: a goal always takes the same number of days and subtasks are cheap expressions
+    def __init__(self, latency, error_rate, seed):
+        super().__init__()
+        kind, *args = latency.split(":")
+        self.latency = (kind, [float(arg) for arg in args])
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+
+    def sample_latency(self):
+        kind, args = self.latency
+        if kind == "uniform":
+            return self.random.uniform(*args)
+        if kind == "lognormal":
+            median, sigma = args
+            return self.random.lognormvariate(math.log(median), sigma)
+        return args[0]
+
+    def inject_error(self):
+        import httpx
+        from openai import APITimeoutError, InternalServerError, RateLimitError
+        request = httpx.Request("POST", "https://fake-llm.local/v1/chat/completions")
+        name = self.random.choice(FAKE_LLM_ERRORS)
+        if name == "APITimeoutError":
+            return APITimeoutError(request=request)
+        status = 429 if name == "RateLimitError" else 500
+        error = RateLimitError if status == 429 else InternalServerError
+        return error("injected by FakeLLM", response=httpx.Response(status, request=request), body=None)
+
+    @staticmethod
+    def goal_days(goal):
+        return 2 + int(hashlib.sha256(normalize_text(goal).encode()).hexdigest(), 16) % 4
+
+    @staticmethod
+    def parse_list(text):
+        try:
+            return ast.literal_eval(text)
+        except (ValueError, SyntaxError):
+            return []
+
+    def answer(self, messages):
+        system, user = messages[0]["content"], messages[-1]["content"]
+        if "task analyst" in system:
+            return str(self.goal_days(user.removeprefix("My goal is: ")))
+        if "running summary" in system:
+            done = re.search(r"Completed (\d+) subtasks", user)
+            newly = re.search(r"Newly completed: (\[.*\])", user, re.S)
+            count = (int(done.group(1)) if done else 0) + len(self.parse_list(newly.group(1)) if newly else [])
+            return f"Completed {count} subtasks so far."
+        if "AI planner" in system:
+            goal = re.search(r"The user's goal is: '(.*?)'\. ", system, re.S)
+            summarized = re.search(r"Completed (\d+) subtasks", system)
+            recent = re.search(r"They have already completed: (\[.*?\])\. ", system, re.S)
+            done = (int(summarized.group(1)) if summarized else 0) + len(self.parse_list(recent.group(1)) if recent else [])
+            remaining = self.goal_days(goal.group(1) if goal else "") - done
+            if remaining <= 0:
+                return "GOAL COMPLETE"
+            if recent and "Do not suggest" not in system and self.random.random() < FAKE_LLM_REPEAT_RATE:
+                repeated = self.parse_list(recent.group(1))
+                if repeated:
+                    return f"{repeated[-1].capitalize()}."
+            batch = re.search(r"return up to (\d+) next subtasks", system)
+            count = min(int(batch.group(1)) if batch else 1, remaining)
+            return "\n".join(f"sum(range({(done + i + 1) * 1000}))" for i in range(count))
+        return "OK"
+
+    async def reply(self, model, messages, params):
+        latency = self.sample_latency()
+        if self.random.random() < self.error_rate:
+            await asyncio.sleep(latency)
+            raise self.inject_error()
+        return self.answer(messages), None, latency
+
+class ReplayLLM(OfflineLLM):
+    def __init__(self, path, latency_scale):
+        super().__init__()
+        self.latency_scale = latency_scale
+        self.recorded = {}
+        with open(path) as f:
+            for line in f:
+                entry = json.loads(line)
+                self.recorded.setdefault(entry["key"], []).append(entry)
+        self.served = {}
+
+    async def reply(self, model, messages, params):
+        key = cache_key(model, messages, params)
+        entries = self.recorded.get(key)
+        if not entries:
+            raise LookupError(f"No recorded {model} response for this request")
+        # Identical requests get their recorded answers in order, then the last one again
+        index = self.served.get(key, 0)
+        self.served[key] = index + 1
+        entry = entries[min(index, len(entries) - 1)]
+        return entry["content"], types.SimpleNamespace(**entry["usage"]), entry["latency"] * self.latency_scale
+
+class RecordingLLM:
+    # Wraps the real client; streamed requests are fetched whole so the recording holds complete answers
+    def __init__(self, inner, path):
+        self.inner = inner
+        self.path = path
+        self.lock = threading.Lock()
+        self.chat = types.SimpleNamespace(completions=self)
+
+    async def create(self, model, messages, stream=False, stream_options=None, **params):
+        start = time.perf_counter()
+        response = await self.inner.chat.completions.create(model=model, messages=messages, **params)
+        latency = time.perf_counter() - start
+        content = response.choices[0].message.content
+        usage = {"prompt_tokens": response.usage.prompt_tokens, "completion_tokens": response.usage.completion_tokens}
+        entry = {"key": cache_key(model, messages, params), "model": model, "content": content, "usage": usage, "latency": latency}
+        with self.lock, open(self.path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+        if stream:
+            return OfflineStream(content, response.usage, 0)
+        return response
+
+def make_llm_client():
+    if LLM_BACKEND == "fake":
+        return FakeLLM(FAKE_LLM_LATENCY, FAKE_LLM_ERROR_RATE, FAKE_LLM_SEED)
+    if LLM_BACKEND == "replay":
+        return ReplayLLM(LLM_REPLAY_PATH, LLM_REPLAY_LATENCY_SCALE)
+    from openai import AsyncOpenAI
+
+    # Async client so hundreds of sessions can wait on OpenAI at the same time
+    # (retries are owned by the request scheduler below, not the SDK)
+    openai_client = AsyncOpenAI(max_retries=0)
+    return RecordingLLM(openai_client, LLM_RECORD_PATH) if LLM_RECORD_PATH else openai_client
+
+client = None
+client_lock = threading.Lock()
+
+def llm_client():
+    global client
+    if client is None:
+        with client_lock:
+            if client is None:
+                client = make_llm_client()
+    return client
+
+# 📊 Prometheus metrics (served on /metrics)
+NODE_LATENCY = Histogram("agent_node_latency_seconds", "Time spent in each graph node", ["node"])
+LLM_LATENCY = Histogram(
+    "agent_llm_request_seconds", "OpenAI chat completion latency", ["model"],
+    buckets=(0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60)
+)
+LLM_ERRORS = Counter("agent_llm_errors_total", "Failed OpenAI chat completions", ["model", "error"])
+LLM_TOKENS = Counter("agent_llm_tokens_total", "Tokens used by OpenAI chat completions", ["model", "kind"])
+SESSION_ROUNDS = Histogram(
+    "agent_session_rounds", "Rounds a session ran before it stopped",
+    buckets=(1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 30, 50)
+)
+SAVE_STATE_LATENCY = Histogram("agent_save_state_seconds", "Time spent writing agent memory")
+ACTIVE_SESSIONS = Gauge("agent_active_sessions", "Sessions currently running")
+LOG_MEMORY_BYTES = Gauge("agent_log_memory_bytes", "Bytes of log entries held in memory across all sessions")
+LOG_MEMORY_BYTES.set_function(lambda: sum(session_log_bytes(s["state"]) for s in list(sessions.values())))
+LLM_TTFT = Histogram(
+    "agent_llm_time_to_first_token_seconds", "Time until the first streamed token arrives", ["model"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10)
+)
+
+# 📡 Event bus: node transitions, plans, results and planner tokens fan out to /sessions/{id}/events
+EVENT_BUFFER = int(os.getenv("EVENT_BUFFER", "256"))
+TERMINAL_STATUSES = ("done", "failed", "stopped", "cancelled")
+
+EVENTS_PUBLISHED = Counter("agent_events_published_total", "Session events delivered to subscribers", ["type"])
+EVENTS_DROPPED = Counter("agent_events_dropped_total", "Oldest events dropped because a subscriber fell behind")
+
+class EventBus:
+    # Each subscriber gets a bounded queue; a slow one loses its oldest events, never blocks the session
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.subscribers = {}
+        self.seq = {}
+        self.loop = None
+
+    def subscribe(self, session_id):
+        self.loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=self.buffer)
+        self.subscribers.setdefault(session_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, session_id, queue):
+        queues = self.subscribers.get(session_id, set())
+        queues.discard(queue)
+        if not queues:
+            self.subscribers.pop(session_id, None)
+            self.seq.pop(session_id, None)
+
+    def publish(self, session_id, kind, **data):
+        if session_id not in self.subscribers:
+            return
+        event = {"type": kind, "session_id": session_id, "time": time.time(), **data}
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            self.deliver(session_id, event)
+        else:
+            self.loop.call_soon_threadsafe(self.deliver, session_id, event)  # sync nodes run in worker threads
+
+    def deliver(self, session_id, event):
+        # Sequence numbers let a client see where events were dropped
+        seq = self.seq.get(session_id, 0) + 1
+        self.seq[session_id] = seq
+        event["seq"] = seq
+        EVENTS_PUBLISHED.labels(event["type"]).inc()
+        for queue in self.subscribers.get(session_id, ()):
+            if queue.full():
+                queue.get_nowait()
+                EVENTS_DROPPED.inc()
+            queue.put_nowait(event)
+
+event_bus = EventBus(EVENT_BUFFER)
+
+def publish_token(session_id, text):
+    event_bus.publish(session_id, "token", text=text)
+
+# 🎟️ Token metering: every LLM call charges the meter of the node (or speculative draft) that made it
+class TokenMeter:
+    def __init__(self):
+        self.tokens = 0
+
+    def charge(self, usage):
+        if usage:
+            self.tokens += usage.prompt_tokens + usage.completion_tokens
+
+token_meter = ContextVar("token_meter", default=None)
+
+def charge_tokens(usage):
+    meter = token_meter.get()
+    if meter is not None:
+        meter.charge(usage)
+
+async def metered(meter, coro):
+    token_meter.set(meter)  # tasks run in a copied context, so this stays local to the task
+    return await coro
+
+node_samples = None  # name -> [seconds], collected only while a benchmark runs
+
+def observe_node(name, seconds):
+    NODE_LATENCY.labels(name).observe(seconds)
+    if node_samples is not None:
+        node_samples.setdefault(name, []).append(seconds)
+
+def timed_node(name, node):
+    if asyncio.iscoroutinefunction(node):
+        @functools.wraps(node)
+        async def timed(state):
+            start = time.perf_counter()
+            event_bus.publish(state.get("session_id"), "node", node=name, phase="start")
+            meter = TokenMeter()
+            reset = token_meter.set(meter)
+            try:
+                update = await node(state)
+            finally:
+                token_meter.reset(reset)
+                observe_node(name, time.perf_counter() - start)
+                event_bus.publish(state.get("session_id"), "node", node=name, phase="end", seconds=time.perf_counter() - start)
+            if meter.tokens and isinstance(update, dict):
+                update = {**update, "tokens_used": meter.tokens}
+            return update
+    else:
+        @functools.wraps(node)
+        def timed(state):
+            start = time.perf_counter()
+            event_bus.publish(state.get("session_id"), "node", node=name, phase="start")
+            try:
+                return node(state)
+            finally:
+                observe_node(name, time.perf_counter() - start)
+                event_bus.publish(state.get("session_id"), "node", node=name, phase="end", seconds=time.perf_counter() - start)
+    return timed
+
+async def request_completion(model, messages, **params):
+    start = time.perf_counter()
+    try:
+        response = await llm_client().chat.completions.create(model=model, messages=messages, **params)
+    except Exception as e:
+        LLM_ERRORS.labels(model, type(e).__name__).inc()
+        raise
+    finally:
+        LLM_LATENCY.labels(model).observe(time.perf_counter() - start)
+
+    charge_tokens(response.usage)
+    if response.usage:
+        LLM_TOKENS.labels(model, "prompt").inc(response.usage.prompt_tokens)
+        LLM_TOKENS.labels(model, "completion").inc(response.usage.completion_tokens)
+    return response.choices[0].message.content.strip()
+
+# 🌊 Streaming: stop reading once the answer is decided, forwarding tokens as they arrive
+def plan_is_decided(text):
+    return "goal complete" in text.lower() or text.lstrip().count("\n") >= PLANNER_BATCH_SIZE
+
+async def stream_completion(model, messages, on_token=None, **params):
+    start = time.perf_counter()
+    text = ""
+    stream = None
+    charged = False
+    try:
+        stream = await llm_client().chat.completions.create(
+            model=model, messages=messages, stream=True, stream_options={"include_usage": True}, **params
+        )
+        async for chunk in stream:
+            charge_tokens(chunk.usage)
+            charged = charged or bool(chunk.usage)
+            if chunk.usage:
+                LLM_TOKENS.labels(model, "prompt").inc(chunk.usage.prompt_tokens)
+                LLM_TOKENS.labels(model, "completion").inc(chunk.usage.completion_tokens)
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            if not text:
+                LLM_TTFT.labels(model).observe(time.perf_counter() - start)
+            text += chunk.choices[0].delta.content
+            if on_token:
+                on_token(chunk.choices[0].delta.content)
+            if plan_is_decided(text):
+                break
+    except Exception as e:
+        LLM_ERRORS.labels(model, type(e).__name__).inc()
+        raise
+    finally:
+        LLM_LATENCY.labels(model).observe(time.perf_counter() - start)
+        if stream is not None:
+            if not charged:
+                # Usage only arrives with the last chunk; a stream cut short still spent its prompt and what it read
+                charge_tokens(types.SimpleNamespace(
+                    prompt_tokens=sum(estimate_tokens(m["content"]) for m in messages),
+                    completion_tokens=estimate_tokens(text)
+                ))
+            await stream.close()
+    return "\n".join(text.strip().split("\n")[:PLANNER_BATCH_SIZE]).strip()
+
+# 🚦 Process-wide request scheduler: rate buckets, AIMD concurrency limit and jittered backoff
+LLM_REQUESTS_PER_MINUTE = float(os.getenv("LLM_REQUESTS_PER_MINUTE", "500"))
+LLM_TOKENS_PER_MINUTE = float(os.getenv("LLM_TOKENS_PER_MINUTE", "30000"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "64"))
+LLM_LATENCY_TARGET = float(os.getenv("LLM_LATENCY_TARGET", "10"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "5"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "30"))
+@functools.cache
+def retryable_errors():
+    from openai import APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+    return (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+
+LLM_QUEUE_WAIT = Histogram(
+    "agent_llm_queue_wait_seconds", "Time a request waited for a concurrency slot and rate budget",
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60)
+)
+LLM_CONCURRENCY_LIMIT = Gauge("agent_llm_concurrency_limit", "Current AIMD concurrency limit for OpenAI calls")
+LLM_IN_FLIGHT = Gauge("agent_llm_in_flight", "OpenAI calls currently in flight")
+LLM_RETRIES = Counter("agent_llm_retries_total", "OpenAI calls retried after a transient error", ["model", "error"])
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def reserve(self, amount):
+        # Take the budget now (possibly going negative) and report how long to wait for it
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= min(amount, self.capacity)
+        return max(0.0, -self.tokens / self.rate)
+
+class RequestScheduler:
+    def __init__(self, requests_per_minute, tokens_per_minute, max_concurrency, latency_target):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.latency_target = latency_target
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.waiters = []
+        self.last_decrease = 0.0
+        LLM_CONCURRENCY_LIMIT.set(self.limit)
+
+    async def acquire(self, tokens):
+        start = time.perf_counter()
+        while self.in_flight >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self.wake_waiters()  # cancelled just after being woken: pass the wake-up on
+                raise
+            finally:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+        self.in_flight += 1
+        LLM_IN_FLIGHT.set(self.in_flight)
+
+        delay = max(self.requests.reserve(1), self.tokens.reserve(tokens))
+        if delay:
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                # The caller's release() only covers the call itself: give the slot back here
+                self.in_flight -= 1
+                LLM_IN_FLIGHT.set(self.in_flight)
+                self.wake_waiters()
+                raise
+        LLM_QUEUE_WAIT.observe(time.perf_counter() - start)
+
+    def release(self, latency, throttled):
+        self.in_flight -= 1
+        LLM_IN_FLIGHT.set(self.in_flight)
+
+        now = time.monotonic()
+        if throttled or latency > self.latency_target:
+            # Multiplicative decrease, at most once per latency window so one burst of 429s halves once
+            if now - self.last_decrease > min(latency, self.latency_target):
+                self.limit = max(1.0, self.limit * (0.5 if throttled else 0.9))
+                self.last_decrease = now
+        else:
+            self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+        LLM_CONCURRENCY_LIMIT.set(self.limit)
+        self.wake_waiters()
+
+    def wake_waiters(self):
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self.waiters:
+            waiter = self.waiters.pop(0)
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+llm_scheduler = RequestScheduler(
+    LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE, LLM_MAX_CONCURRENCY, LLM_LATENCY_TARGET
+)
+
+def backoff_delay(attempt, error):
+    delay = min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.5)
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            delay = max(delay, float(retry_after))
+        except ValueError:
+            pass
+    return delay
+
+async def scheduled_completion(fetch, model, messages, **params):
+    tokens = sum(estimate_tokens(m["content"]) for m in messages) + params.get("max_tokens", 256)
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        await llm_scheduler.acquire(tokens)
+        start = time.perf_counter()
+        throttled = False
+        try:
+            return await fetch(model, messages, **params)
+        except retryable_errors() as e:
+            throttled = isinstance(e, retryable_errors()[0])
+            if attempt == LLM_MAX_RETRIES:
+                raise
+            LLM_RETRIES.labels(model, type(e).__name__).inc()
+            delay = backoff_delay(attempt, e)
+        finally:
+            llm_scheduler.release(time.perf_counter() - start, throttled)
+        await asyncio.sleep(delay)
+
+# 🗃️ Two-tier response cache: in-memory LRU in front of a SQLite file, opt-in per node
+LLM_CACHE_NODES = set(filter(None, os.getenv("LLM_CACHE_NODES", "estimate_difficulty,planner_node").split(",")))
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite")
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "86400"))
+LLM_CACHE_MEMORY_ITEMS = int(os.getenv("LLM_CACHE_MEMORY_ITEMS", "2048"))
+LLM_CACHE_DISK_ITEMS = int(os.getenv("LLM_CACHE_DISK_ITEMS", "100000"))
+LLM_CACHE = Counter("agent_llm_cache_total", "LLM response cache lookups", ["node", "tier", "result"])
+
+def normalize_text(text):
+    return " ".join(text.split()).casefold()
+
+def cache_key(model, messages, params):
+    payload = {
+        "model": model,
+        "messages": [{"role": m["role"], "content": normalize_text(m["content"])} for m in messages],
+        "params": params,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+class ResponseCache:
+    def __init__(self, path, memory_items, disk_items, ttl):
+        self.path = path
+        self.memory_items = memory_items
+        self.disk_items = disk_items
+        self.ttl = ttl
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.db = None
+        self.puts = 0
+
+    def connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, value TEXT, expires_at REAL, accessed_at REAL)"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)")
+        return self.db
+
+    # The memory tier is an unlocked OrderedDict: only the event loop may call get_memory/put_memory
+    def get_memory(self, key):
+        entry = self.memory.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at < time.time():
+            del self.memory[key]
+            return None
+        self.memory.move_to_end(key)
+        return value
+
+    def put_memory(self, key, value, expires_at):
+        self.memory[key] = (value, expires_at)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+    def get_disk(self, key):
+        now = time.time()
+        with self.lock:
+            db = self.connect()
+            row = db.execute("SELECT value, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                db.commit()
+                return None
+            db.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            db.commit()
+        return row  # (value, expires_at); the caller promotes it, the memory tier is only touched on the loop
+
+    def put_disk(self, key, value, expires_at):
+        now = time.time()
+        with self.lock:
+            db = self.connect()
+            db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, value, expires_at, now))
+            self.puts += 1
+            if self.puts % 100 == 0:
+                db.execute("DELETE FROM responses WHERE expires_at < ?", (now,))
+                db.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at DESC "
+                    "LIMIT -1 OFFSET ?)", (self.disk_items,)
+                )
+            db.commit()
+
+response_cache = ResponseCache(LLM_CACHE_PATH, LLM_CACHE_MEMORY_ITEMS, LLM_CACHE_DISK_ITEMS, LLM_CACHE_TTL)
+
+# 🤝 Singleflight: identical requests already in flight share one upstream call instead of repeating it
+LLM_COALESCE = os.getenv("LLM_COALESCE", "1") == "1"
+
+LLM_COALESCED = Counter("agent_llm_coalesced_total", "LLM calls answered by an identical request already in flight", ["node"])
+LLM_UPSTREAM = Counter("agent_llm_upstream_total", "LLM calls that went to the backend (after cache and coalescing)", ["node"])
+
+inflight = {}
+coalescing = {"coalesced": 0, "upstream": 0}
+
+def coalescing_ratio():
+    total = coalescing["coalesced"] + coalescing["upstream"]
+    return coalescing["coalesced"] / total if total else 0.0
+
+LLM_COALESCING_RATIO = Gauge("agent_llm_coalescing_ratio", "Share of LLM calls saved by joining an identical in-flight call")
+LLM_COALESCING_RATIO.set_function(coalescing_ratio)
+
+async def coalesced(key, node, call):
+    # Returns (answer, shared); a waiter whose leader was cancelled makes the call itself
+    while LLM_COALESCE and key in inflight:
+        pending = inflight[key]
+        await asyncio.wait([pending])
+        if not pending.cancelled():
+            LLM_COALESCED.labels(node).inc()
+            coalescing["coalesced"] += 1
+            return pending.result(), True
+
+    future = asyncio.get_running_loop().create_future()
+    if LLM_COALESCE:
+        inflight[key] = future
+    LLM_UPSTREAM.labels(node).inc()
+    coalescing["upstream"] += 1
+    try:
+        answer = await call()
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        future.exception()  # waiters re-raise it; don't warn when there are none
+        raise
+    else:
+        future.set_result(answer)
+        return answer, False
+    finally:
+        if inflight.get(key) is future:
+            del inflight[key]
+
+async def chat_completion(model, messages, node=None, stream=False, on_token=None, **params):
+    fetch = functools.partial(stream_completion, on_token=on_token) if stream else request_completion
+    key = cache_key(model, messages, params)
+    cached = node in LLM_CACHE_NODES
+    if cached:
+        answer = response_cache.get_memory(key)
+        tier = "memory"
+        if answer is None:
+            row = await asyncio.to_thread(response_cache.get_disk, key)
+            tier = "disk"
+            if row is not None:
+                answer = row[0]
+                response_cache.put_memory(key, *row)
+        if answer is not None:
+            LLM_CACHE.labels(node, tier, "hit").inc()
+            if on_token:
+                on_token(answer)
+            return answer
+        LLM_CACHE.labels(node, "all", "miss").inc()
+
+    answer, shared = await coalesced(
+        f"{key}:{'stream' if stream else 'full'}", node,
+        lambda: scheduled_completion(fetch, model, messages, **params)
+    )
+    if on_token and (shared or not stream):
+        on_token(answer)
+    if cached and not shared:
+        expires_at = time.time() + response_cache.ttl
+        response_cache.put_memory(key, answer, expires_at)
+        await asyncio.to_thread(response_cache.put_disk, key, answer, expires_at)
+    return answer
+
+# 🧾 Planner context: the last few subtasks verbatim, older ones folded into a rolling summary
+PLANNER_RECENT_SUBTASKS = int(os.getenv("PLANNER_RECENT_SUBTASKS", "5"))
+PLANNER_SUMMARY_BATCH = int(os.getenv("PLANNER_SUMMARY_BATCH", "3"))
+PLANNER_CONTEXT_TOKENS = int(os.getenv("PLANNER_CONTEXT_TOKENS", "600"))
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gpt-4o-mini")
+PLANNER_STREAM = os.getenv("PLANNER_STREAM", "0") == "1"
+PLANNER_MAX_FAILURES = int(os.getenv("PLANNER_MAX_FAILURES", "3"))
+PLANNER_BATCH_SIZE = int(os.getenv("PLANNER_BATCH_SIZE", "1"))
+
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+def clip_to_tokens(text, tokens):
+    limit = max(tokens, 1) * 4
+    return text if len(text) <= limit else "..." + text[-(limit - 3):]
+
+async def fold_progress(state):
+    goal = state.get("user_goal", "")
+    completed = state.get("subtask_progress", [])
+    summary = state.get("progress_summary", "")
+    summarized = state.get("summarized_count", 0)
 
-client = OpenAI()
+    fold_until = len(completed) - PLANNER_RECENT_SUBTASKS
+    if fold_until - summarized < PLANNER_SUMMARY_BATCH:
+        return summary, summarized
 
-def planner_node(state):
-    round_num = state.get("round", 1)
+    newly_done = completed[summarized:fold_until]
+    try:
+        summary = await chat_completion(
+            model=SUMMARY_MODEL,
+            messages=[
+                {"role": "system", "content": (
+                    f"You keep a running summary of the progress a user has made toward the goal: '{goal}'. "
+                    "Merge the newly completed subtasks into the existing summary. "
+                    "Reply with the updated summary only, in a few short sentences."
+                )},
+                {"role": "user", "content": f"Existing summary: {summary or 'None'}\nNewly completed: {newly_done}"}
+            ],
+            max_tokens=PLANNER_CONTEXT_TOKENS // 3,
+            node="planner_summary"
+        )
+    except Exception as e:
+        logger.warning("Error summarizing progress: %s", e)
+        summary = f"{summary} {'; '.join(newly_done)}".strip()
+    return summary, fold_until
+
+def planner_context(summary, recent):
+    # Summary gets a third of the budget, the verbatim subtasks share the rest
+    summary = clip_to_tokens(summary, PLANNER_CONTEXT_TOKENS // 3) if summary else ""
+    per_item = max((PLANNER_CONTEXT_TOKENS - estimate_tokens(summary)) // max(len(recent), 1), 8)
+    recent = [clip_to_tokens(item, per_item) for item in recent]
+
+    context = f"They have already completed: {recent}. "
+    if summary:
+        context = f"Summary of their earlier progress: {summary.rstrip('.')}. " + context
+    return context
+
+def ask_for_subtasks():
+    if PLANNER_BATCH_SIZE == 1:
+        return "If not, return ONE next subtask to help complete the goal."
+    return (
+        f"If not, return up to {PLANNER_BATCH_SIZE} next subtasks that do not depend on each other "
+        "and can be done in parallel, one per line, with no numbering or extra text."
+    )
+
+def split_subtasks(text):
+    lines = [re.sub(r"^\s*(?:[-*•]|\d+[.)])\s+", "", line).strip() for line in text.splitlines()]
+    return [line for line in lines if line][:PLANNER_BATCH_SIZE] or [text.strip()]
+
+async def draft_plan(state, on_token=None, excluded=()):
     goal = state.get("user_goal", "")
     completed = state.get("subtask_progress", [])
 
-    print(f"📅 Planner: Planning task for Day {round_num}...\n🧠 Goal: {goal}")
+    summary, summarized = await fold_progress(state)
+    context = planner_context(summary, completed[summarized:])
+    if excluded:
+        context += f"Do not suggest these again, they repeat work already done: {list(excluded)}. "
 
     try:
-        response = client.chat.completions.create(
+        task = await chat_completion(
             model="gpt-4o",
             messages=[
                 {"role": "system", "content": (
                     f"You are a helpful AI planner. The user's goal is: '{goal}'. "
-                    f"They have already completed: {completed}. "
+                    + context +
                     "If the goal is fully complete, respond ONLY with: 'GOAL COMPLETE'. "
-                    "If not, return ONE next subtask to help complete the goal."
+                    + ask_for_subtasks()
                 )},
                 {"role": "user", "content": "What should I do next?"}
             ],
-            max_tokens=50
+            max_tokens=50 * PLANNER_BATCH_SIZE,
+            node="planner_node",
+            stream=PLANNER_STREAM,
+            on_token=on_token
         )
-        task = response.choices[0].message.content.strip()
     except Exception as e:
-        task = f"Error generating task: {e}"
+        return summary, summarized, e
+    return summary, summarized, task
+
+# 🔮 Pipelined planning: draft tomorrow's plan while today's task runs, assuming it gets accepted
+PIPELINE_PLANNING = os.getenv("PIPELINE_PLANNING", "0") == "1"
+
+PLANNER_SPECULATION = Counter(
+    "agent_planner_speculation_total", "Speculative next-round plans by outcome", ["outcome"]
+)
+
+speculative_plans = {}
+speculation_debt = {}  # session -> tokens spent by discarded drafts, not yet charged
+speculation_outcomes = {"hit": 0, "miss": 0}
+
+def plan_inputs(state):
+    # Everything draft_plan reads; a speculative plan is only valid if these match exactly
+    return (
+        state.get("user_goal", ""),
+        tuple(state.get("subtask_progress", [])),
+        state.get("progress_summary", ""),
+        state.get("summarized_count", 0)
+    )
+
+def speculation_hit_ratio():
+    decided = speculation_outcomes["hit"] + speculation_outcomes["miss"]
+    return speculation_outcomes["hit"] / decided if decided else 0.0
+
+SPECULATION_HIT_RATIO = Gauge("agent_planner_speculation_hit_ratio", "Share of speculative plans that were used")
+SPECULATION_HIT_RATIO.set_function(speculation_hit_ratio)
+
+def speculate_next_plan(state, tasks):
+    session_id = state.get("session_id")
+    if not PIPELINE_PLANNING or not session_id or state.get("round", 1) >= state.get("max_rounds", MAX_ESTIMATED_DAYS):
+        return
+    assumed = merge_update(state, {"subtask_progress": tasks})
+    discard_speculation(session_id)
+    meter = TokenMeter()
+    speculative_plans[session_id] = (plan_inputs(assumed), asyncio.create_task(metered(meter, draft_plan(assumed))), meter)
+
+def bill_draft(session_id, draft, meter):
+    # A thrown-away draft still spent tokens, some of them possibly after it was cancelled:
+    # once it has settled, they go on the session's next plan
+    def bill(_):
+        if meter.tokens:
+            speculation_debt[session_id] = speculation_debt.get(session_id, 0) + meter.tokens
+    draft.add_done_callback(bill)
+
+def discard_speculation(session_id, bill=True):
+    pending = speculative_plans.pop(session_id, None)
+    if pending is None:
+        return
+    _, draft, meter = pending
+    if bill:
+        bill_draft(session_id, draft, meter)
+    if not draft.done():
+        draft.cancel()
+        PLANNER_SPECULATION.labels("cancelled").inc()
+
+async def take_speculation(state):
+    session_id = state.get("session_id")
+    current = token_meter.get() or TokenMeter()
+    current.tokens += speculation_debt.pop(session_id, 0)
+    pending = speculative_plans.pop(session_id, None)
+    if pending is None:
+        return None
+    inputs, draft, meter = pending
+    if inputs != plan_inputs(state):
+        bill_draft(session_id, draft, meter)
+        if not draft.done():
+            draft.cancel()
+        PLANNER_SPECULATION.labels("miss").inc()
+        speculation_outcomes["miss"] += 1
+        return None
+    PLANNER_SPECULATION.labels("hit").inc()
+    speculation_outcomes["hit"] += 1
+    # Charge only once the draft is finished, so calls it makes from here on count too
+    drafted = await draft
+    current.tokens += meter.tokens
+    return drafted
+
+# 🔁 Duplicate subtasks: a per-session MinHash index rejects planned subtasks the session has already done
+DEDUP_SUBTASKS = os.getenv("DEDUP_SUBTASKS", "1") == "1"
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.7"))  # estimated Jaccard similarity of word shingles
+DEDUP_MAX_REPLANS = int(os.getenv("DEDUP_MAX_REPLANS", "2"))
+MINHASH_PERMUTATIONS = int(os.getenv("MINHASH_PERMUTATIONS", "64"))
+MINHASH_PRIME = (1 << 61) - 1
+minhash_random = random.Random(0)
+MINHASH_PARAMS = [
+    (minhash_random.randrange(1, MINHASH_PRIME), minhash_random.randrange(MINHASH_PRIME)) for _ in range(MINHASH_PERMUTATIONS)
+]
+
+DEDUP_REJECTED = Counter("agent_dedup_rejected_total", "Planned subtasks rejected as near-duplicates of done work")
+DEDUP_ROUNDS_SAVED = Counter("agent_dedup_rounds_saved_total", "Days re-planned instead of repeating done work")
+DEDUP_TOKENS_SAVED = Counter(
+    "agent_dedup_tokens_saved_total", "Estimated planner prompt tokens rejected duplicates would have added"
+)
+
+def shingles(text):
+    words = re.findall(r"\w+", text.casefold())
+    return set(words) | {f"{a} {b}" for a, b in zip(words, words[1:])}
+
+def minhash(text):
+    hashes = [int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "big") for s in shingles(text)] or [0]
+    return tuple(min((a * h + b) % MINHASH_PRIME for h in hashes) for a, b in MINHASH_PARAMS)
+
+def similarity(left, right):
+    return sum(x == y for x, y in zip(left, right)) / len(left)
+
+class SubtaskIndex:
+    def __init__(self):
+        self.signatures = []
+
+    def sync(self, completed):
+        # The index follows subtask_progress, so a restarted session rebuilds it from persisted state
+        if len(self.signatures) > len(completed):
+            self.signatures = []
+        self.signatures.extend(minhash(task) for task in completed[len(self.signatures):])
+        return self
+
+    def screen(self, tasks):
+        # Returns (fresh, duplicates); subtasks in one batch can't repeat each other either
+        fresh, duplicates, seen = [], [], list(self.signatures)
+        for task in tasks:
+            signature = minhash(task)
+            if any(similarity(signature, other) >= DEDUP_THRESHOLD for other in seen):
+                duplicates.append(task)
+            else:
+                fresh.append(task)
+                seen.append(signature)
+        return fresh, duplicates
+
+subtask_indexes = {}
+
+def subtask_index(state):
+    session_id = state.get("session_id")
+    index = subtask_indexes.setdefault(session_id, SubtaskIndex()) if session_id else SubtaskIndex()
+    return index.sync(state.get("subtask_progress", []))
+
+async def replan_duplicates(state, task, on_token):
+    # Returns (task, tasks, rejected, replanned): drops repeated subtasks and re-plans while nothing new is left
+    index = subtask_index(state) if DEDUP_SUBTASKS else None
+    rejected = []
+    for attempt in range(DEDUP_MAX_REPLANS + 1):
+        if isinstance(task, Exception) or "goal complete" in task.lower():
+            return task, [], rejected, attempt > 0 and not isinstance(task, Exception)
+        planned = split_subtasks(task)
+        tasks, duplicates = index.screen(planned) if index else (planned, [])
+        if tasks or not duplicates:
+            return task, tasks, rejected + duplicates, attempt > 0
+        if attempt == DEDUP_MAX_REPLANS:
+            break
+        rejected += duplicates
+        logger.info("[%s] Rejected a plan that repeats done work: %s", state.get("session_id"), duplicates)
+        _, _, task = await draft_plan(state, on_token, excluded=rejected)
+    # Out of re-plans: run the repeat rather than stall the session
+    logger.warning("[%s] Planner keeps repeating done work: %s", state.get("session_id"), planned)
+    return task, planned, rejected, False
+
+def dedup_savings(state, rejected, replanned):
+    # A rejected repeat would have sat in the verbatim part of the next few planner prompts
+    prompts = max(min(state.get("max_rounds", 1) - state.get("round", 1), PLANNER_RECENT_SUBTASKS), 0)
+    tokens = sum(estimate_tokens(task) for task in rejected) * prompts
+    DEDUP_REJECTED.inc(len(rejected))
+    DEDUP_ROUNDS_SAVED.inc(int(replanned))
+    DEDUP_TOKENS_SAVED.inc(tokens)
+    return {
+        "duplicates_rejected": state.get("duplicates_rejected", 0) + len(rejected),
+        "rounds_saved": state.get("rounds_saved", 0) + int(replanned),
+        "tokens_saved": state.get("tokens_saved", 0) + tokens
+    }
 
-    logs = state.get("log", [])
-    logs.append(f"Planned task {round_num}: {task}")
+async def planner_node(state):
+    round_num = state.get("round", 1)
+    goal = state.get("user_goal", "")
 
-    if "goal complete" in task.lower():
-        return {**state, "role": "end", "log": logs}
+    logger.info("📅 Planner: planning task for Day %s of goal: %s", round_num, goal)
+
+    on_token = functools.partial(publish_token, state.get("session_id"))
+    drafted = await take_speculation(state)
+    if drafted is not None and not isinstance(drafted[2], Exception):
+        on_token(drafted[2])
+    else:
+        drafted = await draft_plan(state, on_token)
+    summary, summarized, task = drafted
+    task, tasks, rejected, replanned = await replan_duplicates(state, task, on_token)
+    dedup = dedup_savings(state, rejected, replanned) if rejected else {}
+
+    if isinstance(task, Exception):
+        # Never hand an error message to the executor: plan again, or give up after repeated failures
+        failures = state.get("planner_failures", 0) + 1
+        event_bus.publish(state.get("session_id"), "plan_failed", round=round_num, attempt=failures, error=str(task))
+        update = {
+            **log_update(state, f"Planning failed for Day {round_num} (attempt {failures}): {task}"),
+            "role": "planner",
+            "planner_failures": failures,
+            **dedup
+        }
+        if failures >= PLANNER_MAX_FAILURES:
+            update.update(role="end", end_reason="planner_failures")
+        return update
 
+    if "goal complete" in task.lower():
+        event_bus.publish(state.get("session_id"), "planned", round=round_num, tasks=[], goal_complete=True)
+        log = log_update(state, f"Planned task {round_num}: {task}")
+        return {
+            **log,
+            "role": "end",
+            "end_reason": "goal_complete",
+            "planner_failures": 0,
+            "progress_summary": summary,
+            "summarized_count": summarized,
+            **dedup
+        }
+
+    task = "; ".join(tasks)
+    event_bus.publish(state.get("session_id"), "planned", round=round_num, tasks=tasks, rejected=rejected)
+    speculate_next_plan({**state, "progress_summary": summary, "summarized_count": summarized}, tasks)
+    skipped = [f"Skipped repeated subtasks for Day {round_num}: {'; '.join(rejected)}"] if rejected else []
     return {
-        **state,
+        **log_update(state, *skipped, f"Planned task {round_num}: {task}"),
         "task": task,
+        "tasks": tasks,
         "role": "executor",
-        "log": logs
+        "planner_failures": 0,
+        "progress_summary": summary,
+        "summarized_count": summarized,
+        **dedup
     }
 
-def estimate_difficulty_node(state):
+async def estimate_days(goal):
+    answer = await chat_completion(
+        model="gpt-4o",
+        messages=[
+            {"role": "system", "content": (
+                "You are an AI task analyst. Given a user's goal, estimate the number of days needed to accomplish it "
+                "realistically with daily tasks. Respond ONLY with a number between 1 and 10."
+            )},
+            {"role": "user", "content": f"My goal is: {goal}"}
+        ],
+        max_tokens=10,
+        node="estimate_difficulty"
+    )
+    days = re.search(r"\d+", answer)
+    if days is None:
+        raise ValueError(f"no number in estimate {answer!r}")
+    # The estimate becomes the session's round cap: "0" or "2-3" must not end it early or run it for 23 days
+    return min(max(int(days.group()), 1), MAX_ESTIMATED_DAYS)
+
+async def estimate_difficulty_node(state):
     goal = state.get("user_goal", "")
-    print(f"Estimating difficulty for goal: {goal}")
+    logger.info("Estimating difficulty for goal: %s", goal)
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": (
-                    "You are an AI task analyst. Given a user's goal, estimate the number of days needed to accomplish it "
-                    "realistically with daily tasks. Respond ONLY with a number between 1 and 10."
-                )},
-                {"role": "user", "content": f"My goal is: {goal}"}
-            ],
-            max_tokens=10
-        )
-        estimated_days = int("".join(filter(str.isdigit, response.choices[0].message.content.strip())))
-        print(f"Estimated days: {estimated_days}")
+        estimated_days = await estimate_days(goal)
+        logger.info("Estimated days: %s", estimated_days)
     except Exception as e:
-        print(f"Error estimating difficulty: {e}")
+        logger.warning("Error estimating difficulty: %s", e)
         estimated_days = 3
 
     return {
-        **state,
         "max_rounds": estimated_days,
+        "difficulty_estimated": True,
         "role": "planner"
     }
 
-def executor_node(state):
+# 🧪 Executor sandbox: pre-forked worker processes with timeouts, memory caps and recycling
+EXECUTOR_WORKERS = int(os.getenv("EXECUTOR_WORKERS", str(os.cpu_count() or 2)))
+EXECUTOR_TIMEOUT = float(os.getenv("EXECUTOR_TIMEOUT", "5"))
+EXECUTOR_MAX_RSS_MB = int(os.getenv("EXECUTOR_MAX_RSS_MB", "256"))
+EXECUTOR_MAX_TASKS = int(os.getenv("EXECUTOR_MAX_TASKS", "500"))
+SAFE_BUILTINS = {
+    name: getattr(builtins, name) for name in (
+        "abs", "all", "any", "bool", "dict", "divmod", "enumerate", "float", "int", "len", "list",
+        "max", "min", "pow", "range", "reversed", "round", "set", "sorted", "str", "sum", "tuple", "zip"
+    )
+}
+
+# The builtins whitelist alone isn't a sandbox: ().__class__.__base__.__subclasses__() walks back to os.
+# Tasks may not touch underscore names or attributes, nor str.format (whose fields can read attributes)
+BLOCKED_ATTRIBUTES = {"format", "format_map"}
+
+def compile_task(task):
+    tree = ast.parse(task, mode="eval")
+    for node in ast.walk(tree):
+        name = node.id if isinstance(node, ast.Name) else node.attr if isinstance(node, ast.Attribute) else ""
+        if name.startswith("_") or (isinstance(node, ast.Attribute) and name in BLOCKED_ATTRIBUTES):
+            raise ValueError(f"'{name}' is not allowed in a task")
+    return compile(tree, "<task>", "eval")
+
+EXECUTOR_QUEUE_DEPTH = Gauge("agent_executor_queue_depth", "Tasks waiting for a free executor worker")
+EXECUTOR_BUSY = Gauge("agent_executor_busy_workers", "Executor workers currently running a task")
+EXECUTOR_TASK_SECONDS = Histogram("agent_executor_task_seconds", "Wall-clock time of sandboxed executor tasks")
+EXECUTOR_RECYCLED = Counter("agent_executor_recycled_total", "Executor workers replaced", ["reason"])
+
+def sandbox_worker(conn, max_rss_mb, max_tasks):
+    import resource
+
+    def memory():
+        # (address space, resident set) in bytes
+        with open("/proc/self/statm") as f:
+            size, resident = f.read().split()[:2]
+        return int(size) * page_size, int(resident) * page_size
+
+    # Cap address-space growth so a runaway expression fails inside the worker, not the pod;
+    # a forked worker starts out with the server's footprint, so both limits count growth from here
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    current, baseline_rss = memory()
+    limit = current + max_rss_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    # Nothing the server holds is the task's business: no API keys, no database or socket descriptors
+    os.environ.clear()
+    keep = conn.fileno()
+    max_fd = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    os.closerange(3, keep)
+    os.closerange(keep + 1, max_fd if max_fd != resource.RLIM_INFINITY else 65536)
+
+    for done in range(1, max_tasks + 1):
+        try:
+            task = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        try:
+            result = eval(compile_task(task), {"__builtins__": SAFE_BUILTINS}, {})
+            if not isinstance(result, (str, int, float, bool, type(None))):
+                result = repr(result)
+        except MemoryError:
+            result = "Error: memory limit exceeded"
+        except Exception as e:
+            result = f"Error: {e}"
+        grown_mb = (memory()[1] - baseline_rss) / (1024 * 1024)
+        recycle = "rss" if grown_mb > max_rss_mb else "max_tasks" if done == max_tasks else None
+        conn.send((result, recycle))
+        if recycle:
+            return
+
+class ExecutorPool:
+    def __init__(self, size, timeout, max_rss_mb, max_tasks):
+        self.size = size
+        self.timeout = timeout
+        self.max_rss_mb = max_rss_mb
+        self.max_tasks = max_tasks
+        self.context = multiprocessing.get_context("fork")
+        self.idle = None
+        self.workers = []
+        self.waiting = 0
+
+    def spawn(self):
+        conn, child_conn = self.context.Pipe()
+        process = self.context.Process(
+            target=sandbox_worker, args=(child_conn, self.max_rss_mb, self.max_tasks), daemon=True
+        )
+        process.start()
+        child_conn.close()
+        worker = (process, conn)
+        self.workers.append(worker)
+        return worker
+
+    def retire(self, worker, reason):
+        process, conn = worker
+        if process.is_alive():
+            process.kill()
+        process.join(timeout=1)
+        conn.close()
+        self.workers.remove(worker)
+        EXECUTOR_RECYCLED.labels(reason).inc()
+
+    def start(self):
+        if self.idle is None:
+            self.idle = asyncio.Queue()
+            for _ in range(self.size):
+                self.idle.put_nowait(self.spawn())
+
+    def has_capacity(self):
+        # Busy workers are fine; a backlog longer than the pool itself means new work would just queue
+        return self.idle is not None and bool(self.workers) and self.waiting < self.size
+
+    def close(self):
+        for process, conn in list(self.workers):
+            process.kill()
+            conn.close()
+        self.workers = []
+        self.idle = None
+
+    async def wait_for_reply(self, conn):
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        loop.add_reader(conn.fileno(), lambda: ready.done() or ready.set_result(None))
+        try:
+            await asyncio.wait_for(ready, self.timeout)
+        finally:
+            loop.remove_reader(conn.fileno())
+        return conn.recv()
+
+    async def run(self, task):
+        self.start()
+        EXECUTOR_QUEUE_DEPTH.inc()
+        self.waiting += 1
+        try:
+            worker = await self.idle.get()
+        finally:
+            EXECUTOR_QUEUE_DEPTH.dec()
+            self.waiting -= 1
+
+        EXECUTOR_BUSY.inc()
+        start = time.perf_counter()
+        recycle = None
+        try:
+            worker[1].send(task)
+            result, recycle = await self.wait_for_reply(worker[1])
+        except asyncio.TimeoutError:
+            result, recycle = f"Error: task timed out after {self.timeout}s", "timeout"
+        except (EOFError, OSError):
+            result, recycle = "Error: executor worker crashed", "crash"
+        except asyncio.CancelledError:
+            # The reply is still on its way down the pipe: replace the worker instead of reusing it
+            self.retire(worker, "cancelled")
+            self.idle.put_nowait(self.spawn())
+            raise
+        finally:
+            EXECUTOR_BUSY.dec()
+            EXECUTOR_TASK_SECONDS.observe(time.perf_counter() - start)
+
+        if recycle:
+            self.retire(worker, recycle)
+            worker = self.spawn()
+        self.idle.put_nowait(worker)
+        return result
+
+executor_pool = ExecutorPool(EXECUTOR_WORKERS, EXECUTOR_TIMEOUT, EXECUTOR_MAX_RSS_MB, EXECUTOR_MAX_TASKS)
+
+# 🔀 Each planned subtask runs in its own executor branch; the reviewer joins them into one day
+async def executor_node(state):
     task = state.get("task", "")
-    print(f"Executor: Executing task: {task}")
-    try:
-        result = eval(task)
-    except Exception as e:
-        result = f"Error: {e}"
-    logs = state.get("log", [])
-    logs.append(f"Executed: {task} -> {result}")
-    return {
-        **state,
-        "result": result,
-        "role": "reviewer",
-        "log": logs
-    }
+    logger.info("Executor: executing task: %s", task)
+    result = await executor_pool.run(task)
+    event_bus.publish(state.get("session_id"), "result", round=state.get("round", 1), task=task, result=str(result))
+    return {"results": [[task, result]], "role": "reviewer"}
+
+def dispatch_tasks(state):
+    from langgraph.types import Send
+
+    tasks = state.get("tasks") or [state.get("task", "")]
+    return [Send("executor_node", {**state, "task": task}) for task in tasks]
 
 def reviewer_node(state):
     round_num = state.get("round", 1)
-    logs = state.get("log", [])
-    logs.append(f"Reviewed result of Day {round_num}")
-    completed = state.get("subtask_progress", [])
-    completed.append(state.get("task", ""))
+    results = state.get("results") or []
+    executed = [f"Executed: {task} -> {result}" for task, result in results]
+    event_bus.publish(state.get("session_id"), "reviewed", round=round_num, completed=len(results))
     return {
-        **state,
+        **log_update(state, *executed, f"Reviewed result of Day {round_num}"),
         "round": round_num + 1,
         "role": "planner",
-        "subtask_progress": completed,
-        "log": logs
+        "result": results[0][1] if len(results) == 1 else [result for _, result in results],
+        "results": None,
+        "subtask_progress": [task for task, _ in results] or [state.get("task", "")]
     }
 
-def role_switch_node(state):
-    print(f"Switching role to: {state.get('role')}")
-    return state
+# ⛽ Budgets: sessions stop at max_rounds, their token budget or their deadline, whichever comes first
+SESSION_TOKEN_BUDGET = int(os.getenv("SESSION_TOKEN_BUDGET", "50000"))
+SESSION_DEADLINE_SECONDS = float(os.getenv("SESSION_DEADLINE_SECONDS", "1800"))
+
+SESSION_ENDS = Counter("agent_session_end_total", "Sessions that reached the end node, by reason", ["reason"])
+
+def exhausted_budget(state):
+    if state.get("round", 1) > state.get("max_rounds", MAX_ESTIMATED_DAYS):
+        return "max_rounds"
+    if SESSION_TOKEN_BUDGET and state.get("tokens_used", 0) >= SESSION_TOKEN_BUDGET:
+        return "token_budget"
+    if SESSION_DEADLINE_SECONDS and state.get("started_at") and time.time() - state["started_at"] > SESSION_DEADLINE_SECONDS:
+        return "deadline"
+    return None
 
 def route_by_role(state):
+    # Budgets are checked before any node that spends tokens; a dispatched day still gets executed and reviewed
+    if state.get("role") == "planner" and exhausted_budget(state):
+        return "end"
+    if state.get("role") == "executor":
+        return dispatch_tasks(state)
     return {
         "planner": "planner_node",
-        "executor": "executor_node",
         "reviewer": "reviewer_node"
     }.get(state.get("role", ""), "end")
 
+# ⏩ Restarted sessions skip straight to the node they were waiting on
+def resume_point(state):
+    if not state.get("user_goal"):
+        return "user_goal_node"
+    if not state.get("difficulty_estimated"):
+        return "estimate_difficulty"
+    return route_by_role(state)
+
 def end_node(state):
-    print("Finished")
-    print("Final log:", state.get("log", []))
+    reason = state.get("end_reason") if state.get("role") == "end" else exhausted_budget(state)
+    reason = reason or "goal_complete"
+    spilled = state.get("log_spilled", 0)
+    logger.info("Finished (%s)", reason)
+    event_bus.publish(state.get("session_id"), "end", reason=reason, round=state.get("round", 1))
+    logger.debug("Final log (entries %s-%s): %s", spilled, spilled + len(state.get("log", [])), state.get("log", []))
+    SESSION_ENDS.labels(reason).inc()
+    update = {"role": "end", "end_reason": reason}
+    if state.get("role") != "end":
+        update.update(log_update(state, f"Stopped on Day {state.get('round', 1)}: {reason.replace('_', ' ')} reached"))
+    return update
+
+# 🧠 Build LangGraph structure: every worker routes straight to the next role, one superstep per node
+GRAPH_SETUP_STEPS = 3  # user goal, difficulty estimate, end
+GRAPH_STEPS_PER_DAY = 3  # planner, executor, reviewer
+
+def build_graph(nodes=None, checkpointer=None, legacy=False):
+    from langgraph.graph import StateGraph
+
+    nodes = {
+        "user_goal_node": user_goal_node,
+        "estimate_difficulty": estimate_difficulty_node,
+        "planner_node": planner_node,
+        "executor_node": executor_node,
+        "reviewer_node": reviewer_node,
+        **(nodes or {})
+    }
+    builder = StateGraph(AgentState)
+    for name, node in nodes.items():
+        builder.add_node(name, timed_node(name, node))
+    builder.add_node("end", end_node)
+
+    builder.set_conditional_entry_point(resume_point)
+    builder.add_edge("user_goal_node", "estimate_difficulty")
+    builder.add_edge("estimate_difficulty", "planner_node")
+    if legacy:
+        # The old topology (every worker hops through a pass-through role_switch node), kept for --bench graph
+        builder.add_node("role_switch", lambda state: {})
+        for name in ("planner_node", "executor_node", "reviewer_node"):
+            builder.add_edge(name, "role_switch")
+        builder.add_conditional_edges("role_switch", route_by_role)
+    else:
+        builder.add_conditional_edges("planner_node", route_by_role)
+        builder.add_edge("executor_node", "reviewer_node")
+        builder.add_conditional_edges("reviewer_node", route_by_role)
+    return builder.compile(checkpointer=checkpointer)
+
+MAX_ESTIMATED_DAYS = 10
+
+def recursion_limit(state):
+    # Before the estimate runs, allow for the longest plan the estimator can return
+    days = state.get("max_rounds") if state.get("difficulty_estimated") else MAX_ESTIMATED_DAYS
+    return GRAPH_SETUP_STEPS + GRAPH_STEPS_PER_DAY * (max(days or MAX_ESTIMATED_DAYS, 1) + 2)
+
+# 💾 Checkpoints keyed by session id let a continued session resume at its pending node
+checkpointer = None
+graph = None
+graph_lock = threading.Lock()
+
+def agent_graph():
+    global checkpointer, graph
+    if graph is None:
+        with graph_lock:
+            if graph is None:
+                from langgraph.checkpoint.memory import MemorySaver
+
+                checkpointer = MemorySaver()
+                graph = build_graph(checkpointer=checkpointer)
+    return graph
+
+# 🔄 Agent memory persistence: a snapshot plus an append-only journal of per-step deltas
+JOURNAL_FSYNC_EVERY = int(os.getenv("JOURNAL_FSYNC_EVERY", "16"))
+JOURNAL_FSYNC_SECONDS = float(os.getenv("JOURNAL_FSYNC_SECONDS", "1.0"))
+JOURNAL_COMPACT_EVERY = int(os.getenv("JOURNAL_COMPACT_EVERY", "200"))
+APPEND_FIELDS = ("log", "subtask_progress")
+APPEND_OFFSETS = {"log": "log_spilled"}  # entries dropped from the front of a windowed list
+
+class StateJournal:
+    def __init__(self, path):
+        self.path = path
+        self.journal_path = os.path.splitext(path)[0] + ".journal"
+        self.seq = 0
+        self.saved = None
+        self.file = None
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        self.since_compact = 0
+
+    def resume(self, state, seq):
+        self.seq = seq
+        self.saved = self.remember(state)
+
+    def remember(self, state):
+        # Append-only fields are remembered by absolute length, so diffing never walks the history
+        return {
+            key: self.total(state, key) if key in APPEND_FIELDS and isinstance(value, list) else value
+            for key, value in state.items()
+        }
+
+    def total(self, state, key):
+        return len(state[key]) + state.get(APPEND_OFFSETS.get(key), 0)
+
+    def delta(self, state):
+        changes, appends = {}, {}
+        for key, value in state.items():
+            if key in APPEND_FIELDS and isinstance(value, list):
+                saved_total = self.saved.get(key)
+                grown = self.total(state, key) - saved_total if isinstance(saved_total, int) else -1
+                if 0 <= grown <= len(value):
+                    if grown:
+                        appends[key] = value[len(value) - grown:]
+                    continue
+            elif key in self.saved and self.saved[key] == value:
+                continue
+            changes[key] = value
+        removed = [key for key in self.saved if key not in state]
+        return {key: part for key, part in (("set", changes), ("append", appends), ("unset", removed)) if part}
+
+    def append(self, state):
+        if self.saved is None:
+            self.compact(state)
+            return
+
+        delta = self.delta(state)
+        if not delta:
+            return
+
+        if self.file is None:
+            self.file = open(self.journal_path, "a")
+        self.seq += 1
+        self.file.write(json.dumps({"seq": self.seq, **delta}, separators=(",", ":")) + "\n")
+        self.file.flush()
+        self.saved = self.remember(state)
+        self.unsynced += 1
+        self.since_compact += 1
+
+        if self.unsynced >= JOURNAL_FSYNC_EVERY or time.monotonic() - self.last_sync >= JOURNAL_FSYNC_SECONDS:
+            self.sync()
+        if self.since_compact >= JOURNAL_COMPACT_EVERY:
+            self.compact(state)
+
+    def sync(self):
+        if self.file is not None and self.unsynced:
+            os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def compact(self, state):
+        # Write the snapshot atomically, then start an empty journal after it
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"journal_seq": self.seq, "state": state}, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.journal_path, "w")
+        self.saved = self.remember(state)
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        self.since_compact = 0
+        logger.debug("Memory saved to %s", self.path)
+
+    def close(self):
+        self.sync()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+journals = {}
+
+def journal_for(path):
+    if path not in journals:
+        journals[path] = StateJournal(path)
+    return journals[path]
+
+def apply_delta(state, record):
+    offsets = {key: state.get(field, 0) for key, field in APPEND_OFFSETS.items()}
+    state.update(record.get("set", {}))
+    for key, items in record.get("append", {}).items():
+        combined = state.get(key, []) + items
+        if key in APPEND_OFFSETS:
+            combined = combined[state.get(APPEND_OFFSETS[key], 0) - offsets[key]:]
+        state[key] = combined
+    for key in record.get("unset", []):
+        state.pop(key, None)
     return state
 
-# 🧠 Build LangGraph structure
-builder = StateGraph(dict)
-builder.add_node("user_goal_node", user_goal_node)
-builder.add_node("estimate_difficulty", estimate_difficulty_node)
-builder.add_node("planner_node", planner_node)
-builder.add_node("executor_node", executor_node)
-builder.add_node("reviewer_node", reviewer_node)
-builder.add_node("role_switch", role_switch_node)
-builder.add_node("end", end_node)
-
-builder.set_entry_point("user_goal_node")
-builder.add_edge("user_goal_node", "estimate_difficulty")
-builder.add_edge("estimate_difficulty", "planner_node")
-builder.add_edge("planner_node", "role_switch")
-builder.add_edge("executor_node", "role_switch")
-builder.add_edge("reviewer_node", "role_switch")
-builder.add_conditional_edges("role_switch", route_by_role)
-
-graph = builder.compile()
-
-# 🔄 Agent memory persistence
 def save_state(state, path="agent_memory.json"):
-    with open(path, "w") as f:
-        json.dump(state, f, indent=2)
-    print(f"Memory saved to {path}")
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    journal_for(path).append(state)
+
+def fresh_state():
+    return {"role": "planner", "round": 1, "max_rounds": 3}
+
+def close_state(path="agent_memory.json"):
+    if path in journals:
+        journals.pop(path).close()
 
 def load_state(path="agent_memory.json"):
+    journal = journal_for(path)
+    state, seq = None, 0
     try:
         with open(path, "r") as f:
-            state = json.load(f)
-        print(f"Memory loaded from {path}")
-        return state
+            snapshot = json.load(f)
+        if "journal_seq" in snapshot and "state" in snapshot:
+            state, seq = snapshot["state"], snapshot["journal_seq"]
+        else:
+            state = snapshot  # memory written before the journal existed
     except FileNotFoundError:
-        print("No saved memory found, starting fresh.")
-        return {"role": "planner", "round": 1, "max_rounds": 3}
+        pass
 
-# 🧠 Run the agent
-state = load_state()
+    replayed = 0
+    try:
+        with open(journal.journal_path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break  # torn write at the tail of the journal
+                if record["seq"] <= seq:
+                    continue
+                state = apply_delta(state if state is not None else {}, record)
+                seq = record["seq"]
+                replayed += 1
+    except FileNotFoundError:
+        pass
 
-if state.get("role") == "end":
-    print("Agent has already completed its tasks. Nothing more to do.")
-else:
+    if state is None:
+        logger.info("No saved memory found, starting fresh.")
+        return fresh_state()
+
+    journal.resume(state, seq)
+    logger.info("Memory loaded from %s (+%s journal entries)", path, replayed)
+    return state
+
+# 🏪 State stores: per-session JSON journals (default) or one SQLite database shared by every session
+STATE_STORE = os.getenv("STATE_STORE", "journal")
+STATE_DB = os.getenv("STATE_DB", "agent_state.sqlite")
+# WAL needs shared memory between every process using the file: set DELETE when replicas share the databases
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+DEFAULT_SESSION = "default"
+SESSIONS_DIR = os.getenv("SESSIONS_DIR", "sessions")
+
+class JournalStateStore:
+    def __init__(self, sessions_dir, default_path="agent_memory.json"):
+        self.sessions_dir = sessions_dir
+        self.default_path = default_path
+
+    def path(self, session_id):
+        if session_id == DEFAULT_SESSION:
+            return self.default_path
+        return os.path.join(self.sessions_dir, f"{session_id}.json")
+
+    def save(self, session_id, state):
+        save_state(state, self.path(session_id))
+
+    def load(self, session_id):
+        return load_state(self.path(session_id))
+
+    def close(self, session_id):
+        close_state(self.path(session_id))
+
+    def warm(self):
+        os.makedirs(self.sessions_dir, exist_ok=True)
+        if not os.access(self.sessions_dir, os.W_OK):
+            raise PermissionError(f"{self.sessions_dir} is not writable")
+
+class SQLiteStateStore:
+    # One writer thread group-commits the latest state of every session that saved since the last commit
+    def __init__(self, path):
+        self.path = path
+        self.pending = {}
+        self.cond = threading.Condition()
+        self.committed = 0
+        self.writing = False
+        self.failure = None
+        self.writer = None
+        self.reader = None
+        self.read_lock = threading.Lock()
+
+    def connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, round INTEGER, role TEXT, "
+            "state TEXT, updated_at REAL)"
+        )
+        db.execute("CREATE INDEX IF NOT EXISTS sessions_by_round ON sessions (round)")
+        db.commit()
+        return db
+
+    def write_loop(self):
+        db = self.connect()
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                batch, self.pending = self.pending, {}
+                self.writing = True
+            failure = None
+            try:
+                db.executemany(
+                    "INSERT INTO sessions VALUES (?, ?, ?, ?, ?) ON CONFLICT(session_id) DO UPDATE SET "
+                    "round = excluded.round, role = excluded.role, state = excluded.state, "
+                    "updated_at = excluded.updated_at", list(batch.values())
+                )
+                db.commit()
+            except sqlite3.Error as e:
+                db.rollback()
+                failure = e
+            with self.cond:
+                self.committed += 1
+                self.writing = False
+                self.failure = (self.committed, failure) if failure else None
+                self.cond.notify_all()
+
+    def save(self, session_id, state):
+        row = (session_id, state.get("round", 1), state.get("role"), json.dumps(state, separators=(",", ":")), time.time())
+        with self.cond:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self.write_loop, daemon=True)
+                self.writer.start()
+            self.pending[session_id] = row
+            # A batch already being written does not contain this row: wait for the one after it
+            target = self.committed + (2 if self.writing else 1)
+            self.cond.notify_all()
+            while self.committed < target:
+                self.cond.wait()
+            if self.failure and self.failure[0] == target:
+                raise self.failure[1]
+
+    def load(self, session_id):
+        with self.read_lock:
+            if self.reader is None:
+                self.reader = self.connect()
+            row = self.reader.execute("SELECT state FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        if row is None:
+            logger.info("No saved memory found, starting fresh.")
+            return fresh_state()
+        logger.info("Memory loaded for session %s from %s", session_id, self.path)
+        return json.loads(row[0])
+
+    def close(self, session_id):
+        pass
+
+    def warm(self):
+        with self.read_lock:
+            if self.reader is None:
+                self.reader = self.connect()
+
+def make_state_store(kind=STATE_STORE):
+    if kind == "sqlite":
+        return SQLiteStateStore(STATE_DB)
+    return JournalStateStore(SESSIONS_DIR)
+
+state_store = make_state_store()
+
+# 🗄️ History index: every log entry and subtask keyed by (session, round) for paginated reads
+HISTORY_DB = os.getenv("HISTORY_DB", "agent_history.sqlite")
+
+class HistoryIndex:
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS log_entries (session_id TEXT, seq INTEGER, round INTEGER, entry TEXT, "
+                "PRIMARY KEY (session_id, seq)) WITHOUT ROWID"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS log_by_round ON log_entries (session_id, round, seq)")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS subtasks (session_id TEXT, seq INTEGER, round INTEGER, task TEXT, "
+                "PRIMARY KEY (session_id, seq)) WITHOUT ROWID"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS subtasks_by_round ON subtasks (session_id, round, seq)")
+        return self.db
+
+    def record_step(self, session_id, previous, state):
+        # Rows added by a step belong to the round that was running when the step started
+        round_num = previous.get("round", 1)
+        start, grown = log_total(previous), log_total(state) - log_total(previous)
+        window = state.get("log", [])
+        log_rows = [
+            (session_id, start + i, round_num, entry)
+            for i, entry in enumerate(window[len(window) - min(grown, len(window)):] if grown > 0 else [])
+        ]
+        done_before = len(previous.get("subtask_progress", []))
+        subtask_rows = [
+            (session_id, done_before + i, round_num, task)
+            for i, task in enumerate(state.get("subtask_progress", [])[done_before:])
+        ]
+        if not log_rows and not subtask_rows:
+            return
+        with self.lock:
+            db = self.connect()
+            db.executemany("INSERT OR IGNORE INTO log_entries VALUES (?, ?, ?, ?)", log_rows)
+            db.executemany("INSERT OR IGNORE INTO subtasks VALUES (?, ?, ?, ?)", subtask_rows)
+            db.commit()
+
+    def page(self, table, column, session_id, since_round, after, limit):
+        with self.lock:
+            rows = self.connect().execute(
+                f"SELECT seq, round, {column} FROM {table} WHERE session_id = ? AND round >= ? AND seq > ? "
+                "ORDER BY seq LIMIT ?", (session_id, since_round, after, limit)
+            ).fetchall()
+        return [{"seq": seq, "round": round_num, column: value} for seq, round_num, value in rows]
+
+    def log(self, session_id, since_round=1, after=-1, limit=100):
+        return self.page("log_entries", "entry", session_id, since_round, after, limit)
+
+    def subtasks(self, session_id, since_round=1, after=-1, limit=100):
+        return self.page("subtasks", "task", session_id, since_round, after, limit)
+
+    def has_session(self, session_id):
+        with self.lock:
+            return self.connect().execute(
+                "SELECT 1 FROM log_entries WHERE session_id = ? LIMIT 1", (session_id,)
+            ).fetchone() is not None
+
+history_index = HistoryIndex(HISTORY_DB)
+
+def persist_step(session_id, previous, state):
+    with SAVE_STATE_LATENCY.time():
+        state_store.save(session_id, state)
+    history_index.record_step(session_id, previous, state)
+
+# 🌡️ Warm-up: the server answers probes at once while the SDK, graph, stores and workers load in the background
+readiness = {"llm_client": False, "agent_graph": False, "state_store": False, "history_index": False, "executor_pool": False}
+warm_up_task = None
+warm_up_error = None
+
+WARM_UP_SECONDS = Gauge("agent_warm_up_seconds", "Time from warm-up start until the agent was ready")
+
+async def warm_up():
+    start = time.perf_counter()
+    await asyncio.to_thread(llm_client)
+    await asyncio.to_thread(retryable_errors)
+    readiness["llm_client"] = True
+    await asyncio.to_thread(agent_graph)
+    readiness["agent_graph"] = True
+    await asyncio.to_thread(state_store.warm)
+    readiness["state_store"] = True
+    await asyncio.to_thread(history_index.connect)
+    readiness["history_index"] = True
+    executor_pool.start()
+    readiness["executor_pool"] = True
+    WARM_UP_SECONDS.set(time.perf_counter() - start)
+    logger.info("Agent warmed up in %.2fs", time.perf_counter() - start)
+
+async def ensure_warm():
+    global warm_up_task, warm_up_error
+    if warm_up_task is None:
+        warm_up_task = asyncio.get_running_loop().create_task(warm_up())
+    if not warm_up_task.done():
+        await asyncio.shield(warm_up_task)
+    if warm_up_task.exception():
+        failed, warm_up_task = warm_up_task, None  # let the next caller try again
+        warm_up_error = f"{type(failed.exception()).__name__}: {failed.exception()}"
+        raise failed.exception()
+    warm_up_error = None
+
+# ⚖️ Session scheduler: SESSION_WORKERS slots, handed out one day at a time by weighted fair queuing over (tenant, priority)
+SESSION_WORKERS = int(os.getenv("SESSION_WORKERS", "64"))
+SESSION_ADMIT_LIMIT = int(os.getenv("SESSION_ADMIT_LIMIT", "5000"))
+SESSION_TENANT_LIMIT = int(os.getenv("SESSION_TENANT_LIMIT", "1000"))
+SESSION_RETRY_AFTER = int(os.getenv("SESSION_RETRY_AFTER", "5"))
+DEFAULT_TENANT = "default"
+DEFAULT_PRIORITY = "normal"
+
+def parse_weights(spec):
+    weights = {}
+    for item in filter(None, spec.split(",")):
+        name, _, weight = item.partition("=")
+        weights[name.strip()] = float(weight)
+    return weights
+
+PRIORITY_WEIGHTS = parse_weights(os.getenv("PRIORITY_WEIGHTS", "high=4,normal=2,low=1"))
+TENANT_WEIGHTS = parse_weights(os.getenv("TENANT_WEIGHTS", ""))
+
+SESSION_QUEUE_DEPTH = Gauge("agent_session_queue_depth", "Sessions waiting for a worker slot", ["priority"])
+SESSION_QUEUE_WAIT = Histogram(
+    "agent_session_queue_wait_seconds", "Time a session day waited for a worker slot", ["priority"],
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 120, 300)
+)
+SESSION_WORKERS_BUSY = Gauge("agent_session_workers_busy", "Worker slots currently running a session day")
+SESSIONS_ADMITTED = Gauge("agent_sessions_admitted", "Sessions admitted and not yet finished")
+SESSIONS_REJECTED = Counter("agent_sessions_rejected_total", "Goals turned away by admission control", ["reason"])
+
+class SessionScheduler:
+    def __init__(self, workers, admit_limit, tenant_limit):
+        self.workers = workers
+        self.admit_limit = admit_limit
+        self.tenant_limit = tenant_limit
+        self.busy = 0
+        self.waiting = 0
+        self.queue = []  # (finish tag, sequence, start tag, future)
+        self.finish = {}  # last finish tag per (tenant, priority) flow
+        self.virtual_time = 0.0
+        self.sequence = itertools.count()
+        self.admitted = {}  # tenant -> sessions queued or running
+
+    def weight(self, tenant, priority):
+        return TENANT_WEIGHTS.get(tenant, 1.0) * PRIORITY_WEIGHTS.get(priority, 1.0)
+
+    def admission_error(self, tenant, count, admitted=None):
+        # `admitted` overrides the local counts (tenant -> open sessions) when replicas share the intake
+        admitted = self.admitted if admitted is None else admitted
+        if sum(admitted.values()) + count > self.admit_limit:
+            return "saturated"
+        if self.tenant_limit and admitted.get(tenant, 0) + count > self.tenant_limit:
+            return "tenant_limit"
+        return None
+
+    def saturated(self, admitted=None):
+        admitted = self.admitted if admitted is None else admitted
+        return sum(admitted.values()) >= self.admit_limit
+
+    def admit(self, tenant):
+        self.admitted[tenant] = self.admitted.get(tenant, 0) + 1
+        SESSIONS_ADMITTED.inc()
+
+    def discharge(self, tenant):
+        self.admitted[tenant] -= 1
+        if not self.admitted[tenant]:
+            del self.admitted[tenant]
+        SESSIONS_ADMITTED.dec()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, tenant, priority):
+        await self.acquire(tenant, priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, tenant, priority):
+        # Every day costs its flow 1 / weight of virtual time; the smallest finish tag runs next
+        flow = (tenant, priority)
+        start = max(self.virtual_time, self.finish.get(flow, 0.0))
+        finish = self.finish[flow] = start + 1 / self.weight(tenant, priority)
+        if self.busy < self.workers and not self.waiting:
+            self.busy += 1
+            self.virtual_time = max(self.virtual_time, start)
+            SESSION_WORKERS_BUSY.set(self.busy)
+            SESSION_QUEUE_WAIT.labels(priority).observe(0)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.queue, (finish, next(self.sequence), start, future))
+        self.waiting += 1
+        SESSION_QUEUE_DEPTH.labels(priority).inc()
+        waited = time.perf_counter()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()  # cancelled just after being handed a slot: pass it on
+            raise
+        finally:
+            self.waiting -= 1
+            SESSION_QUEUE_DEPTH.labels(priority).dec()
+        SESSION_QUEUE_WAIT.labels(priority).observe(time.perf_counter() - waited)
+
+    def release(self):
+        # The slot goes straight to the next live waiter; it only frees up when nobody is queued
+        while self.queue:
+            _, _, start, future = heapq.heappop(self.queue)
+            if not future.done():
+                self.virtual_time = max(self.virtual_time, start)
+                future.set_result(None)
+                return
+        self.busy -= 1
+        SESSION_WORKERS_BUSY.set(self.busy)
+        if not self.busy:
+            # Idle: flows that are behind virtual time carry no credit, forget them
+            self.finish = {flow: tag for flow, tag in self.finish.items() if tag > self.virtual_time}
+
+session_scheduler = SessionScheduler(SESSION_WORKERS, SESSION_ADMIT_LIMIT, SESSION_TENANT_LIMIT)
+
+# 🗂️ Sessions: every goal runs as its own graph execution, one scheduled day at a time
+sessions = {}
+
+async def run_session(session_id):
+    session = sessions[session_id]
+    state = session["state"]
+
+    if state.get("role") == "end":
+        logger.info("[%s] Agent has already completed its tasks. Nothing more to do.", session_id)
+        session["status"] = "done"
+        event_bus.publish(session_id, "status", status="done")
+        if session.get("leased"):
+            await asyncio.to_thread(lease_store.release, POD_NAME, session_id, True)
+        return
+
+    ACTIVE_SESSIONS.inc()
+    config = {"recursion_limit": recursion_limit(state), "configurable": {"thread_id": session_id}}
     try:
+        await ensure_warm()
+        graph = agent_graph()
         while state.get("role") != "end":
-            state = graph.invoke(state, config={"recursion_limit": 25})
-            save_state(state)
+            # A pending checkpoint means this session was interrupted in-process: continue it
+            checkpoint = await graph.aget_state(config)
+            if checkpoint.values and not checkpoint.next:
+                await checkpointer.adelete_thread(session_id)  # finished thread: start over from the saved state
+            graph_input = None if checkpoint.next else state
+
+            # Persist after every step so a crash loses at most the step in flight; the graph pauses
+            # after each review so the session queues again for its next day behind everyone else's
+            previous = state
+            async with session_scheduler.slot(session["tenant"], session["priority"]):
+                if session["status"] == "queued":
+                    session["status"] = "running"
+                    event_bus.publish(session_id, "status", status="running")
+                async for state in graph.astream(
+                    graph_input, config=config, stream_mode="values", interrupt_after=["reviewer_node"]
+                ):
+                    session["state"] = state
+                    await asyncio.to_thread(persist_step, session_id, previous, state)
+                    previous = state
+        session["status"] = "done"
+        await checkpointer.adelete_thread(session_id)
     except langgraph.errors.GraphRecursionError:
-        print("Graph hit recursion limit. Stopping safely.")
+        logger.warning("[%s] Graph hit recursion limit. Stopping safely.", session_id)
+        session["status"] = "stopped"
+    except asyncio.CancelledError:
+        session["status"] = "cancelled"
+        raise
+    except Exception as e:
+        logger.error("[%s] Session failed: %s", session_id, e)
+        session["status"] = "failed"
+        session["error"] = str(e)
+    finally:
+        event_bus.publish(session_id, "status", status=session["status"], error=session.get("error"))
+        ACTIVE_SESSIONS.dec()
+        SESSION_ROUNDS.observe(session["state"].get("round", 1))
+        await asyncio.to_thread(state_store.close, session_id)
+        discard_speculation(session_id, bill=False)
+        speculation_debt.pop(session_id, None)
+        subtask_indexes.pop(session_id, None)
+        if session.get("leased") and session["status"] != "cancelled":
+            await asyncio.to_thread(lease_store.release, POD_NAME, session_id, True)
+            if lease_wakeup is not None:
+                lease_wakeup.set()
+
+def start_session(goal, session_id=None, leased=False, tenant=DEFAULT_TENANT, priority=DEFAULT_PRIORITY):
+    session_id = session_id or uuid.uuid4().hex[:12]
+    goal = " ".join(goal.split()) if goal else goal
+    if session_id in sessions and sessions[session_id]["status"] in ("queued", "running"):
+        return session_id
+
+    state = state_store.load(session_id)
+    state["session_id"] = session_id
+    if goal and goal != state.get("user_goal") and state.get("role") != "end":
+        state["user_goal"] = goal
+        state.pop("difficulty_estimated", None)
+        state.pop("started_at", None)
+    state.setdefault("started_at", time.time())
+
+    sessions[session_id] = {
+        "state": state, "status": "queued", "leased": leased, "tenant": tenant, "priority": priority
+    }
+    session_scheduler.admit(tenant)
+    task = sessions[session_id]["task"] = asyncio.create_task(run_session(session_id))
+    task.add_done_callback(lambda _: session_scheduler.discharge(tenant))
+    return session_id
+
+def session_log_bytes(state):
+    return sum(len(entry) for entry in state.get("log", []))
+
+def session_summary(session_id, session=None):
+    session = session or sessions[session_id]
+    state = session["state"]
+    return {
+        "session_id": session_id,
+        "status": session["status"],
+        "user_goal": state.get("user_goal"),
+        "round": state.get("round", 1),
+        "max_rounds": state.get("max_rounds"),
+        "role": state.get("role"),
+        "error": session.get("error"),
+        "owner": session.get("owner") or (POD_NAME if session.get("leased") else None),
+        "tenant": session.get("tenant"),
+        "priority": session.get("priority"),
+        "end_reason": state.get("end_reason"),
+        "tokens_used": state.get("tokens_used", 0),
+        "rounds_saved": state.get("rounds_saved", 0),
+        "tokens_saved": state.get("tokens_saved", 0),
+        "log_total": log_total(state),
+        "log_in_memory": len(state.get("log", [])),
+        "log_memory_bytes": session_log_bytes(state),
+    }
+
+# 📏 Benchmarks
+def benchmark_state_store(session_counts=(1000, 10000), rounds=3, workers=32):
+    import io
+    import tempfile
+    import contextlib
+    from concurrent.futures import ThreadPoolExecutor
+
+    print(f"{'store':<8} {'sessions':>8} {'writes':>7} {'write s':>8} {'writes/s':>9} {'load s':>7} {'disk MB':>8}")
+    for count in session_counts:
+        for kind in ("journal", "sqlite"):
+            with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()):
+                if kind == "journal":
+                    store = JournalStateStore(os.path.join(tmp, "sessions"), os.path.join(tmp, "agent_memory.json"))
+                else:
+                    store = SQLiteStateStore(os.path.join(tmp, "agent_state.sqlite"))
+                states = {
+                    f"bench-{i}": {**fresh_state(), "session_id": f"bench-{i}", "user_goal": f"Goal {i}", "log": []}
+                    for i in range(count)
+                }
+
+                def play_round(session_id, round_num):
+                    states[session_id] = merge_update(states[session_id], {
+                        "round": round_num + 1,
+                        "task": f"Subtask {round_num}",
+                        "log": [f"Planned task {round_num}", f"Executed task {round_num}", f"Reviewed Day {round_num}"],
+                        "subtask_progress": [f"Subtask {round_num}"],
+                    })
+                    store.save(session_id, states[session_id])
+
+                with ThreadPoolExecutor(workers) as pool:
+                    start = time.perf_counter()
+                    for round_num in range(1, rounds + 1):
+                        list(pool.map(functools.partial(play_round, round_num=round_num), states))
+                    write_seconds = time.perf_counter() - start
+                    for session_id in states:
+                        store.close(session_id)
+
+                    start = time.perf_counter()
+                    list(pool.map(store.load, states))
+                    load_seconds = time.perf_counter() - start
+
+                disk = sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(tmp) for name in names)
+                journals.clear()
+            writes = count * rounds
+            print(
+                f"{kind:<8} {count:>8} {writes:>7} {write_seconds:>8.2f} {writes / write_seconds:>9.0f} "
+                f"{load_seconds:>7.2f} {disk / 1e6:>8.1f}"
+            )
+
+def benchmark_graph(days=8, sessions_per_run=50):
+    import io
+    import contextlib
+
+    async def plan(state):
+        round_num = state.get("round", 1)
+        if round_num > days:
+            return {"role": "end"}
+        return {**log_update(state, f"Planned task {round_num}"), "task": f"Subtask {round_num}", "role": "executor"}
+
+    async def execute(state):
+        return {"results": [[state.get("task", ""), "ok"]], "role": "reviewer"}
+
+    stubs = {
+        "estimate_difficulty": lambda state: {"max_rounds": days, "difficulty_estimated": True, "role": "planner"},
+        "planner_node": plan,
+        "executor_node": execute,
+    }
+
+    async def run(legacy):
+        from langgraph.checkpoint.memory import MemorySaver
+
+        bench_graph = build_graph(stubs, MemorySaver(), legacy=legacy)
+        steps = 0
+        start = time.perf_counter()
+        for i in range(sessions_per_run):
+            config = {"recursion_limit": 1000, "configurable": {"thread_id": f"bench-{i}"}}
+            state = {**fresh_state(), "user_goal": f"Goal {i}", "log": []}
+            async for _ in bench_graph.astream(state, config, stream_mode="updates"):
+                steps += 1
+        return steps / sessions_per_run, time.perf_counter() - start
+
+    print(f"{'topology':<10} {'steps/session':>13} {'steps/day':>9} {'ms/day':>7} {'days @ limit 25':>15}")
+    for legacy in (True, False):
+        with contextlib.redirect_stdout(io.StringIO()):
+            steps, elapsed = asyncio.run(run(legacy))
+        per_day = (steps - GRAPH_SETUP_STEPS) / days
+        print(
+            f"{'legacy' if legacy else 'direct':<10} {steps:>13.0f} {per_day:>9.1f} "
+            f"{elapsed * 1000 / (sessions_per_run * days):>7.2f} {int((25 - GRAPH_SETUP_STEPS) // per_day):>15}"
+        )
 
-from fastapi import FastAPI
-from fastapi.responses import JSONResponse
+def benchmark_suite(session_counts=(50, 200), persistence_rounds=(10, 50, 200)):
+    import io
+    import gc
+    import tempfile
+    import contextlib
+    import tracemalloc
+    global client, llm_scheduler, state_store, history_index, response_cache, node_samples
+
+    # Offline by default, and without rate limits: the suite measures the agent, not the OpenAI quota
+    if LLM_BACKEND == "openai" and not isinstance(client, OfflineLLM):
+        client = FakeLLM(FAKE_LLM_LATENCY, FAKE_LLM_ERROR_RATE, FAKE_LLM_SEED)
+    llm_scheduler = RequestScheduler(1e9, 1e12, LLM_MAX_CONCURRENCY, LLM_LATENCY_TARGET)
+
+    async def run_sessions(count, label):
+        with contextlib.redirect_stdout(io.StringIO()):
+            started = [start_session(f"Benchmark goal {label} {i}") for i in range(count)]
+            await asyncio.gather(*(sessions[session_id]["task"] for session_id in started))
+        return started
+
+    async def throughput():
+        executor_pool.start()
+        print(f"{'sessions':>8} {'seconds':>8} {'sessions/s':>10} {'rounds/s':>9} {'failed':>6}")
+        for count in session_counts:
+            start = time.perf_counter()
+            started = await run_sessions(count, count)
+            elapsed = time.perf_counter() - start
+            rounds = sum(sessions[session_id]["state"].get("round", 1) - 1 for session_id in started)
+            failed = sum(sessions[session_id]["status"] != "done" for session_id in started)
+            print(f"{count:>8} {elapsed:>8.2f} {count / elapsed:>10.1f} {rounds / elapsed:>9.1f} {failed:>6}")
+
+        print(f"\n{'node':<20} {'calls':>7} {'p50 ms':>8} {'p99 ms':>8}")
+        for name, samples in sorted(node_samples.items()):
+            print(f"{name:<20} {len(samples):>7} {percentile(samples, 50) * 1000:>8.1f} {percentile(samples, 99) * 1000:>8.1f}")
+
+        sessions.clear()
+        gc.collect()
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        await run_sessions(session_counts[0], "memory")
+        gc.collect()
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        count = session_counts[0]
+        print(
+            f"\nmemory per session: {(retained - baseline) / count / 1024:.1f} KiB retained, "
+            f"{(peak - baseline) / count / 1024:.1f} KiB peak while running"
+        )
+        executor_pool.close()
+
+    def persistence_cost():
+        session_id = "bench-persistence"
+        state = {**fresh_state(), "session_id": session_id, "user_goal": "Persistence benchmark", "log": []}
+        window = []
+        print(f"\n{'rounds':>6} {'persist ms':>10} {'state KiB':>9}")
+        for round_num in range(1, max(persistence_rounds) + 1):
+            previous = state
+            state = merge_update(state, {
+                "round": round_num + 1,
+                "task": f"Subtask {round_num}",
+                **log_update(state, f"Planned task {round_num}", f"Executed task {round_num}", f"Reviewed Day {round_num}"),
+                "subtask_progress": [f"Subtask {round_num}"],
+            })
+            start = time.perf_counter()
+            persist_step(session_id, previous, state)
+            window.append(time.perf_counter() - start)
+            if round_num in persistence_rounds:
+                print(f"{round_num:>6} {sum(window) / len(window) * 1000:>10.2f} {len(json.dumps(state)) / 1024:>9.1f}")
+                window = []
+        state_store.close(session_id)
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            state_store = make_state_store()
+            history_index = HistoryIndex(HISTORY_DB)
+            response_cache = ResponseCache(LLM_CACHE_PATH, LLM_CACHE_MEMORY_ITEMS, LLM_CACHE_DISK_ITEMS, LLM_CACHE_TTL)
+            node_samples = {}
+            print(f"backend: {type(llm_client()).__name__}, store: {type(state_store).__name__}")
+            asyncio.run(throughput())
+            persistence_cost()
+        finally:
+            os.chdir(cwd)
+
+def benchmark_coldstart(runs=5, timeout=60):
+    import sys
+    import tempfile
+    import subprocess
+    import urllib.request
+
+    def wait_for(url, deadline):
+        while time.perf_counter() < deadline:
+            try:
+                with urllib.request.urlopen(url, timeout=1) as response:
+                    if response.status == 200:
+                        return True
+            except OSError:
+                pass
+            time.sleep(0.005)
+        return False
+
+    print(f"{'run':>3} {'/health ms':>10} {'/ready ms':>9}")
+    health_times, ready_times = [], []
+    for run in range(1, runs + 1):
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+        env = {**os.environ, "PORT": str(port), "LLM_BACKEND": os.getenv("LLM_BACKEND", "fake")}
+        env.pop("USER_GOAL", None)
+        with tempfile.TemporaryDirectory() as tmp:
+            start = time.perf_counter()
+            process = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__)], cwd=tmp, env=env,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+            try:
+                deadline = start + timeout
+                healthy = wait_for(f"http://127.0.0.1:{port}/health", deadline)
+                health_seconds = time.perf_counter() - start
+                ready = healthy and wait_for(f"http://127.0.0.1:{port}/ready", deadline)
+                ready_seconds = time.perf_counter() - start
+            finally:
+                process.terminate()
+                process.wait(timeout=10)
+        if not ready:
+            print(f"{run:>3} {'timeout' if not healthy else f'{health_seconds * 1000:.0f}':>10} {'timeout':>9}")
+            continue
+        health_times.append(health_seconds)
+        ready_times.append(ready_seconds)
+        print(f"{run:>3} {health_seconds * 1000:>10.0f} {ready_seconds * 1000:>9.0f}")
+    if ready_times:
+        print(f"{'p50':>3} {percentile(health_times, 50) * 1000:>10.0f} {percentile(ready_times, 50) * 1000:>9.0f}")
+
+# 🤝 Leases: replicas share sessions through a lease table; expired leases are picked up from persisted state
+LEASE_DB = os.getenv("LEASE_DB")
+LEASE_TTL = float(os.getenv("LEASE_TTL", "30"))
+LEASE_HEARTBEAT = float(os.getenv("LEASE_HEARTBEAT", "10"))
+LEASE_CAPACITY = int(os.getenv("LEASE_CAPACITY", "200"))
+POD_NAME = os.getenv("POD_NAME") or socket.gethostname()
+
+LEASES_OWNED = Gauge("agent_leases_owned", "Sessions this replica currently holds a lease for")
+LEASES_CLAIMED = Counter("agent_leases_claimed_total", "Session leases claimed by this replica", ["kind"])
+LEASES_LOST = Counter("agent_leases_lost_total", "Session leases this replica lost to another replica")
+
+class LeaseStore:
+    # SQLite file locks stand in for a shared coordination service (point LEASE_DB at a shared volume)
+    def __init__(self, path, ttl, weight):
+        self.path = path
+        self.ttl = ttl
+        self.weight = weight
+        self.db = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            self.db.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+            self.db.create_function("flow_weight", 2, lambda tenant, priority: self.weight(tenant, priority), deterministic=True)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS leases (session_id TEXT PRIMARY KEY, goal TEXT, owner TEXT, "
+                "expires_at REAL, done INTEGER DEFAULT 0, created_at REAL)"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS leases_open ON leases (done, expires_at)")
+            for column in ("tenant TEXT", "priority TEXT"):
+                try:
+                    self.db.execute(f"ALTER TABLE leases ADD COLUMN {column}")
+                except sqlite3.OperationalError:
+                    pass  # lease table already has it
+        return self.db
+
+    def submit(self, session_id, goal, tenant, priority):
+        with self.lock:
+            self.connect().execute(
+                "INSERT INTO leases (session_id, goal, owner, expires_at, done, created_at, tenant, priority) "
+                "VALUES (?, ?, NULL, 0, 0, ?, ?, ?) ON CONFLICT(session_id) DO UPDATE SET done = 0, goal = excluded.goal, "
+                "tenant = excluded.tenant, priority = excluded.priority WHERE done = 1",
+                (session_id, goal, time.time(), tenant, priority)
+            )
+
+    def claim(self, owner, limit):
+        now = time.time()
+        with self.lock:
+            db = self.connect()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                # Fair claims: the n-th oldest open session of each (tenant, priority) flow, running ones included,
+                # goes in at n / weight, so a tenant that queued thousands of goals first can't take every slot
+                rows = db.execute(
+                    "SELECT session_id, goal, owner, tenant, priority FROM ("
+                    "SELECT *, ROW_NUMBER() OVER (PARTITION BY tenant, priority ORDER BY created_at) AS position "
+                    "FROM leases WHERE done = 0) WHERE owner IS NULL OR expires_at < ? "
+                    "ORDER BY position / flow_weight(tenant, priority), created_at LIMIT ?", (now, limit)
+                ).fetchall()
+                db.executemany(
+                    "UPDATE leases SET owner = ?, expires_at = ? WHERE session_id = ?",
+                    [(owner, now + self.ttl, row[0]) for row in rows]
+                )
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+        return rows
+
+    def heartbeat(self, owner):
+        with self.lock:
+            db = self.connect()
+            db.execute(
+                "UPDATE leases SET expires_at = ? WHERE owner = ? AND done = 0", (time.time() + self.ttl, owner)
+            )
+            return {row[0] for row in db.execute("SELECT session_id FROM leases WHERE owner = ? AND done = 0", (owner,))}
+
+    def lookup(self, session_id=None):
+        # (session_id, goal, owner, expires_at, done, tenant, priority) rows, for one session or all of them
+        query = "SELECT session_id, goal, owner, expires_at, done, tenant, priority FROM leases"
+        with self.lock:
+            if session_id is None:
+                return self.connect().execute(query + " ORDER BY created_at").fetchall()
+            return self.connect().execute(query + " WHERE session_id = ?", (session_id,)).fetchall()
+
+    def open_sessions(self):
+        # tenant -> sessions submitted to any replica and not finished yet
+        with self.lock:
+            return dict(self.connect().execute(
+                "SELECT COALESCE(tenant, ?), COUNT(*) FROM leases WHERE done = 0 GROUP BY 1", (DEFAULT_TENANT,)
+            ).fetchall())
+
+    def release(self, owner, session_id, done):
+        with self.lock:
+            self.connect().execute(
+                "UPDATE leases SET owner = NULL, expires_at = 0, done = ? WHERE session_id = ? AND owner = ?",
+                (int(done), session_id, owner)
+            )
+
+lease_store = LeaseStore(LEASE_DB, LEASE_TTL, session_scheduler.weight) if LEASE_DB else None
+lease_wakeup = None
+
+def remote_session(row, load=True):
+    # A session this replica doesn't run: status and owner come from its lease, state from the shared store
+    session_id, goal, owner, expires_at, done, tenant, priority = row
+    status = "done" if done else "running" if owner and expires_at > time.time() else "queued"
+    state = {"user_goal": goal}
+    if load:
+        state = state_store.load(session_id)
+        state_store.close(session_id)
+        state["user_goal"] = state.get("user_goal") or goal  # not started yet: nothing saved but the goal
+    return {
+        "state": state, "status": status, "owner": owner if status == "running" else None,
+        "tenant": tenant or DEFAULT_TENANT, "priority": priority or DEFAULT_PRIORITY
+    }
+
+def find_session(session_id):
+    if session_id in sessions:
+        return sessions[session_id]
+    rows = lease_store.lookup(session_id) if lease_store else []
+    return remote_session(rows[0]) if rows else None
+
+def submit_session(goal, session_id=None, tenant=DEFAULT_TENANT, priority=DEFAULT_PRIORITY):
+    if lease_store is None:
+        return start_session(goal, session_id, tenant=tenant, priority=priority)
+    session_id = session_id or uuid.uuid4().hex[:12]
+    lease_store.submit(session_id, " ".join(goal.split()), tenant, priority)
+    if lease_wakeup is not None:
+        lease_wakeup.set()
+    return session_id
+
+async def lease_loop():
+    global lease_wakeup
+    lease_wakeup = asyncio.Event()
+    while True:
+        try:
+            owned = await asyncio.to_thread(lease_store.heartbeat, POD_NAME)
+            for session_id, session in sessions.items():
+                # Someone else holds this lease now (ours expired): stop working on it
+                if session.get("leased") and session["status"] in ("queued", "running") and session_id not in owned:
+                    session["task"].cancel()
+                    LEASES_LOST.inc()
+
+            free = LEASE_CAPACITY - len(owned)
+            if free > 0:
+                claimed = await asyncio.to_thread(lease_store.claim, POD_NAME, free)
+                for session_id, goal, previous_owner, tenant, priority in claimed:
+                    LEASES_CLAIMED.labels("takeover" if previous_owner else "new").inc()
+                    start_session(
+                        goal, session_id, leased=True, tenant=tenant or DEFAULT_TENANT, priority=priority or DEFAULT_PRIORITY
+                    )
+            LEASES_OWNED.set(sum(1 for s in sessions.values() if s.get("leased") and s["status"] in ("queued", "running")))
+        except Exception as e:
+            logger.warning("Lease loop error: %s", e)
+
+        try:
+            await asyncio.wait_for(lease_wakeup.wait(), LEASE_HEARTBEAT)
+        except asyncio.TimeoutError:
+            pass
+        lease_wakeup.clear()
+
+async def release_leases():
+    for session_id, session in sessions.items():
+        if session.get("leased") and session["status"] in ("queued", "running"):
+            await asyncio.to_thread(lease_store.release, POD_NAME, session_id, False)
+
+# 📦 Bulk ingestion: estimate (and optionally plan) a file of goals with bounded concurrency
+def read_goals(path):
+    if path.endswith(".csv"):
+        with open(path, newline="") as f:
+            return [row for row in csv.DictReader(f) if row.get("goal")]
+
+    # Like blank CSV rows, lines without a usable goal are skipped (with a warning) rather than failing the batch
+    records = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                logger.warning("Skipping %s line %s: invalid JSON (%s)", path, number, e)
+                continue
+            record = record if isinstance(record, dict) else {"goal": record}
+            if not isinstance(record.get("goal"), str) or not record["goal"].strip():
+                logger.warning("Skipping %s line %s: no goal", path, number)
+                continue
+            records.append(record)
+    return records
+
+def write_results(path, results):
+    if path.endswith(".csv"):
+        fields = list(dict.fromkeys(key for result in results for key in result))
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(results)
+    else:
+        with open(path, "w") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))]
+
+async def run_batch(path, out_path, concurrency=32, plan=False):
+    records = read_goals(path)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def process(record):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                # Not the graph node: a failed estimate must show up as an error, not as the 3-day fallback
+                goal = " ".join(record["goal"].split())
+                state = {"user_goal": goal, "round": 1, "log": [], "subtask_progress": []}
+                state.update(max_rounds=await estimate_days(goal), difficulty_estimated=True, role="planner")
+                result = {**record, "max_rounds": state["max_rounds"]}
+                if plan:
+                    state = merge_update(state, await planner_node(state))
+                    if state.get("planner_failures"):
+                        result["error"] = state["log"][-1]
+                    else:
+                        result["first_task"] = state.get("task") or "GOAL COMPLETE"
+            except Exception as e:
+                # One bad goal is recorded in its own row instead of losing the whole run
+                result = {**record, "error": f"{type(e).__name__}: {e}"}
+            latencies.append(time.perf_counter() - start)
+            return result
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(process(record) for record in records))
+    elapsed = time.perf_counter() - start
+    write_results(out_path, results)
+
+    failed = sum(1 for result in results if "error" in result)
+    print(f"Processed {len(results)} goals ({failed} failed) in {elapsed:.1f}s -> {out_path}")
+    print(f"Throughput: {len(results) / elapsed if elapsed else 0:.1f} goals/sec")
+    print(f"Latency p50: {percentile(latencies, 50):.2f}s  p99: {percentile(latencies, 99):.2f}s")
+    return results
+
+from contextlib import asynccontextmanager
+from typing import List, Optional
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 import uvicorn
 import threading
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+  warm_up_started = asyncio.create_task(ensure_warm())
+  warm_up_started.add_done_callback(lambda task: task.cancelled() or task.exception())  # failures show up on /ready
+  # 🎯 Keep the single-goal deployment working: USER_GOAL becomes the default session
+  if os.getenv("USER_GOAL"):
+    submit_session(os.getenv("USER_GOAL"), DEFAULT_SESSION)
+  lease_task = asyncio.create_task(lease_loop()) if lease_store else None
+  yield
+  if lease_task:
+    lease_task.cancel()
+    await release_leases()
+  for session in sessions.values():
+    session["task"].cancel()
+  executor_pool.close()
+
+app = FastAPI(lifespan=lifespan)
+
+class GoalRequest(BaseModel):
+  goals: List[str]
+  session_ids: Optional[List[str]] = None
+  tenant: str = DEFAULT_TENANT
+  priority: str = DEFAULT_PRIORITY
 
 @app.get("/health")
 def health_check():
@@ -300,23 +2742,175 @@ def health_check():
 
 @app.get("/ready")
 def ready_check():
-  return JSONResponse(content={"status": "ready"}, status_code=200)
+  checks = {
+    **readiness,
+    "executor_capacity": executor_pool.has_capacity(),
+    "session_capacity": not session_scheduler.saturated(lease_store.open_sessions() if lease_store else None),
+  }
+  if all(checks.values()):
+    return JSONResponse(content={"status": "ready", "checks": checks}, status_code=200)
+  if warm_up_error:
+    status = "failed"
+  elif not all(readiness.values()):
+    status = "warming up"
+  else:
+    status = "busy" if checks["session_capacity"] else "saturated"
+  return JSONResponse(content={"status": status, "checks": checks, "error": warm_up_error}, status_code=503)
+
+@app.get("/metrics")
+def metrics():
+  return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.post("/sessions")
+async def create_sessions(request: GoalRequest):
+  session_ids = request.session_ids or [None] * len(request.goals)
+  if len(session_ids) != len(request.goals):
+    raise HTTPException(status_code=400, detail="session_ids must match goals")
+  if request.priority not in PRIORITY_WEIGHTS:
+    raise HTTPException(status_code=400, detail=f"priority must be one of {sorted(PRIORITY_WEIGHTS)}")
+  # Admission control: refuse the whole request rather than half-start it
+  # With leases the intake is shared, so admission counts every replica's open sessions
+  admitted = await asyncio.to_thread(lease_store.open_sessions) if lease_store else None
+  reason = session_scheduler.admission_error(request.tenant, len(request.goals), admitted)
+  if reason:
+    SESSIONS_REJECTED.labels(reason).inc(len(request.goals))
+    return JSONResponse(
+      content={"detail": "Too many sessions in flight, retry later", "reason": reason},
+      status_code=429, headers={"Retry-After": str(SESSION_RETRY_AFTER)}
+    )
+  started = [
+    submit_session(goal, session_id, request.tenant, request.priority)
+    for goal, session_id in zip(request.goals, session_ids)
+  ]
+  return JSONResponse(content={"session_ids": started}, status_code=202)
+
+@app.get("/sessions")
+def list_sessions():
+  summaries = [session_summary(session_id) for session_id in sessions]
+  if lease_store is not None:
+    # Sessions submitted here but run (or still waiting) elsewhere, listed from the lease table alone
+    rows = lease_store.lookup()
+    summaries += [session_summary(row[0], remote_session(row, load=False)) for row in rows if row[0] not in sessions]
+  return {"sessions": summaries}
+
+@app.get("/sessions/{session_id}")
+def get_session(session_id: str):
+  session = find_session(session_id)
+  if session is None:
+    raise HTTPException(status_code=404, detail="Unknown session")
+  return {**session_summary(session_id, session), "log": session["state"].get("log", [])}
+
+def require_local(session_id):
+  # Live events only exist on the replica running the session: point the client at it
+  if session_id in sessions:
+    return
+  session = find_session(session_id)
+  if session is None:
+    raise HTTPException(status_code=404, detail="Unknown session")
+  raise HTTPException(status_code=409, detail={
+    "message": "Session is handled by another replica", "status": session["status"], "owner": session["owner"]
+  })
+
+def require_history(session_id):
+  if session_id not in sessions and not history_index.has_session(session_id):
+    raise HTTPException(status_code=404, detail="Unknown session")
+
+@app.get("/sessions/{session_id}/log")
+async def get_session_log(session_id: str, since_round: int = 1, after: int = -1, limit: int = 100):
+  await asyncio.to_thread(require_history, session_id)
+  entries = await asyncio.to_thread(history_index.log, session_id, since_round, after, min(max(limit, 1), 1000))
+  return {"entries": entries, "next": entries[-1]["seq"] if entries else after}
+
+@app.get("/sessions/{session_id}/subtasks")
+async def get_session_subtasks(session_id: str, since_round: int = 1, after: int = -1, limit: int = 100):
+  await asyncio.to_thread(require_history, session_id)
+  subtasks = await asyncio.to_thread(history_index.subtasks, session_id, since_round, after, min(max(limit, 1), 1000))
+  return {"subtasks": subtasks, "next": subtasks[-1]["seq"] if subtasks else after}
+
+def follow_session(session_id, queue, only=None):
+  async def events():
+    try:
+      status = sessions[session_id]["status"]
+      yield {"type": "status", "session_id": session_id, "status": status, "round": sessions[session_id]["state"].get("round", 1)}
+      while status not in TERMINAL_STATUSES:
+        event = await queue.get()
+        if only is None or event["type"] in only:
+          yield event
+        if event["type"] == "status":
+          status = event["status"]
+    finally:
+      event_bus.unsubscribe(session_id, queue)
+  return events()
+
+@app.get("/sessions/{session_id}/events")
+async def stream_session_events(session_id: str, types: Optional[str] = None):
+  await asyncio.to_thread(require_local, session_id)
+  only = set(types.split(",")) if types else None
+  queue = event_bus.subscribe(session_id)
+
+  async def events():
+    async for event in follow_session(session_id, queue, only):
+      yield f"id: {event.get('seq', 0)}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+  return StreamingResponse(events(), media_type="text/event-stream")
+
+# The planner-token stream predates the event bus; it is now just a filtered view of it
+@app.get("/sessions/{session_id}/plan-stream")
+async def stream_plan_tokens(session_id: str):
+  await asyncio.to_thread(require_local, session_id)
+  queue = event_bus.subscribe(session_id)
+
+  async def events():
+    async for event in follow_session(session_id, queue, {"token"}):
+      if event["type"] == "token":
+        yield f"data: {json.dumps({'token': event['text']})}\n\n"
+
+  return StreamingResponse(events(), media_type="text/event-stream")
 
 def run_server():
-  uvicorn.run(app, host="0.0.0.0", port=8000)
-
-server_thread = threading.Thread(target = run_server)
-server_thread.start()
+  uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", "8000")))
+
+if __name__ == "__main__":
+  import argparse
+
+  parser = argparse.ArgumentParser(description="LangGraph agent server")
+  parser.add_argument("--batch", help="JSONL or CSV file of goals to estimate instead of serving")
+  parser.add_argument("--out", help="where to write batch results (defaults next to the input)")
+  parser.add_argument("--concurrency", type=int, default=32, help="goals processed at the same time")
+  parser.add_argument("--plan", action="store_true", help="also run the first planner round for each goal")
+  parser.add_argument("--bench", choices=["store", "graph", "suite", "coldstart"], help="run a benchmark instead of serving")
+  args, _ = parser.parse_known_args()
+
+  if args.bench == "store":
+    benchmark_state_store()
+  elif args.bench == "graph":
+    benchmark_graph()
+  elif args.bench == "suite":
+    benchmark_suite()
+  elif args.bench == "coldstart":
+    benchmark_coldstart()
+  elif args.batch:
+    root, ext = os.path.splitext(args.batch)
+    out_path = args.out or f"{root}.results{ext if ext == '.csv' else '.jsonl'}"
+    asyncio.run(run_batch(args.batch, out_path, args.concurrency, args.plan))
+  else:
+    # Serve right away; the agent warms up inside the server's event loop
+    try:
+      asyncio.get_running_loop()
+      threading.Thread(target=run_server, daemon=True).start()  # notebooks already run a loop on this thread
+    except RuntimeError:
+      run_server()
 
 # ✅ Save requirements.txt with all needed packages
 with open("requirements.txt", "w") as f:
     f.write("openai>=1.0.0\n")               # OpenAI API access (GPT-4o, etc.)
-    f.write("langgraph>=0.0.35\n")           # LangGraph for agent structure
+    f.write("langgraph>=0.3.0\n")            # LangGraph for agent structure + checkpointers
     f.write("python-dotenv>=1.0.0\n")        # For reading API keys from .env
     f.write("fastapi>=0.110.0\n")            # Web server for health/ready endpoints
     f.write("uvicorn[standard]>=0.29.0\n")   # ASGI server to run FastAPI
     f.write("pydantic>=2.0\n")               # Optional: used internally by FastAPI
     f.write("requests>=2.28.0\n")            # Optional: useful for health checks or external calls
+    f.write("prometheus-client>=0.20.0\n")   # /metrics endpoint scraped by Prometheus
 
 # ✅ Display the file content
 !cat requirements.txt
@@ -445,11 +3039,36 @@ spec:
       labels:
         app: langgraph-agent
     spec:
+      # The replicas coordinate through SQLite files on one volume, which is only safe on a single node:
+      # keep every replica on the same node as the first one
+      affinity:
+        podAffinity:
+          requiredDuringSchedulingIgnoredDuringExecution:
+            - labelSelector:
+                matchLabels:
+                  app: langgraph-agent
+              topologyKey: kubernetes.io/hostname
       containers:
         - name: langgraph-agent
           image: aaravmehra/langgraph-agent-app:latest
           ports:
             - containerPort: 8000
+          startupProbe:
+            httpGet:
+              path: /health
+              port: 8000
+            periodSeconds: 1
+            failureThreshold: 30
+          livenessProbe:
+            httpGet:
+              path: /health
+              port: 8000
+            periodSeconds: 10
+          readinessProbe:
+            httpGet:
+              path: /ready
+              port: 8000
+            periodSeconds: 2
           env:
             - name: OPENAI_API_KEY
               valueFrom:
@@ -458,6 +3077,27 @@ spec:
                   key: api-key
             - name: USER_GOAL
               value: "Learn LangGraph"
+            - name: POD_NAME
+              valueFrom:
+                fieldRef:
+                  fieldPath: metadata.name
+            - name: STATE_STORE
+              value: "sqlite"
+            - name: STATE_DB
+              value: "/data/agent_state.sqlite"
+            - name: HISTORY_DB
+              value: "/data/agent_history.sqlite"
+            - name: LEASE_DB
+              value: "/data/leases.sqlite"
+            - name: SQLITE_JOURNAL_MODE
+              value: "DELETE"
+          volumeMounts:
+            - name: agent-data
+              mountPath: /data
+      volumes:
+        - name: agent-data
+          persistentVolumeClaim:
+            claimName: langgraph-agent-data
 """
 
 with open("deployment.yaml", "w") as f:
@@ -483,10 +3123,28 @@ spec:
 with open("service.yaml", "w") as f:
     f.write(service)
 
+# ✅ Write pvc.yaml (the volume deployment.yaml keeps its SQLite databases on)
+pvc = """
+apiVersion: v1
+kind: PersistentVolumeClaim
+metadata:
+  name: langgraph-agent-data
+spec:
+  accessModes:
+    - ReadWriteOnce
+  resources:
+    requests:
+      storage: 1Gi
+"""
+
+with open("pvc.yaml", "w") as f:
+    f.write(pvc)
+
 # ✅ Download both files for use on your local machine
 from google.colab import files
 files.download("deployment.yaml")
 files.download("service.yaml")
+files.download("pvc.yaml")
 
 from google.colab import files
 files.download("deployment.yaml")
@@ -530,188 +3188,2597 @@ with open("Dockerfile", "w") as f:
 from google.colab import files
 files.download("Dockerfile")
 
-code = '''
+code = r'''
 import os
+import csv
+import ast
 import json
-from openai import OpenAI
-import langgraph
-from langgraph.graph import StateGraph
-
-# ✅ User input is now pulled from environment variable
+import re
+import time
+import uuid
+import types
+import math
+import random
+import heapq
+import itertools
+import contextlib
+import socket
+import asyncio
+import builtins
+import hashlib
+import logging
+import operator
+import multiprocessing
+import sqlite3
+import functools
+import threading
+from collections import OrderedDict
+from typing import Annotated, Any, TypedDict
+from contextvars import ContextVar
+import langgraph  # the OpenAI SDK and the graph modules are imported lazily, see warm_up()
+from prometheus_client import Counter, Gauge, Histogram
+
+# 📝 Progress messages go through logging, so a busy server only writes what LOG_LEVEL asks for
+LOG_LEVEL = os.getenv("LOG_LEVEL", "WARNING").upper()
+logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger("agent")
+
+# 🪵 Log ring buffer: state keeps the last LOG_WINDOW entries, the full history lives in the history index
+LOG_WINDOW = int(os.getenv("LOG_WINDOW", "50"))
+
+def append_log(left, right):
+    return (left + right)[-LOG_WINDOW:]
+
+def log_update(state, *entries):
+    overflow = len(state.get("log", [])) + len(entries) - LOG_WINDOW
+    update = {"log": list(entries)}
+    if overflow > 0:
+        update["log_spilled"] = state.get("log_spilled", 0) + overflow
+    return update
+
+def last_value(left, right):
+    return right
+
+def collect_results(left, right):
+    # Parallel executors append their results; the reviewer resets the list by writing None
+    return [] if right is None else (left or []) + right
+
+def log_total(state):
+    return state.get("log_spilled", 0) + len(state.get("log", []))
+
+# 🧩 Typed agent state: nodes return only the keys they change, append-only lists use reducers
+class AgentState(TypedDict, total=False):
+    session_id: str
+    user_goal: str
+    role: Annotated[str, last_value]
+    round: int
+    max_rounds: int
+    difficulty_estimated: bool
+    task: str
+    tasks: list
+    result: Any
+    results: Annotated[list, collect_results]
+    planner_failures: int
+    progress_summary: str
+    summarized_count: int
+    log_spilled: int
+    log: Annotated[list, append_log]
+    subtask_progress: Annotated[list, operator.add]
+    tokens_used: Annotated[int, operator.add]
+    started_at: float
+    end_reason: str
+    duplicates_rejected: int
+    rounds_saved: int
+    tokens_saved: int
+
+REDUCERS = {
+    "log": append_log,
+    "subtask_progress": operator.add,
+    "results": collect_results,
+    "tokens_used": operator.add
+}
+REDUCER_DEFAULTS = {"tokens_used": 0}
+
+def merge_update(state, update):
+    # Apply a node's return value the way the graph's reducers would
+    merged = {**state, **update}
+    for key, reducer in REDUCERS.items():
+        if key in update:
+            merged[key] = reducer(state.get(key, REDUCER_DEFAULTS.get(key, [])), update[key])
+    return merged
+
+# ✅ User input comes from the session, falling back to the environment variable
 def user_goal_node(state):
-    goal = os.getenv("USER_GOAL", "Default Goal")
-    print(f"User Goal Provided: {goal}")
-    return {**state, "user_goal": goal, "role": "planner"}
+    goal = " ".join((state.get("user_goal") or os.getenv("USER_GOAL", "Default Goal")).split())
+    logger.info("User goal provided: %s", goal)
+    return {"user_goal": goal, "role": "planner"}
+
+# 🔌 LLM backend: OpenAI (optionally recording every response), a deterministic offline fake, or a replay
+LLM_BACKEND = os.getenv("LLM_BACKEND", "openai")
+LLM_RECORD_PATH = os.getenv("LLM_RECORD_PATH")
+LLM_REPLAY_PATH = os.getenv("LLM_REPLAY_PATH", "llm_recording.jsonl")
+LLM_REPLAY_LATENCY_SCALE = float(os.getenv("LLM_REPLAY_LATENCY_SCALE", "1.0"))
+FAKE_LLM_LATENCY = os.getenv("FAKE_LLM_LATENCY", "lognormal:0.8:0.5")  # fixed:s | uniform:lo:hi | lognormal:median:sigma
+FAKE_LLM_ERROR_RATE = float(os.getenv("FAKE_LLM_ERROR_RATE", "0"))
+FAKE_LLM_ERRORS = os.getenv("FAKE_LLM_ERRORS", "RateLimitError,InternalServerError,APITimeoutError").split(",")
+FAKE_LLM_SEED = int(os.getenv("FAKE_LLM_SEED", "0"))
+FAKE_LLM_REPEAT_RATE = float(os.getenv("FAKE_LLM_REPEAT_RATE", "0"))  # share of plans that repeat the last subtask
+
+def completion_response(content, usage):
+    message = types.SimpleNamespace(content=content)
+    return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)], usage=usage)
+
+class OfflineStream:
+    def __init__(self, content, usage, latency):
+        self.words = content.split(" ")
+        self.usage = usage
+        self.latency = latency
+        self.sent = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        # First token after ~30% of the latency, the rest spread evenly; usage arrives in a final chunk
+        if self.sent > len(self.words):
+            raise StopAsyncIteration
+        share = 0.3 if self.sent == 0 else 0.7 / max(len(self.words), 1)
+        await asyncio.sleep(self.latency * share)
+        self.sent += 1
+        if self.sent > len(self.words):
+            return types.SimpleNamespace(choices=[], usage=self.usage)
+        text = self.words[self.sent - 1] + (" " if self.sent < len(self.words) else "")
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(delta=types.SimpleNamespace(content=text))], usage=None)
+
+    async def close(self):
+        self.sent = len(self.words) + 1
+
+class OfflineLLM:
+    # Speaks just enough of the AsyncOpenAI surface for request_completion and stream_completion
+    def __init__(self):
+        self.chat = types.SimpleNamespace(completions=self)
+
+    async def create(self, model, messages, stream=False, stream_options=None, **params):
+        content, usage, latency = await self.reply(model, messages, params)
+        if usage is None:
+            usage = types.SimpleNamespace(
+                prompt_tokens=sum(estimate_tokens(m["content"]) for m in messages),
+                completion_tokens=estimate_tokens(content)
+            )
+        if stream:
+            return OfflineStream(content, usage, latency)
+        await asyncio.sleep(latency)
+        return completion_response(content, usage)
+
+class FakeLLM(OfflineLLM):
+    # Answers from the prompt alone: a goal always takes the same number of days and subtasks are cheap expressions
+    def __init__(self, latency, error_rate, seed):
+        super().__init__()
+        kind, *args = latency.split(":")
+        self.latency = (kind, [float(arg) for arg in args])
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+
+    def sample_latency(self):
+        kind, args = self.latency
+        if kind == "uniform":
+            return self.random.uniform(*args)
+        if kind == "lognormal":
+            median, sigma = args
+            return self.random.lognormvariate(math.log(median), sigma)
+        return args[0]
+
+    def inject_error(self):
+        import httpx
+        from openai import APITimeoutError, InternalServerError, RateLimitError
+        request = httpx.Request("POST", "https://fake-llm.local/v1/chat/completions")
+        name = self.random.choice(FAKE_LLM_ERRORS)
+        if name == "APITimeoutError":
+            return APITimeoutError(request=request)
+        status = 429 if name == "RateLimitError" else 500
+        error = RateLimitError if status == 429 else InternalServerError
+        return error("injected by FakeLLM", response=httpx.Response(status, request=request), body=None)
+
+    @staticmethod
+    def goal_days(goal):
+        return 2 + int(hashlib.sha256(normalize_text(goal).encode()).hexdigest(), 16) % 4
+
+    @staticmethod
+    def parse_list(text):
+        try:
+            return ast.literal_eval(text)
+        except (ValueError, SyntaxError):
+            return []
+
+    def answer(self, messages):
+        system, user = messages[0]["content"], messages[-1]["content"]
+        if "task analyst" in system:
+            return str(self.goal_days(user.removeprefix("My goal is: ")))
+        if "running summary" in system:
+            done = re.search(r"Completed (\d+) subtasks", user)
+            newly = re.search(r"Newly completed: (\[.*\])", user, re.S)
+            count = (int(done.group(1)) if done else 0) + len(self.parse_list(newly.group(1)) if newly else [])
+            return f"Completed {count} subtasks so far."
+        if "AI planner" in system:
+            goal = re.search(r"The user's goal is: '(.*?)'\. ", system, re.S)
+            summarized = re.search(r"Completed (\d+) subtasks", system)
+            recent = re.search(r"They have already completed: (\[.*?\])\. ", system, re.S)
+            done = (int(summarized.group(1)) if summarized else 0) + len(self.parse_list(recent.group(1)) if recent else [])
+            remaining = self.goal_days(goal.group(1) if goal else "") - done
+            if remaining <= 0:
+                return "GOAL COMPLETE"
+            if recent and "Do not suggest" not in system and self.random.random() < FAKE_LLM_REPEAT_RATE:
+                repeated = self.parse_list(recent.group(1))
+                if repeated:
+                    return f"{repeated[-1].capitalize()}."
+            batch = re.search(r"return up to (\d+) next subtasks", system)
+            count = min(int(batch.group(1)) if batch else 1, remaining)
+            return "\n".join(f"sum(range({(done + i + 1) * 1000}))" for i in range(count))
+        return "OK"
+
+    async def reply(self, model, messages, params):
+        latency = self.sample_latency()
+        if self.random.random() < self.error_rate:
+            await asyncio.sleep(latency)
+            raise self.inject_error()
+        return self.answer(messages), None, latency
+
+class ReplayLLM(OfflineLLM):
+    def __init__(self, path, latency_scale):
+        super().__init__()
+        self.latency_scale = latency_scale
+        self.recorded = {}
+        with open(path) as f:
+            for line in f:
+                entry = json.loads(line)
+                self.recorded.setdefault(entry["key"], []).append(entry)
+        self.served = {}
+
+    async def reply(self, model, messages, params):
+        key = cache_key(model, messages, params)
+        entries = self.recorded.get(key)
+        if not entries:
+            raise LookupError(f"No recorded {model} response for this request")
+        # Identical requests get their recorded answers in order, then the last one again
+        index = self.served.get(key, 0)
+        self.served[key] = index + 1
+        entry = entries[min(index, len(entries) - 1)]
+        return entry["content"], types.SimpleNamespace(**entry["usage"]), entry["latency"] * self.latency_scale
+
+class RecordingLLM:
+    # Wraps the real client; streamed requests are fetched whole so the recording holds complete answers
+    def __init__(self, inner, path):
+        self.inner = inner
+        self.path = path
+        self.lock = threading.Lock()
+        self.chat = types.SimpleNamespace(completions=self)
+
+    async def create(self, model, messages, stream=False, stream_options=None, **params):
+        start = time.perf_counter()
+        response = await self.inner.chat.completions.create(model=model, messages=messages, **params)
+        latency = time.perf_counter() - start
+        content = response.choices[0].message.content
+        usage = {"prompt_tokens": response.usage.prompt_tokens, "completion_tokens": response.usage.completion_tokens}
+        entry = {"key": cache_key(model, messages, params), "model": model, "content": content, "usage": usage, "latency": latency}
+        with self.lock, open(self.path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+        if stream:
+            return OfflineStream(content, response.usage, 0)
+        return response
+
+def make_llm_client():
+    if LLM_BACKEND == "fake":
+        return FakeLLM(FAKE_LLM_LATENCY, FAKE_LLM_ERROR_RATE, FAKE_LLM_SEED)
+    if LLM_BACKEND == "replay":
+        return ReplayLLM(LLM_REPLAY_PATH, LLM_REPLAY_LATENCY_SCALE)
+    from openai import AsyncOpenAI
+
+    # Async client so hundreds of sessions can wait on OpenAI at the same time
+    # (retries are owned by the request scheduler below, not the SDK)
+    openai_client = AsyncOpenAI(max_retries=0)
+    return RecordingLLM(openai_client, LLM_RECORD_PATH) if LLM_RECORD_PATH else openai_client
+
+client = None
+client_lock = threading.Lock()
+
+def llm_client():
+    global client
+    if client is None:
+        with client_lock:
+            if client is None:
+                client = make_llm_client()
+    return client
+
+# 📊 Prometheus metrics (served on /metrics)
+NODE_LATENCY = Histogram("agent_node_latency_seconds", "Time spent in each graph node", ["node"])
+LLM_LATENCY = Histogram(
+    "agent_llm_request_seconds", "OpenAI chat completion latency", ["model"],
+    buckets=(0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60)
+)
+LLM_ERRORS = Counter("agent_llm_errors_total", "Failed OpenAI chat completions", ["model", "error"])
+LLM_TOKENS = Counter("agent_llm_tokens_total", "Tokens used by OpenAI chat completions", ["model", "kind"])
+SESSION_ROUNDS = Histogram(
+    "agent_session_rounds", "Rounds a session ran before it stopped",
+    buckets=(1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 30, 50)
+)
+SAVE_STATE_LATENCY = Histogram("agent_save_state_seconds", "Time spent writing agent memory")
+ACTIVE_SESSIONS = Gauge("agent_active_sessions", "Sessions currently running")
+LOG_MEMORY_BYTES = Gauge("agent_log_memory_bytes", "Bytes of log entries held in memory across all sessions")
+LOG_MEMORY_BYTES.set_function(lambda: sum(session_log_bytes(s["state"]) for s in list(sessions.values())))
+LLM_TTFT = Histogram(
+    "agent_llm_time_to_first_token_seconds", "Time until the first streamed token arrives", ["model"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10)
+)
+
+# 📡 Event bus: node transitions, plans, results and planner tokens fan out to /sessions/{id}/events
+EVENT_BUFFER = int(os.getenv("EVENT_BUFFER", "256"))
+TERMINAL_STATUSES = ("done", "failed", "stopped", "cancelled")
+
+EVENTS_PUBLISHED = Counter("agent_events_published_total", "Session events delivered to subscribers", ["type"])
+EVENTS_DROPPED = Counter("agent_events_dropped_total", "Oldest events dropped because a subscriber fell behind")
+
+class EventBus:
+    # Each subscriber gets a bounded queue; a slow one loses its oldest events, never blocks the session
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.subscribers = {}
+        self.seq = {}
+        self.loop = None
+
+    def subscribe(self, session_id):
+        self.loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=self.buffer)
+        self.subscribers.setdefault(session_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, session_id, queue):
+        queues = self.subscribers.get(session_id, set())
+        queues.discard(queue)
+        if not queues:
+            self.subscribers.pop(session_id, None)
+            self.seq.pop(session_id, None)
+
+    def publish(self, session_id, kind, **data):
+        if session_id not in self.subscribers:
+            return
+        event = {"type": kind, "session_id": session_id, "time": time.time(), **data}
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            self.deliver(session_id, event)
+        else:
+            self.loop.call_soon_threadsafe(self.deliver, session_id, event)  # sync nodes run in worker threads
+
+    def deliver(self, session_id, event):
+        # Sequence numbers let a client see where events were dropped
+        seq = self.seq.get(session_id, 0) + 1
+        self.seq[session_id] = seq
+        event["seq"] = seq
+        EVENTS_PUBLISHED.labels(event["type"]).inc()
+        for queue in self.subscribers.get(session_id, ()):
+            if queue.full():
+                queue.get_nowait()
+                EVENTS_DROPPED.inc()
+            queue.put_nowait(event)
+
+event_bus = EventBus(EVENT_BUFFER)
+
+def publish_token(session_id, text):
+    event_bus.publish(session_id, "token", text=text)
+
+# 🎟️ Token metering: every LLM call charges the meter of the node (or speculative draft) that made it
+class TokenMeter:
+    def __init__(self):
+        self.tokens = 0
+
+    def charge(self, usage):
+        if usage:
+            self.tokens += usage.prompt_tokens + usage.completion_tokens
+
+token_meter = ContextVar("token_meter", default=None)
+
+def charge_tokens(usage):
+    meter = token_meter.get()
+    if meter is not None:
+        meter.charge(usage)
+
+async def metered(meter, coro):
+    token_meter.set(meter)  # tasks run in a copied context, so this stays local to the task
+    return await coro
+
+node_samples = None  # name -> [seconds], collected only while a benchmark runs
+
+def observe_node(name, seconds):
+    NODE_LATENCY.labels(name).observe(seconds)
+    if node_samples is not None:
+        node_samples.setdefault(name, []).append(seconds)
+
+def timed_node(name, node):
+    if asyncio.iscoroutinefunction(node):
+        @functools.wraps(node)
+        async def timed(state):
+            start = time.perf_counter()
+            event_bus.publish(state.get("session_id"), "node", node=name, phase="start")
+            meter = TokenMeter()
+            reset = token_meter.set(meter)
+            try:
+                update = await node(state)
+            finally:
+                token_meter.reset(reset)
+                observe_node(name, time.perf_counter() - start)
+                event_bus.publish(state.get("session_id"), "node", node=name, phase="end", seconds=time.perf_counter() - start)
+            if meter.tokens and isinstance(update, dict):
+                update = {**update, "tokens_used": meter.tokens}
+            return update
+    else:
+        @functools.wraps(node)
+        def timed(state):
+            start = time.perf_counter()
+            event_bus.publish(state.get("session_id"), "node", node=name, phase="start")
+            try:
+                return node(state)
+            finally:
+                observe_node(name, time.perf_counter() - start)
+                event_bus.publish(state.get("session_id"), "node", node=name, phase="end", seconds=time.perf_counter() - start)
+    return timed
+
+async def request_completion(model, messages, **params):
+    start = time.perf_counter()
+    try:
+        response = await llm_client().chat.completions.create(model=model, messages=messages, **params)
+    except Exception as e:
+        LLM_ERRORS.labels(model, type(e).__name__).inc()
+        raise
+    finally:
+        LLM_LATENCY.labels(model).observe(time.perf_counter() - start)
+
+    charge_tokens(response.usage)
+    if response.usage:
+        LLM_TOKENS.labels(model, "prompt").inc(response.usage.prompt_tokens)
+        LLM_TOKENS.labels(model, "completion").inc(response.usage.completion_tokens)
+    return response.choices[0].message.content.strip()
+
+# 🌊 Streaming: stop reading once the answer is decided, forwarding tokens as they arrive
+def plan_is_decided(text):
+    return "goal complete" in text.lower() or text.lstrip().count("\n") >= PLANNER_BATCH_SIZE
+
+async def stream_completion(model, messages, on_token=None, **params):
+    start = time.perf_counter()
+    text = ""
+    stream = None
+    charged = False
+    try:
+        stream = await llm_client().chat.completions.create(
+            model=model, messages=messages, stream=True, stream_options={"include_usage": True}, **params
+        )
+        async for chunk in stream:
+            charge_tokens(chunk.usage)
+            charged = charged or bool(chunk.usage)
+            if chunk.usage:
+                LLM_TOKENS.labels(model, "prompt").inc(chunk.usage.prompt_tokens)
+                LLM_TOKENS.labels(model, "completion").inc(chunk.usage.completion_tokens)
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            if not text:
+                LLM_TTFT.labels(model).observe(time.perf_counter() - start)
+            text += chunk.choices[0].delta.content
+            if on_token:
+                on_token(chunk.choices[0].delta.content)
+            if plan_is_decided(text):
+                break
+    except Exception as e:
+        LLM_ERRORS.labels(model, type(e).__name__).inc()
+        raise
+    finally:
+        LLM_LATENCY.labels(model).observe(time.perf_counter() - start)
+        if stream is not None:
+            if not charged:
+                # Usage only arrives with the last chunk; a stream cut short still spent its prompt and what it read
+                charge_tokens(types.SimpleNamespace(
+                    prompt_tokens=sum(estimate_tokens(m["content"]) for m in messages),
+                    completion_tokens=estimate_tokens(text)
+                ))
+            await stream.close()
+    return "\n".join(text.strip().split("\n")[:PLANNER_BATCH_SIZE]).strip()
+
+# 🚦 Process-wide request scheduler: rate buckets, AIMD concurrency limit and jittered backoff
+LLM_REQUESTS_PER_MINUTE = float(os.getenv("LLM_REQUESTS_PER_MINUTE", "500"))
+LLM_TOKENS_PER_MINUTE = float(os.getenv("LLM_TOKENS_PER_MINUTE", "30000"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "64"))
+LLM_LATENCY_TARGET = float(os.getenv("LLM_LATENCY_TARGET", "10"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "5"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "30"))
+@functools.cache
+def retryable_errors():
+    from openai import APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+    return (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+
+LLM_QUEUE_WAIT = Histogram(
+    "agent_llm_queue_wait_seconds", "Time a request waited for a concurrency slot and rate budget",
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60)
+)
+LLM_CONCURRENCY_LIMIT = Gauge("agent_llm_concurrency_limit", "Current AIMD concurrency limit for OpenAI calls")
+LLM_IN_FLIGHT = Gauge("agent_llm_in_flight", "OpenAI calls currently in flight")
+LLM_RETRIES = Counter("agent_llm_retries_total", "OpenAI calls retried after a transient error", ["model", "error"])
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def reserve(self, amount):
+        # Take the budget now (possibly going negative) and report how long to wait for it
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= min(amount, self.capacity)
+        return max(0.0, -self.tokens / self.rate)
+
+class RequestScheduler:
+    def __init__(self, requests_per_minute, tokens_per_minute, max_concurrency, latency_target):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.latency_target = latency_target
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.waiters = []
+        self.last_decrease = 0.0
+        LLM_CONCURRENCY_LIMIT.set(self.limit)
+
+    async def acquire(self, tokens):
+        start = time.perf_counter()
+        while self.in_flight >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self.wake_waiters()  # cancelled just after being woken: pass the wake-up on
+                raise
+            finally:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+        self.in_flight += 1
+        LLM_IN_FLIGHT.set(self.in_flight)
+
+        delay = max(self.requests.reserve(1), self.tokens.reserve(tokens))
+        if delay:
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                # The caller's release() only covers the call itself: give the slot back here
+                self.in_flight -= 1
+                LLM_IN_FLIGHT.set(self.in_flight)
+                self.wake_waiters()
+                raise
+        LLM_QUEUE_WAIT.observe(time.perf_counter() - start)
+
+    def release(self, latency, throttled):
+        self.in_flight -= 1
+        LLM_IN_FLIGHT.set(self.in_flight)
+
+        now = time.monotonic()
+        if throttled or latency > self.latency_target:
+            # Multiplicative decrease, at most once per latency window so one burst of 429s halves once
+            if now - self.last_decrease > min(latency, self.latency_target):
+                self.limit = max(1.0, self.limit * (0.5 if throttled else 0.9))
+                self.last_decrease = now
+        else:
+            self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+        LLM_CONCURRENCY_LIMIT.set(self.limit)
+        self.wake_waiters()
+
+    def wake_waiters(self):
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self.waiters:
+            waiter = self.waiters.pop(0)
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+llm_scheduler = RequestScheduler(
+    LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE, LLM_MAX_CONCURRENCY, LLM_LATENCY_TARGET
+)
+
+def backoff_delay(attempt, error):
+    delay = min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.5)
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            delay = max(delay, float(retry_after))
+        except ValueError:
+            pass
+    return delay
+
+async def scheduled_completion(fetch, model, messages, **params):
+    tokens = sum(estimate_tokens(m["content"]) for m in messages) + params.get("max_tokens", 256)
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        await llm_scheduler.acquire(tokens)
+        start = time.perf_counter()
+        throttled = False
+        try:
+            return await fetch(model, messages, **params)
+        except retryable_errors() as e:
+            throttled = isinstance(e, retryable_errors()[0])
+            if attempt == LLM_MAX_RETRIES:
+                raise
+            LLM_RETRIES.labels(model, type(e).__name__).inc()
+            delay = backoff_delay(attempt, e)
+        finally:
+            llm_scheduler.release(time.perf_counter() - start, throttled)
+        await asyncio.sleep(delay)
+
+# 🗃️ Two-tier response cache: in-memory LRU in front of a SQLite file, opt-in per node
+LLM_CACHE_NODES = set(filter(None, os.getenv("LLM_CACHE_NODES", "estimate_difficulty,planner_node").split(",")))
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite")
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "86400"))
+LLM_CACHE_MEMORY_ITEMS = int(os.getenv("LLM_CACHE_MEMORY_ITEMS", "2048"))
+LLM_CACHE_DISK_ITEMS = int(os.getenv("LLM_CACHE_DISK_ITEMS", "100000"))
+LLM_CACHE = Counter("agent_llm_cache_total", "LLM response cache lookups", ["node", "tier", "result"])
+
+def normalize_text(text):
+    return " ".join(text.split()).casefold()
+
+def cache_key(model, messages, params):
+    payload = {
+        "model": model,
+        "messages": [{"role": m["role"], "content": normalize_text(m["content"])} for m in messages],
+        "params": params,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+class ResponseCache:
+    def __init__(self, path, memory_items, disk_items, ttl):
+        self.path = path
+        self.memory_items = memory_items
+        self.disk_items = disk_items
+        self.ttl = ttl
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.db = None
+        self.puts = 0
+
+    def connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, value TEXT, expires_at REAL, accessed_at REAL)"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)")
+        return self.db
+
+    # The memory tier is an unlocked OrderedDict: only the event loop may call get_memory/put_memory
+    def get_memory(self, key):
+        entry = self.memory.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at < time.time():
+            del self.memory[key]
+            return None
+        self.memory.move_to_end(key)
+        return value
+
+    def put_memory(self, key, value, expires_at):
+        self.memory[key] = (value, expires_at)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+    def get_disk(self, key):
+        now = time.time()
+        with self.lock:
+            db = self.connect()
+            row = db.execute("SELECT value, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                db.commit()
+                return None
+            db.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            db.commit()
+        return row  # (value, expires_at); the caller promotes it, the memory tier is only touched on the loop
+
+    def put_disk(self, key, value, expires_at):
+        now = time.time()
+        with self.lock:
+            db = self.connect()
+            db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, value, expires_at, now))
+            self.puts += 1
+            if self.puts % 100 == 0:
+                db.execute("DELETE FROM responses WHERE expires_at < ?", (now,))
+                db.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at DESC "
+                    "LIMIT -1 OFFSET ?)", (self.disk_items,)
+                )
+            db.commit()
+
+response_cache = ResponseCache(LLM_CACHE_PATH, LLM_CACHE_MEMORY_ITEMS, LLM_CACHE_DISK_ITEMS, LLM_CACHE_TTL)
+
+# 🤝 Singleflight: identical requests already in flight share one upstream call instead of repeating it
+LLM_COALESCE = os.getenv("LLM_COALESCE", "1") == "1"
+
+LLM_COALESCED = Counter("agent_llm_coalesced_total", "LLM calls answered by an identical request already in flight", ["node"])
+LLM_UPSTREAM = Counter("agent_llm_upstream_total", "LLM calls that went to the backend (after cache and coalescing)", ["node"])
+
+inflight = {}
+coalescing = {"coalesced": 0, "upstream": 0}
+
+def coalescing_ratio():
+    total = coalescing["coalesced"] + coalescing["upstream"]
+    return coalescing["coalesced"] / total if total else 0.0
+
+LLM_COALESCING_RATIO = Gauge("agent_llm_coalescing_ratio", "Share of LLM calls saved by joining an identical in-flight call")
+LLM_COALESCING_RATIO.set_function(coalescing_ratio)
+
+async def coalesced(key, node, call):
+    # Returns (answer, shared); a waiter whose leader was cancelled makes the call itself
+    while LLM_COALESCE and key in inflight:
+        pending = inflight[key]
+        await asyncio.wait([pending])
+        if not pending.cancelled():
+            LLM_COALESCED.labels(node).inc()
+            coalescing["coalesced"] += 1
+            return pending.result(), True
+
+    future = asyncio.get_running_loop().create_future()
+    if LLM_COALESCE:
+        inflight[key] = future
+    LLM_UPSTREAM.labels(node).inc()
+    coalescing["upstream"] += 1
+    try:
+        answer = await call()
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        future.exception()  # waiters re-raise it; don't warn when there are none
+        raise
+    else:
+        future.set_result(answer)
+        return answer, False
+    finally:
+        if inflight.get(key) is future:
+            del inflight[key]
+
+async def chat_completion(model, messages, node=None, stream=False, on_token=None, **params):
+    fetch = functools.partial(stream_completion, on_token=on_token) if stream else request_completion
+    key = cache_key(model, messages, params)
+    cached = node in LLM_CACHE_NODES
+    if cached:
+        answer = response_cache.get_memory(key)
+        tier = "memory"
+        if answer is None:
+            row = await asyncio.to_thread(response_cache.get_disk, key)
+            tier = "disk"
+            if row is not None:
+                answer = row[0]
+                response_cache.put_memory(key, *row)
+        if answer is not None:
+            LLM_CACHE.labels(node, tier, "hit").inc()
+            if on_token:
+                on_token(answer)
+            return answer
+        LLM_CACHE.labels(node, "all", "miss").inc()
+
+    answer, shared = await coalesced(
+        f"{key}:{'stream' if stream else 'full'}", node,
+        lambda: scheduled_completion(fetch, model, messages, **params)
+    )
+    if on_token and (shared or not stream):
+        on_token(answer)
+    if cached and not shared:
+        expires_at = time.time() + response_cache.ttl
+        response_cache.put_memory(key, answer, expires_at)
+        await asyncio.to_thread(response_cache.put_disk, key, answer, expires_at)
+    return answer
+
+# 🧾 Planner context: the last few subtasks verbatim, older ones folded into a rolling summary
+PLANNER_RECENT_SUBTASKS = int(os.getenv("PLANNER_RECENT_SUBTASKS", "5"))
+PLANNER_SUMMARY_BATCH = int(os.getenv("PLANNER_SUMMARY_BATCH", "3"))
+PLANNER_CONTEXT_TOKENS = int(os.getenv("PLANNER_CONTEXT_TOKENS", "600"))
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gpt-4o-mini")
+PLANNER_STREAM = os.getenv("PLANNER_STREAM", "0") == "1"
+PLANNER_MAX_FAILURES = int(os.getenv("PLANNER_MAX_FAILURES", "3"))
+PLANNER_BATCH_SIZE = int(os.getenv("PLANNER_BATCH_SIZE", "1"))
+
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+def clip_to_tokens(text, tokens):
+    limit = max(tokens, 1) * 4
+    return text if len(text) <= limit else "..." + text[-(limit - 3):]
+
+async def fold_progress(state):
+    goal = state.get("user_goal", "")
+    completed = state.get("subtask_progress", [])
+    summary = state.get("progress_summary", "")
+    summarized = state.get("summarized_count", 0)
 
-client = OpenAI()
+    fold_until = len(completed) - PLANNER_RECENT_SUBTASKS
+    if fold_until - summarized < PLANNER_SUMMARY_BATCH:
+        return summary, summarized
 
-def planner_node(state):
-    round_num = state.get("round", 1)
+    newly_done = completed[summarized:fold_until]
+    try:
+        summary = await chat_completion(
+            model=SUMMARY_MODEL,
+            messages=[
+                {"role": "system", "content": (
+                    f"You keep a running summary of the progress a user has made toward the goal: '{goal}'. "
+                    "Merge the newly completed subtasks into the existing summary. "
+                    "Reply with the updated summary only, in a few short sentences."
+                )},
+                {"role": "user", "content": f"Existing summary: {summary or 'None'}\nNewly completed: {newly_done}"}
+            ],
+            max_tokens=PLANNER_CONTEXT_TOKENS // 3,
+            node="planner_summary"
+        )
+    except Exception as e:
+        logger.warning("Error summarizing progress: %s", e)
+        summary = f"{summary} {'; '.join(newly_done)}".strip()
+    return summary, fold_until
+
+def planner_context(summary, recent):
+    # Summary gets a third of the budget, the verbatim subtasks share the rest
+    summary = clip_to_tokens(summary, PLANNER_CONTEXT_TOKENS // 3) if summary else ""
+    per_item = max((PLANNER_CONTEXT_TOKENS - estimate_tokens(summary)) // max(len(recent), 1), 8)
+    recent = [clip_to_tokens(item, per_item) for item in recent]
+
+    context = f"They have already completed: {recent}. "
+    if summary:
+        context = f"Summary of their earlier progress: {summary.rstrip('.')}. " + context
+    return context
+
+def ask_for_subtasks():
+    if PLANNER_BATCH_SIZE == 1:
+        return "If not, return ONE next subtask to help complete the goal."
+    return (
+        f"If not, return up to {PLANNER_BATCH_SIZE} next subtasks that do not depend on each other "
+        "and can be done in parallel, one per line, with no numbering or extra text."
+    )
+
+def split_subtasks(text):
+    lines = [re.sub(r"^\s*(?:[-*•]|\d+[.)])\s+", "", line).strip() for line in text.splitlines()]
+    return [line for line in lines if line][:PLANNER_BATCH_SIZE] or [text.strip()]
+
+async def draft_plan(state, on_token=None, excluded=()):
     goal = state.get("user_goal", "")
     completed = state.get("subtask_progress", [])
 
-    print(f"📅 Planner: Planning task for Day {round_num}...\n🧠 Goal: {goal}")
+    summary, summarized = await fold_progress(state)
+    context = planner_context(summary, completed[summarized:])
+    if excluded:
+        context += f"Do not suggest these again, they repeat work already done: {list(excluded)}. "
 
     try:
-        response = client.chat.completions.create(
+        task = await chat_completion(
             model="gpt-4o",
             messages=[
                 {"role": "system", "content": (
                     f"You are a helpful AI planner. The user's goal is: '{goal}'. "
-                    f"They have already completed: {completed}. "
+                    + context +
                     "If the goal is fully complete, respond ONLY with: 'GOAL COMPLETE'. "
-                    "If not, return ONE next subtask to help complete the goal."
+                    + ask_for_subtasks()
                 )},
                 {"role": "user", "content": "What should I do next?"}
             ],
-            max_tokens=50
+            max_tokens=50 * PLANNER_BATCH_SIZE,
+            node="planner_node",
+            stream=PLANNER_STREAM,
+            on_token=on_token
         )
-        task = response.choices[0].message.content.strip()
     except Exception as e:
-        task = f"Error generating task: {e}"
+        return summary, summarized, e
+    return summary, summarized, task
+
+# 🔮 Pipelined planning: draft tomorrow's plan while today's task runs, assuming it gets accepted
+PIPELINE_PLANNING = os.getenv("PIPELINE_PLANNING", "0") == "1"
+
+PLANNER_SPECULATION = Counter(
+    "agent_planner_speculation_total", "Speculative next-round plans by outcome", ["outcome"]
+)
+
+speculative_plans = {}
+speculation_debt = {}  # session -> tokens spent by discarded drafts, not yet charged
+speculation_outcomes = {"hit": 0, "miss": 0}
+
+def plan_inputs(state):
+    # Everything draft_plan reads; a speculative plan is only valid if these match exactly
+    return (
+        state.get("user_goal", ""),
+        tuple(state.get("subtask_progress", [])),
+        state.get("progress_summary", ""),
+        state.get("summarized_count", 0)
+    )
+
+def speculation_hit_ratio():
+    decided = speculation_outcomes["hit"] + speculation_outcomes["miss"]
+    return speculation_outcomes["hit"] / decided if decided else 0.0
+
+SPECULATION_HIT_RATIO = Gauge("agent_planner_speculation_hit_ratio", "Share of speculative plans that were used")
+SPECULATION_HIT_RATIO.set_function(speculation_hit_ratio)
+
+def speculate_next_plan(state, tasks):
+    session_id = state.get("session_id")
+    if not PIPELINE_PLANNING or not session_id or state.get("round", 1) >= state.get("max_rounds", MAX_ESTIMATED_DAYS):
+        return
+    assumed = merge_update(state, {"subtask_progress": tasks})
+    discard_speculation(session_id)
+    meter = TokenMeter()
+    speculative_plans[session_id] = (plan_inputs(assumed), asyncio.create_task(metered(meter, draft_plan(assumed))), meter)
+
+def bill_draft(session_id, draft, meter):
+    # A thrown-away draft still spent tokens, some of them possibly after it was cancelled:
+    # once it has settled, they go on the session's next plan
+    def bill(_):
+        if meter.tokens:
+            speculation_debt[session_id] = speculation_debt.get(session_id, 0) + meter.tokens
+    draft.add_done_callback(bill)
+
+def discard_speculation(session_id, bill=True):
+    pending = speculative_plans.pop(session_id, None)
+    if pending is None:
+        return
+    _, draft, meter = pending
+    if bill:
+        bill_draft(session_id, draft, meter)
+    if not draft.done():
+        draft.cancel()
+        PLANNER_SPECULATION.labels("cancelled").inc()
+
+async def take_speculation(state):
+    session_id = state.get("session_id")
+    current = token_meter.get() or TokenMeter()
+    current.tokens += speculation_debt.pop(session_id, 0)
+    pending = speculative_plans.pop(session_id, None)
+    if pending is None:
+        return None
+    inputs, draft, meter = pending
+    if inputs != plan_inputs(state):
+        bill_draft(session_id, draft, meter)
+        if not draft.done():
+            draft.cancel()
+        PLANNER_SPECULATION.labels("miss").inc()
+        speculation_outcomes["miss"] += 1
+        return None
+    PLANNER_SPECULATION.labels("hit").inc()
+    speculation_outcomes["hit"] += 1
+    # Charge only once the draft is finished, so calls it makes from here on count too
+    drafted = await draft
+    current.tokens += meter.tokens
+    return drafted
+
+# 🔁 Duplicate subtasks: a per-session MinHash index rejects planned subtasks the session has already done
+DEDUP_SUBTASKS = os.getenv("DEDUP_SUBTASKS", "1") == "1"
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.7"))  # estimated Jaccard similarity of word shingles
+DEDUP_MAX_REPLANS = int(os.getenv("DEDUP_MAX_REPLANS", "2"))
+MINHASH_PERMUTATIONS = int(os.getenv("MINHASH_PERMUTATIONS", "64"))
+MINHASH_PRIME = (1 << 61) - 1
+minhash_random = random.Random(0)
+MINHASH_PARAMS = [
+    (minhash_random.randrange(1, MINHASH_PRIME), minhash_random.randrange(MINHASH_PRIME)) for _ in range(MINHASH_PERMUTATIONS)
+]
+
+DEDUP_REJECTED = Counter("agent_dedup_rejected_total", "Planned subtasks rejected as near-duplicates of done work")
+DEDUP_ROUNDS_SAVED = Counter("agent_dedup_rounds_saved_total", "Days re-planned instead of repeating done work")
+DEDUP_TOKENS_SAVED = Counter(
+    "agent_dedup_tokens_saved_total", "Estimated planner prompt tokens rejected duplicates would have added"
+)
+
+def shingles(text):
+    words = re.findall(r"\w+", text.casefold())
+    return set(words) | {f"{a} {b}" for a, b in zip(words, words[1:])}
+
+def minhash(text):
+    hashes = [int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "big") for s in shingles(text)] or [0]
+    return tuple(min((a * h + b) % MINHASH_PRIME for h in hashes) for a, b in MINHASH_PARAMS)
+
+def similarity(left, right):
+    return sum(x == y for x, y in zip(left, right)) / len(left)
+
+class SubtaskIndex:
+    def __init__(self):
+        self.signatures = []
+
+    def sync(self, completed):
+        # The index follows subtask_progress, so a restarted session rebuilds it from persisted state
+        if len(self.signatures) > len(completed):
+            self.signatures = []
+        self.signatures.extend(minhash(task) for task in completed[len(self.signatures):])
+        return self
+
+    def screen(self, tasks):
+        # Returns (fresh, duplicates); subtasks in one batch can't repeat each other either
+        fresh, duplicates, seen = [], [], list(self.signatures)
+        for task in tasks:
+            signature = minhash(task)
+            if any(similarity(signature, other) >= DEDUP_THRESHOLD for other in seen):
+                duplicates.append(task)
+            else:
+                fresh.append(task)
+                seen.append(signature)
+        return fresh, duplicates
+
+subtask_indexes = {}
+
+def subtask_index(state):
+    session_id = state.get("session_id")
+    index = subtask_indexes.setdefault(session_id, SubtaskIndex()) if session_id else SubtaskIndex()
+    return index.sync(state.get("subtask_progress", []))
+
+async def replan_duplicates(state, task, on_token):
+    # Returns (task, tasks, rejected, replanned): drops repeated subtasks and re-plans while nothing new is left
+    index = subtask_index(state) if DEDUP_SUBTASKS else None
+    rejected = []
+    for attempt in range(DEDUP_MAX_REPLANS + 1):
+        if isinstance(task, Exception) or "goal complete" in task.lower():
+            return task, [], rejected, attempt > 0 and not isinstance(task, Exception)
+        planned = split_subtasks(task)
+        tasks, duplicates = index.screen(planned) if index else (planned, [])
+        if tasks or not duplicates:
+            return task, tasks, rejected + duplicates, attempt > 0
+        if attempt == DEDUP_MAX_REPLANS:
+            break
+        rejected += duplicates
+        logger.info("[%s] Rejected a plan that repeats done work: %s", state.get("session_id"), duplicates)
+        _, _, task = await draft_plan(state, on_token, excluded=rejected)
+    # Out of re-plans: run the repeat rather than stall the session
+    logger.warning("[%s] Planner keeps repeating done work: %s", state.get("session_id"), planned)
+    return task, planned, rejected, False
+
+def dedup_savings(state, rejected, replanned):
+    # A rejected repeat would have sat in the verbatim part of the next few planner prompts
+    prompts = max(min(state.get("max_rounds", 1) - state.get("round", 1), PLANNER_RECENT_SUBTASKS), 0)
+    tokens = sum(estimate_tokens(task) for task in rejected) * prompts
+    DEDUP_REJECTED.inc(len(rejected))
+    DEDUP_ROUNDS_SAVED.inc(int(replanned))
+    DEDUP_TOKENS_SAVED.inc(tokens)
+    return {
+        "duplicates_rejected": state.get("duplicates_rejected", 0) + len(rejected),
+        "rounds_saved": state.get("rounds_saved", 0) + int(replanned),
+        "tokens_saved": state.get("tokens_saved", 0) + tokens
+    }
 
-    logs = state.get("log", [])
-    logs.append(f"Planned task {round_num}: {task}")
+async def planner_node(state):
+    round_num = state.get("round", 1)
+    goal = state.get("user_goal", "")
 
-    if "goal complete" in task.lower():
-        return {**state, "role": "end", "log": logs}
+    logger.info("📅 Planner: planning task for Day %s of goal: %s", round_num, goal)
+
+    on_token = functools.partial(publish_token, state.get("session_id"))
+    drafted = await take_speculation(state)
+    if drafted is not None and not isinstance(drafted[2], Exception):
+        on_token(drafted[2])
+    else:
+        drafted = await draft_plan(state, on_token)
+    summary, summarized, task = drafted
+    task, tasks, rejected, replanned = await replan_duplicates(state, task, on_token)
+    dedup = dedup_savings(state, rejected, replanned) if rejected else {}
+
+    if isinstance(task, Exception):
+        # Never hand an error message to the executor: plan again, or give up after repeated failures
+        failures = state.get("planner_failures", 0) + 1
+        event_bus.publish(state.get("session_id"), "plan_failed", round=round_num, attempt=failures, error=str(task))
+        update = {
+            **log_update(state, f"Planning failed for Day {round_num} (attempt {failures}): {task}"),
+            "role": "planner",
+            "planner_failures": failures,
+            **dedup
+        }
+        if failures >= PLANNER_MAX_FAILURES:
+            update.update(role="end", end_reason="planner_failures")
+        return update
 
+    if "goal complete" in task.lower():
+        event_bus.publish(state.get("session_id"), "planned", round=round_num, tasks=[], goal_complete=True)
+        log = log_update(state, f"Planned task {round_num}: {task}")
+        return {
+            **log,
+            "role": "end",
+            "end_reason": "goal_complete",
+            "planner_failures": 0,
+            "progress_summary": summary,
+            "summarized_count": summarized,
+            **dedup
+        }
+
+    task = "; ".join(tasks)
+    event_bus.publish(state.get("session_id"), "planned", round=round_num, tasks=tasks, rejected=rejected)
+    speculate_next_plan({**state, "progress_summary": summary, "summarized_count": summarized}, tasks)
+    skipped = [f"Skipped repeated subtasks for Day {round_num}: {'; '.join(rejected)}"] if rejected else []
     return {
-        **state,
+        **log_update(state, *skipped, f"Planned task {round_num}: {task}"),
         "task": task,
+        "tasks": tasks,
         "role": "executor",
-        "log": logs
+        "planner_failures": 0,
+        "progress_summary": summary,
+        "summarized_count": summarized,
+        **dedup
     }
 
-def estimate_difficulty_node(state):
+async def estimate_days(goal):
+    answer = await chat_completion(
+        model="gpt-4o",
+        messages=[
+            {"role": "system", "content": (
+                "You are an AI task analyst. Given a user's goal, estimate the number of days needed to accomplish it "
+                "realistically with daily tasks. Respond ONLY with a number between 1 and 10."
+            )},
+            {"role": "user", "content": f"My goal is: {goal}"}
+        ],
+        max_tokens=10,
+        node="estimate_difficulty"
+    )
+    days = re.search(r"\d+", answer)
+    if days is None:
+        raise ValueError(f"no number in estimate {answer!r}")
+    # The estimate becomes the session's round cap: "0" or "2-3" must not end it early or run it for 23 days
+    return min(max(int(days.group()), 1), MAX_ESTIMATED_DAYS)
+
+async def estimate_difficulty_node(state):
     goal = state.get("user_goal", "")
-    print(f"Estimating difficulty for goal: {goal}")
+    logger.info("Estimating difficulty for goal: %s", goal)
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": (
-                    "You are an AI task analyst. Given a user's goal, estimate the number of days needed to accomplish it "
-                    "realistically with daily tasks. Respond ONLY with a number between 1 and 10."
-                )},
-                {"role": "user", "content": f"My goal is: {goal}"}
-            ],
-            max_tokens=10
-        )
-        estimated_days = int("".join(filter(str.isdigit, response.choices[0].message.content.strip())))
-        print(f"Estimated days: {estimated_days}")
+        estimated_days = await estimate_days(goal)
+        logger.info("Estimated days: %s", estimated_days)
     except Exception as e:
-        print(f"Error estimating difficulty: {e}")
+        logger.warning("Error estimating difficulty: %s", e)
         estimated_days = 3
 
     return {
-        **state,
         "max_rounds": estimated_days,
+        "difficulty_estimated": True,
         "role": "planner"
     }
 
-def executor_node(state):
+# 🧪 Executor sandbox: pre-forked worker processes with timeouts, memory caps and recycling
+EXECUTOR_WORKERS = int(os.getenv("EXECUTOR_WORKERS", str(os.cpu_count() or 2)))
+EXECUTOR_TIMEOUT = float(os.getenv("EXECUTOR_TIMEOUT", "5"))
+EXECUTOR_MAX_RSS_MB = int(os.getenv("EXECUTOR_MAX_RSS_MB", "256"))
+EXECUTOR_MAX_TASKS = int(os.getenv("EXECUTOR_MAX_TASKS", "500"))
+SAFE_BUILTINS = {
+    name: getattr(builtins, name) for name in (
+        "abs", "all", "any", "bool", "dict", "divmod", "enumerate", "float", "int", "len", "list",
+        "max", "min", "pow", "range", "reversed", "round", "set", "sorted", "str", "sum", "tuple", "zip"
+    )
+}
+
+# The builtins whitelist alone isn't a sandbox: ().__class__.__base__.__subclasses__() walks back to os.
+# Tasks may not touch underscore names or attributes, nor str.format (whose fields can read attributes)
+BLOCKED_ATTRIBUTES = {"format", "format_map"}
+
+def compile_task(task):
+    tree = ast.parse(task, mode="eval")
+    for node in ast.walk(tree):
+        name = node.id if isinstance(node, ast.Name) else node.attr if isinstance(node, ast.Attribute) else ""
+        if name.startswith("_") or (isinstance(node, ast.Attribute) and name in BLOCKED_ATTRIBUTES):
+            raise ValueError(f"'{name}' is not allowed in a task")
+    return compile(tree, "<task>", "eval")
+
+EXECUTOR_QUEUE_DEPTH = Gauge("agent_executor_queue_depth", "Tasks waiting for a free executor worker")
+EXECUTOR_BUSY = Gauge("agent_executor_busy_workers", "Executor workers currently running a task")
+EXECUTOR_TASK_SECONDS = Histogram("agent_executor_task_seconds", "Wall-clock time of sandboxed executor tasks")
+EXECUTOR_RECYCLED = Counter("agent_executor_recycled_total", "Executor workers replaced", ["reason"])
+
+def sandbox_worker(conn, max_rss_mb, max_tasks):
+    import resource
+
+    def memory():
+        # (address space, resident set) in bytes
+        with open("/proc/self/statm") as f:
+            size, resident = f.read().split()[:2]
+        return int(size) * page_size, int(resident) * page_size
+
+    # Cap address-space growth so a runaway expression fails inside the worker, not the pod;
+    # a forked worker starts out with the server's footprint, so both limits count growth from here
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    current, baseline_rss = memory()
+    limit = current + max_rss_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    # Nothing the server holds is the task's business: no API keys, no database or socket descriptors
+    os.environ.clear()
+    keep = conn.fileno()
+    max_fd = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    os.closerange(3, keep)
+    os.closerange(keep + 1, max_fd if max_fd != resource.RLIM_INFINITY else 65536)
+
+    for done in range(1, max_tasks + 1):
+        try:
+            task = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        try:
+            result = eval(compile_task(task), {"__builtins__": SAFE_BUILTINS}, {})
+            if not isinstance(result, (str, int, float, bool, type(None))):
+                result = repr(result)
+        except MemoryError:
+            result = "Error: memory limit exceeded"
+        except Exception as e:
+            result = f"Error: {e}"
+        grown_mb = (memory()[1] - baseline_rss) / (1024 * 1024)
+        recycle = "rss" if grown_mb > max_rss_mb else "max_tasks" if done == max_tasks else None
+        conn.send((result, recycle))
+        if recycle:
+            return
+
+class ExecutorPool:
+    def __init__(self, size, timeout, max_rss_mb, max_tasks):
+        self.size = size
+        self.timeout = timeout
+        self.max_rss_mb = max_rss_mb
+        self.max_tasks = max_tasks
+        self.context = multiprocessing.get_context("fork")
+        self.idle = None
+        self.workers = []
+        self.waiting = 0
+
+    def spawn(self):
+        conn, child_conn = self.context.Pipe()
+        process = self.context.Process(
+            target=sandbox_worker, args=(child_conn, self.max_rss_mb, self.max_tasks), daemon=True
+        )
+        process.start()
+        child_conn.close()
+        worker = (process, conn)
+        self.workers.append(worker)
+        return worker
+
+    def retire(self, worker, reason):
+        process, conn = worker
+        if process.is_alive():
+            process.kill()
+        process.join(timeout=1)
+        conn.close()
+        self.workers.remove(worker)
+        EXECUTOR_RECYCLED.labels(reason).inc()
+
+    def start(self):
+        if self.idle is None:
+            self.idle = asyncio.Queue()
+            for _ in range(self.size):
+                self.idle.put_nowait(self.spawn())
+
+    def has_capacity(self):
+        # Busy workers are fine; a backlog longer than the pool itself means new work would just queue
+        return self.idle is not None and bool(self.workers) and self.waiting < self.size
+
+    def close(self):
+        for process, conn in list(self.workers):
+            process.kill()
+            conn.close()
+        self.workers = []
+        self.idle = None
+
+    async def wait_for_reply(self, conn):
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        loop.add_reader(conn.fileno(), lambda: ready.done() or ready.set_result(None))
+        try:
+            await asyncio.wait_for(ready, self.timeout)
+        finally:
+            loop.remove_reader(conn.fileno())
+        return conn.recv()
+
+    async def run(self, task):
+        self.start()
+        EXECUTOR_QUEUE_DEPTH.inc()
+        self.waiting += 1
+        try:
+            worker = await self.idle.get()
+        finally:
+            EXECUTOR_QUEUE_DEPTH.dec()
+            self.waiting -= 1
+
+        EXECUTOR_BUSY.inc()
+        start = time.perf_counter()
+        recycle = None
+        try:
+            worker[1].send(task)
+            result, recycle = await self.wait_for_reply(worker[1])
+        except asyncio.TimeoutError:
+            result, recycle = f"Error: task timed out after {self.timeout}s", "timeout"
+        except (EOFError, OSError):
+            result, recycle = "Error: executor worker crashed", "crash"
+        except asyncio.CancelledError:
+            # The reply is still on its way down the pipe: replace the worker instead of reusing it
+            self.retire(worker, "cancelled")
+            self.idle.put_nowait(self.spawn())
+            raise
+        finally:
+            EXECUTOR_BUSY.dec()
+            EXECUTOR_TASK_SECONDS.observe(time.perf_counter() - start)
+
+        if recycle:
+            self.retire(worker, recycle)
+            worker = self.spawn()
+        self.idle.put_nowait(worker)
+        return result
+
+executor_pool = ExecutorPool(EXECUTOR_WORKERS, EXECUTOR_TIMEOUT, EXECUTOR_MAX_RSS_MB, EXECUTOR_MAX_TASKS)
+
+# 🔀 Each planned subtask runs in its own executor branch; the reviewer joins them into one day
+async def executor_node(state):
     task = state.get("task", "")
-    print(f"Executor: Executing task: {task}")
-    try:
-        result = eval(task)
-    except Exception as e:
-        result = f"Error: {e}"
-    logs = state.get("log", [])
-    logs.append(f"Executed: {task} -> {result}")
-    return {
-        **state,
-        "result": result,
-        "role": "reviewer",
-        "log": logs
-    }
+    logger.info("Executor: executing task: %s", task)
+    result = await executor_pool.run(task)
+    event_bus.publish(state.get("session_id"), "result", round=state.get("round", 1), task=task, result=str(result))
+    return {"results": [[task, result]], "role": "reviewer"}
+
+def dispatch_tasks(state):
+    from langgraph.types import Send
+
+    tasks = state.get("tasks") or [state.get("task", "")]
+    return [Send("executor_node", {**state, "task": task}) for task in tasks]
 
 def reviewer_node(state):
     round_num = state.get("round", 1)
-    logs = state.get("log", [])
-    logs.append(f"Reviewed result of Day {round_num}")
-    completed = state.get("subtask_progress", [])
-    completed.append(state.get("task", ""))
+    results = state.get("results") or []
+    executed = [f"Executed: {task} -> {result}" for task, result in results]
+    event_bus.publish(state.get("session_id"), "reviewed", round=round_num, completed=len(results))
     return {
-        **state,
+        **log_update(state, *executed, f"Reviewed result of Day {round_num}"),
         "round": round_num + 1,
         "role": "planner",
-        "subtask_progress": completed,
-        "log": logs
+        "result": results[0][1] if len(results) == 1 else [result for _, result in results],
+        "results": None,
+        "subtask_progress": [task for task, _ in results] or [state.get("task", "")]
     }
 
-def role_switch_node(state):
-    print(f"Switching role to: {state.get('role')}")
-    return state
+# ⛽ Budgets: sessions stop at max_rounds, their token budget or their deadline, whichever comes first
+SESSION_TOKEN_BUDGET = int(os.getenv("SESSION_TOKEN_BUDGET", "50000"))
+SESSION_DEADLINE_SECONDS = float(os.getenv("SESSION_DEADLINE_SECONDS", "1800"))
+
+SESSION_ENDS = Counter("agent_session_end_total", "Sessions that reached the end node, by reason", ["reason"])
+
+def exhausted_budget(state):
+    if state.get("round", 1) > state.get("max_rounds", MAX_ESTIMATED_DAYS):
+        return "max_rounds"
+    if SESSION_TOKEN_BUDGET and state.get("tokens_used", 0) >= SESSION_TOKEN_BUDGET:
+        return "token_budget"
+    if SESSION_DEADLINE_SECONDS and state.get("started_at") and time.time() - state["started_at"] > SESSION_DEADLINE_SECONDS:
+        return "deadline"
+    return None
 
 def route_by_role(state):
+    # Budgets are checked before any node that spends tokens; a dispatched day still gets executed and reviewed
+    if state.get("role") == "planner" and exhausted_budget(state):
+        return "end"
+    if state.get("role") == "executor":
+        return dispatch_tasks(state)
     return {
         "planner": "planner_node",
-        "executor": "executor_node",
         "reviewer": "reviewer_node"
     }.get(state.get("role", ""), "end")
 
+# ⏩ Restarted sessions skip straight to the node they were waiting on
+def resume_point(state):
+    if not state.get("user_goal"):
+        return "user_goal_node"
+    if not state.get("difficulty_estimated"):
+        return "estimate_difficulty"
+    return route_by_role(state)
+
 def end_node(state):
-    print("Finished")
-    print("Final log:", state.get("log", []))
+    reason = state.get("end_reason") if state.get("role") == "end" else exhausted_budget(state)
+    reason = reason or "goal_complete"
+    spilled = state.get("log_spilled", 0)
+    logger.info("Finished (%s)", reason)
+    event_bus.publish(state.get("session_id"), "end", reason=reason, round=state.get("round", 1))
+    logger.debug("Final log (entries %s-%s): %s", spilled, spilled + len(state.get("log", [])), state.get("log", []))
+    SESSION_ENDS.labels(reason).inc()
+    update = {"role": "end", "end_reason": reason}
+    if state.get("role") != "end":
+        update.update(log_update(state, f"Stopped on Day {state.get('round', 1)}: {reason.replace('_', ' ')} reached"))
+    return update
+
+# 🧠 Build LangGraph structure: every worker routes straight to the next role, one superstep per node
+GRAPH_SETUP_STEPS = 3  # user goal, difficulty estimate, end
+GRAPH_STEPS_PER_DAY = 3  # planner, executor, reviewer
+
+def build_graph(nodes=None, checkpointer=None, legacy=False):
+    from langgraph.graph import StateGraph
+
+    nodes = {
+        "user_goal_node": user_goal_node,
+        "estimate_difficulty": estimate_difficulty_node,
+        "planner_node": planner_node,
+        "executor_node": executor_node,
+        "reviewer_node": reviewer_node,
+        **(nodes or {})
+    }
+    builder = StateGraph(AgentState)
+    for name, node in nodes.items():
+        builder.add_node(name, timed_node(name, node))
+    builder.add_node("end", end_node)
+
+    builder.set_conditional_entry_point(resume_point)
+    builder.add_edge("user_goal_node", "estimate_difficulty")
+    builder.add_edge("estimate_difficulty", "planner_node")
+    if legacy:
+        # The old topology (every worker hops through a pass-through role_switch node), kept for --bench graph
+        builder.add_node("role_switch", lambda state: {})
+        for name in ("planner_node", "executor_node", "reviewer_node"):
+            builder.add_edge(name, "role_switch")
+        builder.add_conditional_edges("role_switch", route_by_role)
+    else:
+        builder.add_conditional_edges("planner_node", route_by_role)
+        builder.add_edge("executor_node", "reviewer_node")
+        builder.add_conditional_edges("reviewer_node", route_by_role)
+    return builder.compile(checkpointer=checkpointer)
+
+MAX_ESTIMATED_DAYS = 10
+
+def recursion_limit(state):
+    # Before the estimate runs, allow for the longest plan the estimator can return
+    days = state.get("max_rounds") if state.get("difficulty_estimated") else MAX_ESTIMATED_DAYS
+    return GRAPH_SETUP_STEPS + GRAPH_STEPS_PER_DAY * (max(days or MAX_ESTIMATED_DAYS, 1) + 2)
+
+# 💾 Checkpoints keyed by session id let a continued session resume at its pending node
+checkpointer = None
+graph = None
+graph_lock = threading.Lock()
+
+def agent_graph():
+    global checkpointer, graph
+    if graph is None:
+        with graph_lock:
+            if graph is None:
+                from langgraph.checkpoint.memory import MemorySaver
+
+                checkpointer = MemorySaver()
+                graph = build_graph(checkpointer=checkpointer)
+    return graph
+
+# 🔄 Agent memory persistence: a snapshot plus an append-only journal of per-step deltas
+JOURNAL_FSYNC_EVERY = int(os.getenv("JOURNAL_FSYNC_EVERY", "16"))
+JOURNAL_FSYNC_SECONDS = float(os.getenv("JOURNAL_FSYNC_SECONDS", "1.0"))
+JOURNAL_COMPACT_EVERY = int(os.getenv("JOURNAL_COMPACT_EVERY", "200"))
+APPEND_FIELDS = ("log", "subtask_progress")
+APPEND_OFFSETS = {"log": "log_spilled"}  # entries dropped from the front of a windowed list
+
+class StateJournal:
+    def __init__(self, path):
+        self.path = path
+        self.journal_path = os.path.splitext(path)[0] + ".journal"
+        self.seq = 0
+        self.saved = None
+        self.file = None
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        self.since_compact = 0
+
+    def resume(self, state, seq):
+        self.seq = seq
+        self.saved = self.remember(state)
+
+    def remember(self, state):
+        # Append-only fields are remembered by absolute length, so diffing never walks the history
+        return {
+            key: self.total(state, key) if key in APPEND_FIELDS and isinstance(value, list) else value
+            for key, value in state.items()
+        }
+
+    def total(self, state, key):
+        return len(state[key]) + state.get(APPEND_OFFSETS.get(key), 0)
+
+    def delta(self, state):
+        changes, appends = {}, {}
+        for key, value in state.items():
+            if key in APPEND_FIELDS and isinstance(value, list):
+                saved_total = self.saved.get(key)
+                grown = self.total(state, key) - saved_total if isinstance(saved_total, int) else -1
+                if 0 <= grown <= len(value):
+                    if grown:
+                        appends[key] = value[len(value) - grown:]
+                    continue
+            elif key in self.saved and self.saved[key] == value:
+                continue
+            changes[key] = value
+        removed = [key for key in self.saved if key not in state]
+        return {key: part for key, part in (("set", changes), ("append", appends), ("unset", removed)) if part}
+
+    def append(self, state):
+        if self.saved is None:
+            self.compact(state)
+            return
+
+        delta = self.delta(state)
+        if not delta:
+            return
+
+        if self.file is None:
+            self.file = open(self.journal_path, "a")
+        self.seq += 1
+        self.file.write(json.dumps({"seq": self.seq, **delta}, separators=(",", ":")) + "\n")
+        self.file.flush()
+        self.saved = self.remember(state)
+        self.unsynced += 1
+        self.since_compact += 1
+
+        if self.unsynced >= JOURNAL_FSYNC_EVERY or time.monotonic() - self.last_sync >= JOURNAL_FSYNC_SECONDS:
+            self.sync()
+        if self.since_compact >= JOURNAL_COMPACT_EVERY:
+            self.compact(state)
+
+    def sync(self):
+        if self.file is not None and self.unsynced:
+            os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def compact(self, state):
+        # Write the snapshot atomically, then start an empty journal after it
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"journal_seq": self.seq, "state": state}, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.journal_path, "w")
+        self.saved = self.remember(state)
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        self.since_compact = 0
+        logger.debug("Memory saved to %s", self.path)
+
+    def close(self):
+        self.sync()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+journals = {}
+
+def journal_for(path):
+    if path not in journals:
+        journals[path] = StateJournal(path)
+    return journals[path]
+
+def apply_delta(state, record):
+    offsets = {key: state.get(field, 0) for key, field in APPEND_OFFSETS.items()}
+    state.update(record.get("set", {}))
+    for key, items in record.get("append", {}).items():
+        combined = state.get(key, []) + items
+        if key in APPEND_OFFSETS:
+            combined = combined[state.get(APPEND_OFFSETS[key], 0) - offsets[key]:]
+        state[key] = combined
+    for key in record.get("unset", []):
+        state.pop(key, None)
     return state
 
-# 🧠 Build LangGraph structure
-builder = StateGraph(dict)
-builder.add_node("user_goal_node", user_goal_node)
-builder.add_node("estimate_difficulty", estimate_difficulty_node)
-builder.add_node("planner_node", planner_node)
-builder.add_node("executor_node", executor_node)
-builder.add_node("reviewer_node", reviewer_node)
-builder.add_node("role_switch", role_switch_node)
-builder.add_node("end", end_node)
-
-builder.set_entry_point("user_goal_node")
-builder.add_edge("user_goal_node", "estimate_difficulty")
-builder.add_edge("estimate_difficulty", "planner_node")
-builder.add_edge("planner_node", "role_switch")
-builder.add_edge("executor_node", "role_switch")
-builder.add_edge("reviewer_node", "role_switch")
-builder.add_conditional_edges("role_switch", route_by_role)
-
-graph = builder.compile()
-
-# 🔄 Agent memory persistence
 def save_state(state, path="agent_memory.json"):
-    with open(path, "w") as f:
-        json.dump(state, f, indent=2)
-    print(f"Memory saved to {path}")
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    journal_for(path).append(state)
+
+def fresh_state():
+    return {"role": "planner", "round": 1, "max_rounds": 3}
+
+def close_state(path="agent_memory.json"):
+    if path in journals:
+        journals.pop(path).close()
 
 def load_state(path="agent_memory.json"):
+    journal = journal_for(path)
+    state, seq = None, 0
     try:
         with open(path, "r") as f:
-            state = json.load(f)
-        print(f"Memory loaded from {path}")
-        return state
+            snapshot = json.load(f)
+        if "journal_seq" in snapshot and "state" in snapshot:
+            state, seq = snapshot["state"], snapshot["journal_seq"]
+        else:
+            state = snapshot  # memory written before the journal existed
     except FileNotFoundError:
-        print("No saved memory found, starting fresh.")
-        return {"role": "planner", "round": 1, "max_rounds": 3}
+        pass
+
+    replayed = 0
+    try:
+        with open(journal.journal_path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break  # torn write at the tail of the journal
+                if record["seq"] <= seq:
+                    continue
+                state = apply_delta(state if state is not None else {}, record)
+                seq = record["seq"]
+                replayed += 1
+    except FileNotFoundError:
+        pass
+
+    if state is None:
+        logger.info("No saved memory found, starting fresh.")
+        return fresh_state()
 
-# 🧠 Run the agent
-state = load_state()
+    journal.resume(state, seq)
+    logger.info("Memory loaded from %s (+%s journal entries)", path, replayed)
+    return state
 
-if state.get("role") == "end":
-    print("Agent has already completed its tasks. Nothing more to do.")
-else:
+# 🏪 State stores: per-session JSON journals (default) or one SQLite database shared by every session
+STATE_STORE = os.getenv("STATE_STORE", "journal")
+STATE_DB = os.getenv("STATE_DB", "agent_state.sqlite")
+# WAL needs shared memory between every process using the file: set DELETE when replicas share the databases
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+DEFAULT_SESSION = "default"
+SESSIONS_DIR = os.getenv("SESSIONS_DIR", "sessions")
+
+class JournalStateStore:
+    def __init__(self, sessions_dir, default_path="agent_memory.json"):
+        self.sessions_dir = sessions_dir
+        self.default_path = default_path
+
+    def path(self, session_id):
+        if session_id == DEFAULT_SESSION:
+            return self.default_path
+        return os.path.join(self.sessions_dir, f"{session_id}.json")
+
+    def save(self, session_id, state):
+        save_state(state, self.path(session_id))
+
+    def load(self, session_id):
+        return load_state(self.path(session_id))
+
+    def close(self, session_id):
+        close_state(self.path(session_id))
+
+    def warm(self):
+        os.makedirs(self.sessions_dir, exist_ok=True)
+        if not os.access(self.sessions_dir, os.W_OK):
+            raise PermissionError(f"{self.sessions_dir} is not writable")
+
+class SQLiteStateStore:
+    # One writer thread group-commits the latest state of every session that saved since the last commit
+    def __init__(self, path):
+        self.path = path
+        self.pending = {}
+        self.cond = threading.Condition()
+        self.committed = 0
+        self.writing = False
+        self.failure = None
+        self.writer = None
+        self.reader = None
+        self.read_lock = threading.Lock()
+
+    def connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, round INTEGER, role TEXT, "
+            "state TEXT, updated_at REAL)"
+        )
+        db.execute("CREATE INDEX IF NOT EXISTS sessions_by_round ON sessions (round)")
+        db.commit()
+        return db
+
+    def write_loop(self):
+        db = self.connect()
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                batch, self.pending = self.pending, {}
+                self.writing = True
+            failure = None
+            try:
+                db.executemany(
+                    "INSERT INTO sessions VALUES (?, ?, ?, ?, ?) ON CONFLICT(session_id) DO UPDATE SET "
+                    "round = excluded.round, role = excluded.role, state = excluded.state, "
+                    "updated_at = excluded.updated_at", list(batch.values())
+                )
+                db.commit()
+            except sqlite3.Error as e:
+                db.rollback()
+                failure = e
+            with self.cond:
+                self.committed += 1
+                self.writing = False
+                self.failure = (self.committed, failure) if failure else None
+                self.cond.notify_all()
+
+    def save(self, session_id, state):
+        row = (session_id, state.get("round", 1), state.get("role"), json.dumps(state, separators=(",", ":")), time.time())
+        with self.cond:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self.write_loop, daemon=True)
+                self.writer.start()
+            self.pending[session_id] = row
+            # A batch already being written does not contain this row: wait for the one after it
+            target = self.committed + (2 if self.writing else 1)
+            self.cond.notify_all()
+            while self.committed < target:
+                self.cond.wait()
+            if self.failure and self.failure[0] == target:
+                raise self.failure[1]
+
+    def load(self, session_id):
+        with self.read_lock:
+            if self.reader is None:
+                self.reader = self.connect()
+            row = self.reader.execute("SELECT state FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        if row is None:
+            logger.info("No saved memory found, starting fresh.")
+            return fresh_state()
+        logger.info("Memory loaded for session %s from %s", session_id, self.path)
+        return json.loads(row[0])
+
+    def close(self, session_id):
+        pass
+
+    def warm(self):
+        with self.read_lock:
+            if self.reader is None:
+                self.reader = self.connect()
+
+def make_state_store(kind=STATE_STORE):
+    if kind == "sqlite":
+        return SQLiteStateStore(STATE_DB)
+    return JournalStateStore(SESSIONS_DIR)
+
+state_store = make_state_store()
+
+# 🗄️ History index: every log entry and subtask keyed by (session, round) for paginated reads
+HISTORY_DB = os.getenv("HISTORY_DB", "agent_history.sqlite")
+
+class HistoryIndex:
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS log_entries (session_id TEXT, seq INTEGER, round INTEGER, entry TEXT, "
+                "PRIMARY KEY (session_id, seq)) WITHOUT ROWID"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS log_by_round ON log_entries (session_id, round, seq)")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS subtasks (session_id TEXT, seq INTEGER, round INTEGER, task TEXT, "
+                "PRIMARY KEY (session_id, seq)) WITHOUT ROWID"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS subtasks_by_round ON subtasks (session_id, round, seq)")
+        return self.db
+
+    def record_step(self, session_id, previous, state):
+        # Rows added by a step belong to the round that was running when the step started
+        round_num = previous.get("round", 1)
+        start, grown = log_total(previous), log_total(state) - log_total(previous)
+        window = state.get("log", [])
+        log_rows = [
+            (session_id, start + i, round_num, entry)
+            for i, entry in enumerate(window[len(window) - min(grown, len(window)):] if grown > 0 else [])
+        ]
+        done_before = len(previous.get("subtask_progress", []))
+        subtask_rows = [
+            (session_id, done_before + i, round_num, task)
+            for i, task in enumerate(state.get("subtask_progress", [])[done_before:])
+        ]
+        if not log_rows and not subtask_rows:
+            return
+        with self.lock:
+            db = self.connect()
+            db.executemany("INSERT OR IGNORE INTO log_entries VALUES (?, ?, ?, ?)", log_rows)
+            db.executemany("INSERT OR IGNORE INTO subtasks VALUES (?, ?, ?, ?)", subtask_rows)
+            db.commit()
+
+    def page(self, table, column, session_id, since_round, after, limit):
+        with self.lock:
+            rows = self.connect().execute(
+                f"SELECT seq, round, {column} FROM {table} WHERE session_id = ? AND round >= ? AND seq > ? "
+                "ORDER BY seq LIMIT ?", (session_id, since_round, after, limit)
+            ).fetchall()
+        return [{"seq": seq, "round": round_num, column: value} for seq, round_num, value in rows]
+
+    def log(self, session_id, since_round=1, after=-1, limit=100):
+        return self.page("log_entries", "entry", session_id, since_round, after, limit)
+
+    def subtasks(self, session_id, since_round=1, after=-1, limit=100):
+        return self.page("subtasks", "task", session_id, since_round, after, limit)
+
+    def has_session(self, session_id):
+        with self.lock:
+            return self.connect().execute(
+                "SELECT 1 FROM log_entries WHERE session_id = ? LIMIT 1", (session_id,)
+            ).fetchone() is not None
+
+history_index = HistoryIndex(HISTORY_DB)
+
+def persist_step(session_id, previous, state):
+    with SAVE_STATE_LATENCY.time():
+        state_store.save(session_id, state)
+    history_index.record_step(session_id, previous, state)
+
+# 🌡️ Warm-up: the server answers probes at once while the SDK, graph, stores and workers load in the background
+readiness = {"llm_client": False, "agent_graph": False, "state_store": False, "history_index": False, "executor_pool": False}
+warm_up_task = None
+warm_up_error = None
+
+WARM_UP_SECONDS = Gauge("agent_warm_up_seconds", "Time from warm-up start until the agent was ready")
+
+async def warm_up():
+    start = time.perf_counter()
+    await asyncio.to_thread(llm_client)
+    await asyncio.to_thread(retryable_errors)
+    readiness["llm_client"] = True
+    await asyncio.to_thread(agent_graph)
+    readiness["agent_graph"] = True
+    await asyncio.to_thread(state_store.warm)
+    readiness["state_store"] = True
+    await asyncio.to_thread(history_index.connect)
+    readiness["history_index"] = True
+    executor_pool.start()
+    readiness["executor_pool"] = True
+    WARM_UP_SECONDS.set(time.perf_counter() - start)
+    logger.info("Agent warmed up in %.2fs", time.perf_counter() - start)
+
+async def ensure_warm():
+    global warm_up_task, warm_up_error
+    if warm_up_task is None:
+        warm_up_task = asyncio.get_running_loop().create_task(warm_up())
+    if not warm_up_task.done():
+        await asyncio.shield(warm_up_task)
+    if warm_up_task.exception():
+        failed, warm_up_task = warm_up_task, None  # let the next caller try again
+        warm_up_error = f"{type(failed.exception()).__name__}: {failed.exception()}"
+        raise failed.exception()
+    warm_up_error = None
+
+# ⚖️ Session scheduler: SESSION_WORKERS slots, handed out one day at a time by weighted fair queuing over (tenant, priority)
+SESSION_WORKERS = int(os.getenv("SESSION_WORKERS", "64"))
+SESSION_ADMIT_LIMIT = int(os.getenv("SESSION_ADMIT_LIMIT", "5000"))
+SESSION_TENANT_LIMIT = int(os.getenv("SESSION_TENANT_LIMIT", "1000"))
+SESSION_RETRY_AFTER = int(os.getenv("SESSION_RETRY_AFTER", "5"))
+DEFAULT_TENANT = "default"
+DEFAULT_PRIORITY = "normal"
+
+def parse_weights(spec):
+    weights = {}
+    for item in filter(None, spec.split(",")):
+        name, _, weight = item.partition("=")
+        weights[name.strip()] = float(weight)
+    return weights
+
+PRIORITY_WEIGHTS = parse_weights(os.getenv("PRIORITY_WEIGHTS", "high=4,normal=2,low=1"))
+TENANT_WEIGHTS = parse_weights(os.getenv("TENANT_WEIGHTS", ""))
+
+SESSION_QUEUE_DEPTH = Gauge("agent_session_queue_depth", "Sessions waiting for a worker slot", ["priority"])
+SESSION_QUEUE_WAIT = Histogram(
+    "agent_session_queue_wait_seconds", "Time a session day waited for a worker slot", ["priority"],
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 120, 300)
+)
+SESSION_WORKERS_BUSY = Gauge("agent_session_workers_busy", "Worker slots currently running a session day")
+SESSIONS_ADMITTED = Gauge("agent_sessions_admitted", "Sessions admitted and not yet finished")
+SESSIONS_REJECTED = Counter("agent_sessions_rejected_total", "Goals turned away by admission control", ["reason"])
+
+class SessionScheduler:
+    def __init__(self, workers, admit_limit, tenant_limit):
+        self.workers = workers
+        self.admit_limit = admit_limit
+        self.tenant_limit = tenant_limit
+        self.busy = 0
+        self.waiting = 0
+        self.queue = []  # (finish tag, sequence, start tag, future)
+        self.finish = {}  # last finish tag per (tenant, priority) flow
+        self.virtual_time = 0.0
+        self.sequence = itertools.count()
+        self.admitted = {}  # tenant -> sessions queued or running
+
+    def weight(self, tenant, priority):
+        return TENANT_WEIGHTS.get(tenant, 1.0) * PRIORITY_WEIGHTS.get(priority, 1.0)
+
+    def admission_error(self, tenant, count, admitted=None):
+        # `admitted` overrides the local counts (tenant -> open sessions) when replicas share the intake
+        admitted = self.admitted if admitted is None else admitted
+        if sum(admitted.values()) + count > self.admit_limit:
+            return "saturated"
+        if self.tenant_limit and admitted.get(tenant, 0) + count > self.tenant_limit:
+            return "tenant_limit"
+        return None
+
+    def saturated(self, admitted=None):
+        admitted = self.admitted if admitted is None else admitted
+        return sum(admitted.values()) >= self.admit_limit
+
+    def admit(self, tenant):
+        self.admitted[tenant] = self.admitted.get(tenant, 0) + 1
+        SESSIONS_ADMITTED.inc()
+
+    def discharge(self, tenant):
+        self.admitted[tenant] -= 1
+        if not self.admitted[tenant]:
+            del self.admitted[tenant]
+        SESSIONS_ADMITTED.dec()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, tenant, priority):
+        await self.acquire(tenant, priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, tenant, priority):
+        # Every day costs its flow 1 / weight of virtual time; the smallest finish tag runs next
+        flow = (tenant, priority)
+        start = max(self.virtual_time, self.finish.get(flow, 0.0))
+        finish = self.finish[flow] = start + 1 / self.weight(tenant, priority)
+        if self.busy < self.workers and not self.waiting:
+            self.busy += 1
+            self.virtual_time = max(self.virtual_time, start)
+            SESSION_WORKERS_BUSY.set(self.busy)
+            SESSION_QUEUE_WAIT.labels(priority).observe(0)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.queue, (finish, next(self.sequence), start, future))
+        self.waiting += 1
+        SESSION_QUEUE_DEPTH.labels(priority).inc()
+        waited = time.perf_counter()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()  # cancelled just after being handed a slot: pass it on
+            raise
+        finally:
+            self.waiting -= 1
+            SESSION_QUEUE_DEPTH.labels(priority).dec()
+        SESSION_QUEUE_WAIT.labels(priority).observe(time.perf_counter() - waited)
+
+    def release(self):
+        # The slot goes straight to the next live waiter; it only frees up when nobody is queued
+        while self.queue:
+            _, _, start, future = heapq.heappop(self.queue)
+            if not future.done():
+                self.virtual_time = max(self.virtual_time, start)
+                future.set_result(None)
+                return
+        self.busy -= 1
+        SESSION_WORKERS_BUSY.set(self.busy)
+        if not self.busy:
+            # Idle: flows that are behind virtual time carry no credit, forget them
+            self.finish = {flow: tag for flow, tag in self.finish.items() if tag > self.virtual_time}
+
+session_scheduler = SessionScheduler(SESSION_WORKERS, SESSION_ADMIT_LIMIT, SESSION_TENANT_LIMIT)
+
+# 🗂️ Sessions: every goal runs as its own graph execution, one scheduled day at a time
+sessions = {}
+
+async def run_session(session_id):
+    session = sessions[session_id]
+    state = session["state"]
+
+    if state.get("role") == "end":
+        logger.info("[%s] Agent has already completed its tasks. Nothing more to do.", session_id)
+        session["status"] = "done"
+        event_bus.publish(session_id, "status", status="done")
+        if session.get("leased"):
+            await asyncio.to_thread(lease_store.release, POD_NAME, session_id, True)
+        return
+
+    ACTIVE_SESSIONS.inc()
+    config = {"recursion_limit": recursion_limit(state), "configurable": {"thread_id": session_id}}
     try:
+        await ensure_warm()
+        graph = agent_graph()
         while state.get("role") != "end":
-            state = graph.invoke(state, config={"recursion_limit": 25})
-            save_state(state)
+            # A pending checkpoint means this session was interrupted in-process: continue it
+            checkpoint = await graph.aget_state(config)
+            if checkpoint.values and not checkpoint.next:
+                await checkpointer.adelete_thread(session_id)  # finished thread: start over from the saved state
+            graph_input = None if checkpoint.next else state
+
+            # Persist after every step so a crash loses at most the step in flight; the graph pauses
+            # after each review so the session queues again for its next day behind everyone else's
+            previous = state
+            async with session_scheduler.slot(session["tenant"], session["priority"]):
+                if session["status"] == "queued":
+                    session["status"] = "running"
+                    event_bus.publish(session_id, "status", status="running")
+                async for state in graph.astream(
+                    graph_input, config=config, stream_mode="values", interrupt_after=["reviewer_node"]
+                ):
+                    session["state"] = state
+                    await asyncio.to_thread(persist_step, session_id, previous, state)
+                    previous = state
+        session["status"] = "done"
+        await checkpointer.adelete_thread(session_id)
     except langgraph.errors.GraphRecursionError:
-        print("Graph hit recursion limit. Stopping safely.")
+        logger.warning("[%s] Graph hit recursion limit. Stopping safely.", session_id)
+        session["status"] = "stopped"
+    except asyncio.CancelledError:
+        session["status"] = "cancelled"
+        raise
+    except Exception as e:
+        logger.error("[%s] Session failed: %s", session_id, e)
+        session["status"] = "failed"
+        session["error"] = str(e)
+    finally:
+        event_bus.publish(session_id, "status", status=session["status"], error=session.get("error"))
+        ACTIVE_SESSIONS.dec()
+        SESSION_ROUNDS.observe(session["state"].get("round", 1))
+        await asyncio.to_thread(state_store.close, session_id)
+        discard_speculation(session_id, bill=False)
+        speculation_debt.pop(session_id, None)
+        subtask_indexes.pop(session_id, None)
+        if session.get("leased") and session["status"] != "cancelled":
+            await asyncio.to_thread(lease_store.release, POD_NAME, session_id, True)
+            if lease_wakeup is not None:
+                lease_wakeup.set()
+
+def start_session(goal, session_id=None, leased=False, tenant=DEFAULT_TENANT, priority=DEFAULT_PRIORITY):
+    session_id = session_id or uuid.uuid4().hex[:12]
+    goal = " ".join(goal.split()) if goal else goal
+    if session_id in sessions and sessions[session_id]["status"] in ("queued", "running"):
+        return session_id
+
+    state = state_store.load(session_id)
+    state["session_id"] = session_id
+    if goal and goal != state.get("user_goal") and state.get("role") != "end":
+        state["user_goal"] = goal
+        state.pop("difficulty_estimated", None)
+        state.pop("started_at", None)
+    state.setdefault("started_at", time.time())
+
+    sessions[session_id] = {
+        "state": state, "status": "queued", "leased": leased, "tenant": tenant, "priority": priority
+    }
+    session_scheduler.admit(tenant)
+    task = sessions[session_id]["task"] = asyncio.create_task(run_session(session_id))
+    task.add_done_callback(lambda _: session_scheduler.discharge(tenant))
+    return session_id
+
+def session_log_bytes(state):
+    return sum(len(entry) for entry in state.get("log", []))
+
+def session_summary(session_id, session=None):
+    session = session or sessions[session_id]
+    state = session["state"]
+    return {
+        "session_id": session_id,
+        "status": session["status"],
+        "user_goal": state.get("user_goal"),
+        "round": state.get("round", 1),
+        "max_rounds": state.get("max_rounds"),
+        "role": state.get("role"),
+        "error": session.get("error"),
+        "owner": session.get("owner") or (POD_NAME if session.get("leased") else None),
+        "tenant": session.get("tenant"),
+        "priority": session.get("priority"),
+        "end_reason": state.get("end_reason"),
+        "tokens_used": state.get("tokens_used", 0),
+        "rounds_saved": state.get("rounds_saved", 0),
+        "tokens_saved": state.get("tokens_saved", 0),
+        "log_total": log_total(state),
+        "log_in_memory": len(state.get("log", [])),
+        "log_memory_bytes": session_log_bytes(state),
+    }
+
+# 📏 Benchmarks
+def benchmark_state_store(session_counts=(1000, 10000), rounds=3, workers=32):
+    import io
+    import tempfile
+    import contextlib
+    from concurrent.futures import ThreadPoolExecutor
+
+    print(f"{'store':<8} {'sessions':>8} {'writes':>7} {'write s':>8} {'writes/s':>9} {'load s':>7} {'disk MB':>8}")
+    for count in session_counts:
+        for kind in ("journal", "sqlite"):
+            with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()):
+                if kind == "journal":
+                    store = JournalStateStore(os.path.join(tmp, "sessions"), os.path.join(tmp, "agent_memory.json"))
+                else:
+                    store = SQLiteStateStore(os.path.join(tmp, "agent_state.sqlite"))
+                states = {
+                    f"bench-{i}": {**fresh_state(), "session_id": f"bench-{i}", "user_goal": f"Goal {i}", "log": []}
+                    for i in range(count)
+                }
+
+                def play_round(session_id, round_num):
+                    states[session_id] = merge_update(states[session_id], {
+                        "round": round_num + 1,
+                        "task": f"Subtask {round_num}",
+                        "log": [f"Planned task {round_num}", f"Executed task {round_num}", f"Reviewed Day {round_num}"],
+                        "subtask_progress": [f"Subtask {round_num}"],
+                    })
+                    store.save(session_id, states[session_id])
+
+                with ThreadPoolExecutor(workers) as pool:
+                    start = time.perf_counter()
+                    for round_num in range(1, rounds + 1):
+                        list(pool.map(functools.partial(play_round, round_num=round_num), states))
+                    write_seconds = time.perf_counter() - start
+                    for session_id in states:
+                        store.close(session_id)
+
+                    start = time.perf_counter()
+                    list(pool.map(store.load, states))
+                    load_seconds = time.perf_counter() - start
+
+                disk = sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(tmp) for name in names)
+                journals.clear()
+            writes = count * rounds
+            print(
+                f"{kind:<8} {count:>8} {writes:>7} {write_seconds:>8.2f} {writes / write_seconds:>9.0f} "
+                f"{load_seconds:>7.2f} {disk / 1e6:>8.1f}"
+            )
+
+def benchmark_graph(days=8, sessions_per_run=50):
+    import io
+    import contextlib
+
+    async def plan(state):
+        round_num = state.get("round", 1)
+        if round_num > days:
+            return {"role": "end"}
+        return {**log_update(state, f"Planned task {round_num}"), "task": f"Subtask {round_num}", "role": "executor"}
+
+    async def execute(state):
+        return {"results": [[state.get("task", ""), "ok"]], "role": "reviewer"}
+
+    stubs = {
+        "estimate_difficulty": lambda state: {"max_rounds": days, "difficulty_estimated": True, "role": "planner"},
+        "planner_node": plan,
+        "executor_node": execute,
+    }
 
-from fastapi import FastAPI
-from fastapi.responses import JSONResponse
+    async def run(legacy):
+        from langgraph.checkpoint.memory import MemorySaver
+
+        bench_graph = build_graph(stubs, MemorySaver(), legacy=legacy)
+        steps = 0
+        start = time.perf_counter()
+        for i in range(sessions_per_run):
+            config = {"recursion_limit": 1000, "configurable": {"thread_id": f"bench-{i}"}}
+            state = {**fresh_state(), "user_goal": f"Goal {i}", "log": []}
+            async for _ in bench_graph.astream(state, config, stream_mode="updates"):
+                steps += 1
+        return steps / sessions_per_run, time.perf_counter() - start
+
+    print(f"{'topology':<10} {'steps/session':>13} {'steps/day':>9} {'ms/day':>7} {'days @ limit 25':>15}")
+    for legacy in (True, False):
+        with contextlib.redirect_stdout(io.StringIO()):
+            steps, elapsed = asyncio.run(run(legacy))
+        per_day = (steps - GRAPH_SETUP_STEPS) / days
+        print(
+            f"{'legacy' if legacy else 'direct':<10} {steps:>13.0f} {per_day:>9.1f} "
+            f"{elapsed * 1000 / (sessions_per_run * days):>7.2f} {int((25 - GRAPH_SETUP_STEPS) // per_day):>15}"
+        )
+
+def benchmark_suite(session_counts=(50, 200), persistence_rounds=(10, 50, 200)):
+    import io
+    import gc
+    import tempfile
+    import contextlib
+    import tracemalloc
+    global client, llm_scheduler, state_store, history_index, response_cache, node_samples
+
+    # Offline by default, and without rate limits: the suite measures the agent, not the OpenAI quota
+    if LLM_BACKEND == "openai" and not isinstance(client, OfflineLLM):
+        client = FakeLLM(FAKE_LLM_LATENCY, FAKE_LLM_ERROR_RATE, FAKE_LLM_SEED)
+    llm_scheduler = RequestScheduler(1e9, 1e12, LLM_MAX_CONCURRENCY, LLM_LATENCY_TARGET)
+
+    async def run_sessions(count, label):
+        with contextlib.redirect_stdout(io.StringIO()):
+            started = [start_session(f"Benchmark goal {label} {i}") for i in range(count)]
+            await asyncio.gather(*(sessions[session_id]["task"] for session_id in started))
+        return started
+
+    async def throughput():
+        executor_pool.start()
+        print(f"{'sessions':>8} {'seconds':>8} {'sessions/s':>10} {'rounds/s':>9} {'failed':>6}")
+        for count in session_counts:
+            start = time.perf_counter()
+            started = await run_sessions(count, count)
+            elapsed = time.perf_counter() - start
+            rounds = sum(sessions[session_id]["state"].get("round", 1) - 1 for session_id in started)
+            failed = sum(sessions[session_id]["status"] != "done" for session_id in started)
+            print(f"{count:>8} {elapsed:>8.2f} {count / elapsed:>10.1f} {rounds / elapsed:>9.1f} {failed:>6}")
+
+        print(f"\n{'node':<20} {'calls':>7} {'p50 ms':>8} {'p99 ms':>8}")
+        for name, samples in sorted(node_samples.items()):
+            print(f"{name:<20} {len(samples):>7} {percentile(samples, 50) * 1000:>8.1f} {percentile(samples, 99) * 1000:>8.1f}")
+
+        sessions.clear()
+        gc.collect()
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        await run_sessions(session_counts[0], "memory")
+        gc.collect()
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        count = session_counts[0]
+        print(
+            f"\nmemory per session: {(retained - baseline) / count / 1024:.1f} KiB retained, "
+            f"{(peak - baseline) / count / 1024:.1f} KiB peak while running"
+        )
+        executor_pool.close()
+
+    def persistence_cost():
+        session_id = "bench-persistence"
+        state = {**fresh_state(), "session_id": session_id, "user_goal": "Persistence benchmark", "log": []}
+        window = []
+        print(f"\n{'rounds':>6} {'persist ms':>10} {'state KiB':>9}")
+        for round_num in range(1, max(persistence_rounds) + 1):
+            previous = state
+            state = merge_update(state, {
+                "round": round_num + 1,
+                "task": f"Subtask {round_num}",
+                **log_update(state, f"Planned task {round_num}", f"Executed task {round_num}", f"Reviewed Day {round_num}"),
+                "subtask_progress": [f"Subtask {round_num}"],
+            })
+            start = time.perf_counter()
+            persist_step(session_id, previous, state)
+            window.append(time.perf_counter() - start)
+            if round_num in persistence_rounds:
+                print(f"{round_num:>6} {sum(window) / len(window) * 1000:>10.2f} {len(json.dumps(state)) / 1024:>9.1f}")
+                window = []
+        state_store.close(session_id)
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            state_store = make_state_store()
+            history_index = HistoryIndex(HISTORY_DB)
+            response_cache = ResponseCache(LLM_CACHE_PATH, LLM_CACHE_MEMORY_ITEMS, LLM_CACHE_DISK_ITEMS, LLM_CACHE_TTL)
+            node_samples = {}
+            print(f"backend: {type(llm_client()).__name__}, store: {type(state_store).__name__}")
+            asyncio.run(throughput())
+            persistence_cost()
+        finally:
+            os.chdir(cwd)
+
+def benchmark_coldstart(runs=5, timeout=60):
+    import sys
+    import tempfile
+    import subprocess
+    import urllib.request
+
+    def wait_for(url, deadline):
+        while time.perf_counter() < deadline:
+            try:
+                with urllib.request.urlopen(url, timeout=1) as response:
+                    if response.status == 200:
+                        return True
+            except OSError:
+                pass
+            time.sleep(0.005)
+        return False
+
+    print(f"{'run':>3} {'/health ms':>10} {'/ready ms':>9}")
+    health_times, ready_times = [], []
+    for run in range(1, runs + 1):
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+        env = {**os.environ, "PORT": str(port), "LLM_BACKEND": os.getenv("LLM_BACKEND", "fake")}
+        env.pop("USER_GOAL", None)
+        with tempfile.TemporaryDirectory() as tmp:
+            start = time.perf_counter()
+            process = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__)], cwd=tmp, env=env,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+            try:
+                deadline = start + timeout
+                healthy = wait_for(f"http://127.0.0.1:{port}/health", deadline)
+                health_seconds = time.perf_counter() - start
+                ready = healthy and wait_for(f"http://127.0.0.1:{port}/ready", deadline)
+                ready_seconds = time.perf_counter() - start
+            finally:
+                process.terminate()
+                process.wait(timeout=10)
+        if not ready:
+            print(f"{run:>3} {'timeout' if not healthy else f'{health_seconds * 1000:.0f}':>10} {'timeout':>9}")
+            continue
+        health_times.append(health_seconds)
+        ready_times.append(ready_seconds)
+        print(f"{run:>3} {health_seconds * 1000:>10.0f} {ready_seconds * 1000:>9.0f}")
+    if ready_times:
+        print(f"{'p50':>3} {percentile(health_times, 50) * 1000:>10.0f} {percentile(ready_times, 50) * 1000:>9.0f}")
+
+# 🤝 Leases: replicas share sessions through a lease table; expired leases are picked up from persisted state
+LEASE_DB = os.getenv("LEASE_DB")
+LEASE_TTL = float(os.getenv("LEASE_TTL", "30"))
+LEASE_HEARTBEAT = float(os.getenv("LEASE_HEARTBEAT", "10"))
+LEASE_CAPACITY = int(os.getenv("LEASE_CAPACITY", "200"))
+POD_NAME = os.getenv("POD_NAME") or socket.gethostname()
+
+LEASES_OWNED = Gauge("agent_leases_owned", "Sessions this replica currently holds a lease for")
+LEASES_CLAIMED = Counter("agent_leases_claimed_total", "Session leases claimed by this replica", ["kind"])
+LEASES_LOST = Counter("agent_leases_lost_total", "Session leases this replica lost to another replica")
+
+class LeaseStore:
+    # SQLite file locks stand in for a shared coordination service (point LEASE_DB at a shared volume)
+    def __init__(self, path, ttl, weight):
+        self.path = path
+        self.ttl = ttl
+        self.weight = weight
+        self.db = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            self.db.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+            self.db.create_function("flow_weight", 2, lambda tenant, priority: self.weight(tenant, priority), deterministic=True)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS leases (session_id TEXT PRIMARY KEY, goal TEXT, owner TEXT, "
+                "expires_at REAL, done INTEGER DEFAULT 0, created_at REAL)"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS leases_open ON leases (done, expires_at)")
+            for column in ("tenant TEXT", "priority TEXT"):
+                try:
+                    self.db.execute(f"ALTER TABLE leases ADD COLUMN {column}")
+                except sqlite3.OperationalError:
+                    pass  # lease table already has it
+        return self.db
+
+    def submit(self, session_id, goal, tenant, priority):
+        with self.lock:
+            self.connect().execute(
+                "INSERT INTO leases (session_id, goal, owner, expires_at, done, created_at, tenant, priority) "
+                "VALUES (?, ?, NULL, 0, 0, ?, ?, ?) ON CONFLICT(session_id) DO UPDATE SET done = 0, goal = excluded.goal, "
+                "tenant = excluded.tenant, priority = excluded.priority WHERE done = 1",
+                (session_id, goal, time.time(), tenant, priority)
+            )
+
+    def claim(self, owner, limit):
+        now = time.time()
+        with self.lock:
+            db = self.connect()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                # Fair claims: the n-th oldest open session of each (tenant, priority) flow, running ones included,
+                # goes in at n / weight, so a tenant that queued thousands of goals first can't take every slot
+                rows = db.execute(
+                    "SELECT session_id, goal, owner, tenant, priority FROM ("
+                    "SELECT *, ROW_NUMBER() OVER (PARTITION BY tenant, priority ORDER BY created_at) AS position "
+                    "FROM leases WHERE done = 0) WHERE owner IS NULL OR expires_at < ? "
+                    "ORDER BY position / flow_weight(tenant, priority), created_at LIMIT ?", (now, limit)
+                ).fetchall()
+                db.executemany(
+                    "UPDATE leases SET owner = ?, expires_at = ? WHERE session_id = ?",
+                    [(owner, now + self.ttl, row[0]) for row in rows]
+                )
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+        return rows
+
+    def heartbeat(self, owner):
+        with self.lock:
+            db = self.connect()
+            db.execute(
+                "UPDATE leases SET expires_at = ? WHERE owner = ? AND done = 0", (time.time() + self.ttl, owner)
+            )
+            return {row[0] for row in db.execute("SELECT session_id FROM leases WHERE owner = ? AND done = 0", (owner,))}
+
+    def lookup(self, session_id=None):
+        # (session_id, goal, owner, expires_at, done, tenant, priority) rows, for one session or all of them
+        query = "SELECT session_id, goal, owner, expires_at, done, tenant, priority FROM leases"
+        with self.lock:
+            if session_id is None:
+                return self.connect().execute(query + " ORDER BY created_at").fetchall()
+            return self.connect().execute(query + " WHERE session_id = ?", (session_id,)).fetchall()
+
+    def open_sessions(self):
+        # tenant -> sessions submitted to any replica and not finished yet
+        with self.lock:
+            return dict(self.connect().execute(
+                "SELECT COALESCE(tenant, ?), COUNT(*) FROM leases WHERE done = 0 GROUP BY 1", (DEFAULT_TENANT,)
+            ).fetchall())
+
+    def release(self, owner, session_id, done):
+        with self.lock:
+            self.connect().execute(
+                "UPDATE leases SET owner = NULL, expires_at = 0, done = ? WHERE session_id = ? AND owner = ?",
+                (int(done), session_id, owner)
+            )
+
+lease_store = LeaseStore(LEASE_DB, LEASE_TTL, session_scheduler.weight) if LEASE_DB else None
+lease_wakeup = None
+
+def remote_session(row, load=True):
+    # A session this replica doesn't run: status and owner come from its lease, state from the shared store
+    session_id, goal, owner, expires_at, done, tenant, priority = row
+    status = "done" if done else "running" if owner and expires_at > time.time() else "queued"
+    state = {"user_goal": goal}
+    if load:
+        state = state_store.load(session_id)
+        state_store.close(session_id)
+        state["user_goal"] = state.get("user_goal") or goal  # not started yet: nothing saved but the goal
+    return {
+        "state": state, "status": status, "owner": owner if status == "running" else None,
+        "tenant": tenant or DEFAULT_TENANT, "priority": priority or DEFAULT_PRIORITY
+    }
+
+def find_session(session_id):
+    if session_id in sessions:
+        return sessions[session_id]
+    rows = lease_store.lookup(session_id) if lease_store else []
+    return remote_session(rows[0]) if rows else None
+
+def submit_session(goal, session_id=None, tenant=DEFAULT_TENANT, priority=DEFAULT_PRIORITY):
+    if lease_store is None:
+        return start_session(goal, session_id, tenant=tenant, priority=priority)
+    session_id = session_id or uuid.uuid4().hex[:12]
+    lease_store.submit(session_id, " ".join(goal.split()), tenant, priority)
+    if lease_wakeup is not None:
+        lease_wakeup.set()
+    return session_id
+
+async def lease_loop():
+    global lease_wakeup
+    lease_wakeup = asyncio.Event()
+    while True:
+        try:
+            owned = await asyncio.to_thread(lease_store.heartbeat, POD_NAME)
+            for session_id, session in sessions.items():
+                # Someone else holds this lease now (ours expired): stop working on it
+                if session.get("leased") and session["status"] in ("queued", "running") and session_id not in owned:
+                    session["task"].cancel()
+                    LEASES_LOST.inc()
+
+            free = LEASE_CAPACITY - len(owned)
+            if free > 0:
+                claimed = await asyncio.to_thread(lease_store.claim, POD_NAME, free)
+                for session_id, goal, previous_owner, tenant, priority in claimed:
+                    LEASES_CLAIMED.labels("takeover" if previous_owner else "new").inc()
+                    start_session(
+                        goal, session_id, leased=True, tenant=tenant or DEFAULT_TENANT, priority=priority or DEFAULT_PRIORITY
+                    )
+            LEASES_OWNED.set(sum(1 for s in sessions.values() if s.get("leased") and s["status"] in ("queued", "running")))
+        except Exception as e:
+            logger.warning("Lease loop error: %s", e)
+
+        try:
+            await asyncio.wait_for(lease_wakeup.wait(), LEASE_HEARTBEAT)
+        except asyncio.TimeoutError:
+            pass
+        lease_wakeup.clear()
+
+async def release_leases():
+    for session_id, session in sessions.items():
+        if session.get("leased") and session["status"] in ("queued", "running"):
+            await asyncio.to_thread(lease_store.release, POD_NAME, session_id, False)
+
+# 📦 Bulk ingestion: estimate (and optionally plan) a file of goals with bounded concurrency
+def read_goals(path):
+    if path.endswith(".csv"):
+        with open(path, newline="") as f:
+            return [row for row in csv.DictReader(f) if row.get("goal")]
+
+    # Like blank CSV rows, lines without a usable goal are skipped (with a warning) rather than failing the batch
+    records = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                logger.warning("Skipping %s line %s: invalid JSON (%s)", path, number, e)
+                continue
+            record = record if isinstance(record, dict) else {"goal": record}
+            if not isinstance(record.get("goal"), str) or not record["goal"].strip():
+                logger.warning("Skipping %s line %s: no goal", path, number)
+                continue
+            records.append(record)
+    return records
+
+def write_results(path, results):
+    if path.endswith(".csv"):
+        fields = list(dict.fromkeys(key for result in results for key in result))
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(results)
+    else:
+        with open(path, "w") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))]
+
+async def run_batch(path, out_path, concurrency=32, plan=False):
+    records = read_goals(path)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def process(record):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                # Not the graph node: a failed estimate must show up as an error, not as the 3-day fallback
+                goal = " ".join(record["goal"].split())
+                state = {"user_goal": goal, "round": 1, "log": [], "subtask_progress": []}
+                state.update(max_rounds=await estimate_days(goal), difficulty_estimated=True, role="planner")
+                result = {**record, "max_rounds": state["max_rounds"]}
+                if plan:
+                    state = merge_update(state, await planner_node(state))
+                    if state.get("planner_failures"):
+                        result["error"] = state["log"][-1]
+                    else:
+                        result["first_task"] = state.get("task") or "GOAL COMPLETE"
+            except Exception as e:
+                # One bad goal is recorded in its own row instead of losing the whole run
+                result = {**record, "error": f"{type(e).__name__}: {e}"}
+            latencies.append(time.perf_counter() - start)
+            return result
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(process(record) for record in records))
+    elapsed = time.perf_counter() - start
+    write_results(out_path, results)
+
+    failed = sum(1 for result in results if "error" in result)
+    print(f"Processed {len(results)} goals ({failed} failed) in {elapsed:.1f}s -> {out_path}")
+    print(f"Throughput: {len(results) / elapsed if elapsed else 0:.1f} goals/sec")
+    print(f"Latency p50: {percentile(latencies, 50):.2f}s  p99: {percentile(latencies, 99):.2f}s")
+    return results
+
+from contextlib import asynccontextmanager
+from typing import List, Optional
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 import uvicorn
 import threading
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+  warm_up_started = asyncio.create_task(ensure_warm())
+  warm_up_started.add_done_callback(lambda task: task.cancelled() or task.exception())  # failures show up on /ready
+  # 🎯 Keep the single-goal deployment working: USER_GOAL becomes the default session
+  if os.getenv("USER_GOAL"):
+    submit_session(os.getenv("USER_GOAL"), DEFAULT_SESSION)
+  lease_task = asyncio.create_task(lease_loop()) if lease_store else None
+  yield
+  if lease_task:
+    lease_task.cancel()
+    await release_leases()
+  for session in sessions.values():
+    session["task"].cancel()
+  executor_pool.close()
+
+app = FastAPI(lifespan=lifespan)
+
+class GoalRequest(BaseModel):
+  goals: List[str]
+  session_ids: Optional[List[str]] = None
+  tenant: str = DEFAULT_TENANT
+  priority: str = DEFAULT_PRIORITY
 
 @app.get("/health")
 def health_check():
@@ -719,13 +5786,164 @@ def health_check():
 
 @app.get("/ready")
 def ready_check():
-  return JSONResponse(content={"status": "ready"}, status_code=200)
+  checks = {
+    **readiness,
+    "executor_capacity": executor_pool.has_capacity(),
+    "session_capacity": not session_scheduler.saturated(lease_store.open_sessions() if lease_store else None),
+  }
+  if all(checks.values()):
+    return JSONResponse(content={"status": "ready", "checks": checks}, status_code=200)
+  if warm_up_error:
+    status = "failed"
+  elif not all(readiness.values()):
+    status = "warming up"
+  else:
+    status = "busy" if checks["session_capacity"] else "saturated"
+  return JSONResponse(content={"status": status, "checks": checks, "error": warm_up_error}, status_code=503)
+
+@app.get("/metrics")
+def metrics():
+  return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.post("/sessions")
+async def create_sessions(request: GoalRequest):
+  session_ids = request.session_ids or [None] * len(request.goals)
+  if len(session_ids) != len(request.goals):
+    raise HTTPException(status_code=400, detail="session_ids must match goals")
+  if request.priority not in PRIORITY_WEIGHTS:
+    raise HTTPException(status_code=400, detail=f"priority must be one of {sorted(PRIORITY_WEIGHTS)}")
+  # Admission control: refuse the whole request rather than half-start it
+  # With leases the intake is shared, so admission counts every replica's open sessions
+  admitted = await asyncio.to_thread(lease_store.open_sessions) if lease_store else None
+  reason = session_scheduler.admission_error(request.tenant, len(request.goals), admitted)
+  if reason:
+    SESSIONS_REJECTED.labels(reason).inc(len(request.goals))
+    return JSONResponse(
+      content={"detail": "Too many sessions in flight, retry later", "reason": reason},
+      status_code=429, headers={"Retry-After": str(SESSION_RETRY_AFTER)}
+    )
+  started = [
+    submit_session(goal, session_id, request.tenant, request.priority)
+    for goal, session_id in zip(request.goals, session_ids)
+  ]
+  return JSONResponse(content={"session_ids": started}, status_code=202)
+
+@app.get("/sessions")
+def list_sessions():
+  summaries = [session_summary(session_id) for session_id in sessions]
+  if lease_store is not None:
+    # Sessions submitted here but run (or still waiting) elsewhere, listed from the lease table alone
+    rows = lease_store.lookup()
+    summaries += [session_summary(row[0], remote_session(row, load=False)) for row in rows if row[0] not in sessions]
+  return {"sessions": summaries}
+
+@app.get("/sessions/{session_id}")
+def get_session(session_id: str):
+  session = find_session(session_id)
+  if session is None:
+    raise HTTPException(status_code=404, detail="Unknown session")
+  return {**session_summary(session_id, session), "log": session["state"].get("log", [])}
+
+def require_local(session_id):
+  # Live events only exist on the replica running the session: point the client at it
+  if session_id in sessions:
+    return
+  session = find_session(session_id)
+  if session is None:
+    raise HTTPException(status_code=404, detail="Unknown session")
+  raise HTTPException(status_code=409, detail={
+    "message": "Session is handled by another replica", "status": session["status"], "owner": session["owner"]
+  })
+
+def require_history(session_id):
+  if session_id not in sessions and not history_index.has_session(session_id):
+    raise HTTPException(status_code=404, detail="Unknown session")
+
+@app.get("/sessions/{session_id}/log")
+async def get_session_log(session_id: str, since_round: int = 1, after: int = -1, limit: int = 100):
+  await asyncio.to_thread(require_history, session_id)
+  entries = await asyncio.to_thread(history_index.log, session_id, since_round, after, min(max(limit, 1), 1000))
+  return {"entries": entries, "next": entries[-1]["seq"] if entries else after}
+
+@app.get("/sessions/{session_id}/subtasks")
+async def get_session_subtasks(session_id: str, since_round: int = 1, after: int = -1, limit: int = 100):
+  await asyncio.to_thread(require_history, session_id)
+  subtasks = await asyncio.to_thread(history_index.subtasks, session_id, since_round, after, min(max(limit, 1), 1000))
+  return {"subtasks": subtasks, "next": subtasks[-1]["seq"] if subtasks else after}
+
+def follow_session(session_id, queue, only=None):
+  async def events():
+    try:
+      status = sessions[session_id]["status"]
+      yield {"type": "status", "session_id": session_id, "status": status, "round": sessions[session_id]["state"].get("round", 1)}
+      while status not in TERMINAL_STATUSES:
+        event = await queue.get()
+        if only is None or event["type"] in only:
+          yield event
+        if event["type"] == "status":
+          status = event["status"]
+    finally:
+      event_bus.unsubscribe(session_id, queue)
+  return events()
+
+@app.get("/sessions/{session_id}/events")
+async def stream_session_events(session_id: str, types: Optional[str] = None):
+  await asyncio.to_thread(require_local, session_id)
+  only = set(types.split(",")) if types else None
+  queue = event_bus.subscribe(session_id)
+
+  async def events():
+    async for event in follow_session(session_id, queue, only):
+      yield f"id: {event.get('seq', 0)}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+  return StreamingResponse(events(), media_type="text/event-stream")
+
+# The planner-token stream predates the event bus; it is now just a filtered view of it
+@app.get("/sessions/{session_id}/plan-stream")
+async def stream_plan_tokens(session_id: str):
+  await asyncio.to_thread(require_local, session_id)
+  queue = event_bus.subscribe(session_id)
+
+  async def events():
+    async for event in follow_session(session_id, queue, {"token"}):
+      if event["type"] == "token":
+        yield f"data: {json.dumps({'token': event['text']})}\n\n"
+
+  return StreamingResponse(events(), media_type="text/event-stream")
 
 def run_server():
-  uvicorn.run(app, host="0.0.0.0", port=8000)
-
-server_thread = threading.Thread(target = run_server)
-server_thread.start()
+  uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", "8000")))
+
+if __name__ == "__main__":
+  import argparse
+
+  parser = argparse.ArgumentParser(description="LangGraph agent server")
+  parser.add_argument("--batch", help="JSONL or CSV file of goals to estimate instead of serving")
+  parser.add_argument("--out", help="where to write batch results (defaults next to the input)")
+  parser.add_argument("--concurrency", type=int, default=32, help="goals processed at the same time")
+  parser.add_argument("--plan", action="store_true", help="also run the first planner round for each goal")
+  parser.add_argument("--bench", choices=["store", "graph", "suite", "coldstart"], help="run a benchmark instead of serving")
+  args, _ = parser.parse_known_args()
+
+  if args.bench == "store":
+    benchmark_state_store()
+  elif args.bench == "graph":
+    benchmark_graph()
+  elif args.bench == "suite":
+    benchmark_suite()
+  elif args.bench == "coldstart":
+    benchmark_coldstart()
+  elif args.batch:
+    root, ext = os.path.splitext(args.batch)
+    out_path = args.out or f"{root}.results{ext if ext == '.csv' else '.jsonl'}"
+    asyncio.run(run_batch(args.batch, out_path, args.concurrency, args.plan))
+  else:
+    # Serve right away; the agent warms up inside the server's event loop
+    try:
+      asyncio.get_running_loop()
+      threading.Thread(target=run_server, daemon=True).start()  # notebooks already run a loop on this thread
+    except RuntimeError:
+      run_server()
 '''
 
 with open("app.py", "w") as f: